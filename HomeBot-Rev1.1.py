@@ -1,7 +1,11 @@
 import streamlit as st
+import streamlit.components.v1 as components  # For the session cookie
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import os
 from openai import OpenAI  # Using OpenAI SDK for xAI compatibility and streaming
-from passlib.hash import sha256_crypt
+from passlib.context import CryptContext  # Password hashing (bcrypt / argon2, sha256_crypt for older accounts)
+from passlib.exc import MissingBackendError
+from passlib.registry import get_crypt_handler
 import sqlite3
 from dotenv import load_dotenv
 import json
@@ -14,10 +18,13 @@ import sys  # For stdout redirection
 import pygit2  # For git_ops; pip install pygit2
 import subprocess  # Already imported, but explicit
 import requests  # For api_simulate; pip install requests
+from requests.adapters import HTTPAdapter  # For pooled sessions
+from urllib3.util.retry import Retry  # For HTTP retries/backoff
+from urllib.parse import urlparse  # For per-host rate limits
 from black import format_str, FileMode  # For code_lint; pip install black
 import numpy as np  # For embeddings
 from sentence_transformers import SentenceTransformer  # For advanced memory; pip install sentence-transformers torch
-from datetime import datetime, timedelta  # For pruning
+from datetime import datetime, timedelta, timezone  # For pruning
 import jsbeautifier  # For JS/CSS linting; pip install jsbeautifier
 import yaml  # For YAML; pip install pyyaml
 import sqlparse  # For SQL; pip install sqlparse
@@ -26,18 +33,211 @@ import xml.dom.minidom  # Built-in for XML
 import tempfile  # For temp files in linting
 import shlex  # For safe shell splitting
 import builtins  # For restricted globals
+import csv  # For bulk CSV import/export
+import itertools  # For streaming batches
+import hashlib  # For content-hash caches
+import shutil  # For locating external formatters
+import threading  # For process-wide services
+import math  # For salience decay
+import uuid  # For message ids
+import zlib  # For compressed history/memory payloads
+import re  # For FTS query tokens
+import hmac  # For signed login tokens
+import secrets
+import socket  # For the session state server
+import socketserver
+import fcntl  # Single host for the session state server
+from collections import OrderedDict, deque  # For LRU caches and the trace ring buffer
+from contextlib import contextmanager  # For tracing spans
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # For the optional metrics exporter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout  # For parallel tool work
+try:
+    import pyarrow.parquet as pq  # Optional, for Parquet bulk import; pip install pyarrow
+except ImportError:
+    pq = None
+try:
+    import zstandard  # Optional, for zstd payload compression; pip install zstandard
+except ImportError:
+    zstandard = None
 
 # Load environment variables
 load_dotenv()
 API_KEY = os.getenv("XAI_API_KEY")
 if not API_KEY:
     st.error("XAI_API_KEY not set in .env! Please add it and restart.")
+XAI_BASE_URL = os.getenv("XAI_BASE_URL", "https://api.x.ai/v1")  # Override to point at a stand-in server (benchmark.py load)
 LANGSEARCH_API_KEY = os.getenv("LANGSEARCH_API_KEY")
 if not LANGSEARCH_API_KEY:
     st.warning("LANGSEARCH_API_KEY not set in .env—web search tool will fail.")
 
+# Tracing - Spans for turns, model streams, tools, DB statements and encodes; ring buffer + SQLite/JSONL sink
+TRACE_RING_SIZE = 5000  # Recent spans kept in RAM (admin panel / exporter percentiles)
+TRACE_SINK = os.getenv("HOMEBOT_TRACE_SINK", "sqlite")  # sqlite | jsonl | off
+TRACE_DB_PATH = 'traces.db'  # Separate file: trace writes never contend with chatapp.db
+TRACE_JSONL_PATH = 'traces.jsonl'
+TRACE_FLUSH_INTERVAL = 2.0  # Seconds between sink flushes
+TRACE_RETENTION_DAYS = 3
+METRICS_PORT = os.getenv("HOMEBOT_METRICS_PORT")  # Set to serve Prometheus text at http://<host>:<port>/metrics
+
+class Tracer:
+    """Span recorder. Spans nest per thread; finished spans go to the ring buffer and a background sink writer."""
+    def __init__(self, sink=TRACE_SINK):
+        self.sink = sink
+        self.ring = deque(maxlen=TRACE_RING_SIZE)
+        self._pending = deque()
+        self._local = threading.local()
+        if sink != "off":
+            threading.Thread(target=self._run, daemon=True, name="trace-sink").start()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _emit(self, span):
+        self.ring.append(span)
+        if self.sink != "off":
+            self._pending.append(span)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a block; yields the span's attrs dict so the block can add measurements."""
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        span = {"trace_id": parent["trace_id"] if parent else uuid.uuid4().hex[:16], "span_id": uuid.uuid4().hex[:16],
+                "parent_id": parent["span_id"] if parent else None, "name": name, "start": time.time(), "attrs": attrs}
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            span["duration_ms"] = (time.perf_counter() - start) * 1000
+            if stack and stack[-1] is span:
+                stack.pop()
+            self._emit(span)
+
+    def record(self, name, start, duration=None, **attrs):
+        """Leaf span from a perf_counter start (or an explicit duration in seconds), under the current span."""
+        duration = time.perf_counter() - start if duration is None else duration
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        self._emit({"trace_id": parent["trace_id"] if parent else None, "span_id": None,
+                    "parent_id": parent["span_id"] if parent else None, "name": name,
+                    "start": time.time() - duration, "duration_ms": duration * 1000, "attrs": attrs})
+
+    def stage_stats(self):
+        """count / p50 / p95 / max / sum (ms) per span name over the ring buffer."""
+        durations = {}
+        for span in list(self.ring):
+            durations.setdefault(span["name"], []).append(span["duration_ms"])
+        stats = {}
+        for name, values in durations.items():
+            values.sort()
+            stats[name] = {"count": len(values), "p50": round(values[len(values) // 2], 2),
+                           "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+                           "max": round(values[-1], 2), "sum": round(sum(values), 2)}
+        return stats
+
+    def prometheus_text(self):
+        """Prometheus text exposition: a summary per stage (quantiles over the recent-span window)."""
+        lines = [f"# HELP homebot_span_duration_seconds Span duration by stage (over the last {TRACE_RING_SIZE} spans).",
+                 "# TYPE homebot_span_duration_seconds summary"]
+        for name, stat in sorted(self.stage_stats().items()):
+            label = name.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'homebot_span_duration_seconds{{stage="{label}",quantile="0.5"}} {stat["p50"] / 1000:.6f}')
+            lines.append(f'homebot_span_duration_seconds{{stage="{label}",quantile="0.95"}} {stat["p95"] / 1000:.6f}')
+            lines.append(f'homebot_span_duration_seconds_sum{{stage="{label}"}} {stat["sum"] / 1000:.6f}')
+            lines.append(f'homebot_span_duration_seconds_count{{stage="{label}"}} {stat["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def _flush(self, db):
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        if not batch:
+            return
+        if self.sink == "jsonl":
+            with open(TRACE_JSONL_PATH, "a") as f:
+                f.writelines(json.dumps(span, default=str) + "\n" for span in batch)
+            return
+        db.executemany("INSERT INTO trace_spans (trace_id, span_id, parent_id, name, start, duration_ms, attrs) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(sp["trace_id"], sp["span_id"], sp["parent_id"], sp["name"], sp["start"], sp["duration_ms"],
+                         json.dumps(sp["attrs"], default=str)) for sp in batch])
+        db.commit()
+
+    def _run(self):
+        db = None
+        if self.sink == "sqlite":
+            db = sqlite3.connect(TRACE_DB_PATH, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS trace_spans (trace_id TEXT, span_id TEXT, parent_id TEXT, name TEXT, "
+                       "start REAL, duration_ms REAL, attrs TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_start ON trace_spans (start)")
+            db.execute("DELETE FROM trace_spans WHERE start < ?", (time.time() - TRACE_RETENTION_DAYS * 86400,))
+            db.commit()
+        while True:
+            time.sleep(TRACE_FLUSH_INTERVAL)
+            try:
+                self._flush(db)
+            except Exception as e:
+                print(f"[LOG] Trace sink error: {e}")
+
+@st.cache_resource
+def get_tracer():
+    return Tracer()
+
+tracer = get_tracer()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics -> Prometheus text from the process-wide tracer."""
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_tracer().prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@st.cache_resource
+def start_metrics_exporter(port: int):
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-exporter").start()
+    print(f"[LOG] Metrics exporter on :{port}/metrics")
+    return server
+
+if METRICS_PORT:
+    start_metrics_exporter(int(METRICS_PORT))
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that records a 'db.<verb>' span per statement (execute time includes SQLite lock waits)."""
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            tracer.record("db." + (sql.split(None, 1) or ["?"])[0].lower(), start, sql=sql.strip()[:80])
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            tracer.record("db." + (sql.split(None, 1) or ["?"])[0].lower(), start, sql=sql.strip()[:80], many=True)
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute shortcuts) are TracedCursors."""
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
 # Database Setup (SQLite for users and history) with WAL mode for concurrency
-conn = sqlite3.connect('chatapp.db', check_same_thread=False)
+DB_PATH = 'chatapp.db'
+conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=TracedConnection)
 conn.execute("PRAGMA journal_mode=WAL;")
 conn.enable_load_extension(True)
 vec_path = os.path.join(os.path.dirname(__file__), 'sqlite-vec/dist/vec0.so')
@@ -47,8 +247,190 @@ try:
     vec_loaded = True
     st.session_state['vec_loaded'] = True
 except Exception as e:
-    st.warning(f"Vec extension unavailable ({e})—embeddings disabled.")
+    # Retrieval scores embeddings in NumPy, so sqlite-vec is optional
+    print(f"[LOG] Vec extension unavailable ({e}).")
     st.session_state['vec_loaded'] = False
+# Payload Storage - Large history/memory JSON stored compressed (zlib, or zstd with a trained dictionary) behind a marker
+# Layout: b'HBZ' + version byte + codec byte, then the compressed UTF-8 text (a BLOB).
+# Plain TEXT values (legacy rows, small payloads, HOMEBOT_PAYLOAD_CODEC=off) pass through unchanged.
+PAYLOAD_CODEC = os.getenv("HOMEBOT_PAYLOAD_CODEC", "zlib")  # zlib | zstd | off
+PAYLOAD_MIN_BYTES = 512  # Smaller values stay plain text (little to gain; keeps short memories readable in the DB)
+PAYLOAD_LEVELS = {"zlib": 6, "zstd": 9}
+PAYLOAD_MAGIC = b'HBZ'
+PAYLOAD_VERSION = 1
+PAYLOAD_CODECS = {'zlib': 1, 'zstd': 2}
+PAYLOAD_HEADER_SIZE = len(PAYLOAD_MAGIC) + 2
+PAYLOAD_DICT_SIZE = 32 * 1024  # Trained zstd dictionary size (migrate.py payloads --train)
+
+class PayloadCodec:
+    """Compress/decompress stored payloads. zstd frames carry their dictionary id; dictionaries live in payload_dicts."""
+    def __init__(self, codec: str = None):
+        self.codec = codec or PAYLOAD_CODEC
+        if self.codec == "zstd" and zstandard is None:
+            print("[LOG] zstandard not installed—storing payloads with zlib.")
+            self.codec = "zlib"
+        self.lock = threading.Lock()
+        self.dicts = {}  # dict_id -> ZstdCompressionDict
+        self.active_dict = None  # Newest dictionary, used for new writes
+        self.loaded = False
+
+    def _load_dicts(self):
+        """(Re)read zstd dictionaries from the DB (also picks up ones trained by another process)."""
+        db = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            rows = db.execute("SELECT dict_id, data FROM payload_dicts ORDER BY created_at").fetchall()
+        except sqlite3.OperationalError:
+            rows = []  # Table not created yet
+        finally:
+            db.close()
+        for _, data in rows:
+            self.add_dictionary(data)
+        self.loaded = True
+
+    def add_dictionary(self, data: bytes) -> int:
+        """Register a zstd dictionary and make it the one new writes use. Returns its id."""
+        zdict = zstandard.ZstdCompressionDict(data)
+        zdict.precompute_compress(level=PAYLOAD_LEVELS["zstd"])
+        with self.lock:
+            self.dicts[zdict.dict_id()] = zdict
+            self.active_dict = zdict
+        return zdict.dict_id()
+
+    def active_dict_id(self) -> int:
+        if self.codec == "zstd" and not self.loaded:
+            self._load_dicts()
+        return self.active_dict.dict_id() if self.active_dict else 0
+
+    def encode(self, text: str, codec: str = None):
+        """Stored form of a JSON text: a marked compressed BLOB, or the text itself when small or incompressible."""
+        codec = codec or self.codec
+        raw = text.encode()
+        if codec not in PAYLOAD_CODECS or len(raw) < PAYLOAD_MIN_BYTES:
+            return text
+        if codec == "zstd":
+            self.active_dict_id()  # Loads dictionaries on first use
+            body = zstandard.ZstdCompressor(level=PAYLOAD_LEVELS["zstd"], dict_data=self.active_dict).compress(raw)
+        else:
+            body = zlib.compress(raw, PAYLOAD_LEVELS["zlib"])
+        if len(body) + PAYLOAD_HEADER_SIZE >= len(raw):
+            return text
+        return PAYLOAD_MAGIC + bytes([PAYLOAD_VERSION, PAYLOAD_CODECS[codec]]) + body
+
+    def decode(self, value) -> str:
+        """Text of any stored payload (compressed BLOB, plain BLOB or TEXT)."""
+        fmt = payload_format(value)
+        if fmt == "text":
+            return value if isinstance(value, str) else bytes(value).decode()
+        body = bytes(value[PAYLOAD_HEADER_SIZE:])
+        if fmt == "zlib":
+            return zlib.decompress(body).decode()
+        if zstandard is None:
+            raise RuntimeError("zstandard not installed—cannot read zstd payloads.")
+        dict_id = zstandard.get_frame_parameters(body).dict_id
+        zdict = None
+        if dict_id:
+            zdict = self.dicts.get(dict_id)
+            if zdict is None:
+                self._load_dicts()
+                zdict = self.dicts[dict_id]
+        return zstandard.ZstdDecompressor(dict_data=zdict).decompress(body).decode()
+
+    def is_current(self, value) -> bool:
+        """Whether a stored value is already in the form encode() would write (migration skips it)."""
+        fmt = payload_format(value)
+        if fmt == "text":
+            return self.codec not in PAYLOAD_CODECS or len(value.encode() if isinstance(value, str) else value) < PAYLOAD_MIN_BYTES
+        if fmt != self.codec:
+            return False
+        return fmt != "zstd" or zstandard.get_frame_parameters(bytes(value[PAYLOAD_HEADER_SIZE:])).dict_id == self.active_dict_id()
+
+def payload_format(value) -> str:
+    """Storage format of a history/memory payload: 'zlib', 'zstd' or 'text'."""
+    if isinstance(value, (bytes, memoryview)) and value[:len(PAYLOAD_MAGIC)] == PAYLOAD_MAGIC and len(value) > PAYLOAD_HEADER_SIZE \
+            and value[3] == PAYLOAD_VERSION:
+        for name, code in PAYLOAD_CODECS.items():
+            if value[4] == code:
+                return name
+    return "text"
+
+@st.cache_resource
+def get_payload_codec():
+    return PayloadCodec()
+
+def encode_payload(text: str):
+    """Value to store in history.messages / memory.mem_value for a JSON text."""
+    return get_payload_codec().encode(text)
+
+def decode_payload(value):
+    """JSON text of a stored history.messages / memory.mem_value (None stays None)."""
+    if value is None or isinstance(value, str):
+        return value  # Fast path: legacy and small values
+    return get_payload_codec().decode(value)
+
+def migrate_payloads(db, batch: int = 500, max_batches: int = None) -> dict:
+    """Re-encode history and memory payloads not yet in the configured format (resumable, batched)."""
+    codec = get_payload_codec()
+    stats = {"converted": 0, "bytes_before": 0, "bytes_after": 0}
+    for table, column in (("history", "messages"), ("memory", "mem_value")):
+        last_rowid, batches = 0, 0
+        while max_batches is None or batches < max_batches:
+            rows = db.execute(f"SELECT rowid, {column} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                              (last_rowid, batch)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for rowid, value in rows:
+                if value is not None and not codec.is_current(value):
+                    new_value = codec.encode(codec.decode(value))
+                    if new_value != value:
+                        updates.append((new_value, rowid))
+                        stats["bytes_before"] += len(value.encode() if isinstance(value, str) else value)
+                        stats["bytes_after"] += len(new_value.encode() if isinstance(new_value, str) else new_value)
+            db.executemany(f"UPDATE {table} SET {column}=? WHERE rowid=?", updates)
+            db.commit()
+            stats["converted"] += len(updates)
+            last_rowid = rows[-1][0]
+            batches += 1
+    return stats
+
+def train_payload_dictionary(db, samples: int = 5000, size: int = PAYLOAD_DICT_SIZE) -> int:
+    """Train a zstd dictionary on recent history/memory payloads and store it in payload_dicts. Returns its id."""
+    if zstandard is None:
+        raise RuntimeError("zstandard not installed—pip install zstandard to train dictionaries.")
+    codec = get_payload_codec()
+    rows = db.execute("SELECT messages FROM history ORDER BY convo_id DESC LIMIT ?", (samples // 2,)).fetchall()
+    rows += db.execute("SELECT mem_value FROM memory ORDER BY rowid DESC LIMIT ?", (samples // 2,)).fetchall()
+    texts = [codec.decode(row[0]).encode() for row in rows if row[0] is not None]
+    try:
+        zdict = zstandard.train_dictionary(size, texts)
+    except zstandard.ZstdError as e:
+        raise RuntimeError(f"Not enough stored payloads to train a dictionary ({len(texts)} samples): {e}")
+    db.execute("INSERT OR REPLACE INTO payload_dicts (dict_id, data, created_at) VALUES (?, ?, ?)",
+               (zdict.dict_id(), zdict.as_bytes(), time.time()))
+    db.commit()
+    return codec.add_dictionary(zdict.as_bytes())
+
+def memory_text(mem_value) -> str:
+    """Searchable text of a stored memory value: JSON leaf values (keys dropped), else the raw string."""
+    mem_value = decode_payload(mem_value)
+    try:
+        data = json.loads(mem_value)
+    except (TypeError, ValueError):
+        return mem_value or ""
+    parts, stack = [], [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(reversed(list(item.values())))
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+        elif item is not None:
+            parts.append(str(item))
+    return " ".join(parts)
+
+conn.create_function("hb_pow", 2, math.pow, deterministic=True)  # For salience decay SQL
+conn.create_function("hb_text", 1, memory_text, deterministic=True)  # For the memory FTS index
+conn.execute("PRAGMA recursive_triggers=ON")  # INSERT OR REPLACE deletes must fire FTS sync triggers
 c = conn.cursor()
 c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)''')
 c.execute('''CREATE TABLE IF NOT EXISTS history (user TEXT, convo_id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, messages TEXT)''')
@@ -75,16 +457,490 @@ try:
     c.execute("ALTER TABLE memory ADD COLUMN parent_id INTEGER")
 except sqlite3.OperationalError:
     pass
+for column in ("last_accessed DATETIME", "decayed_at DATETIME"):  # For time-based salience decay
+    try:
+        c.execute(f"ALTER TABLE memory ADD COLUMN {column}")
+    except sqlite3.OperationalError:
+        pass
+# User-scoped retrieval: recent-per-convo, salience ranking, and embedded-row counts without table scans
+c.execute('CREATE INDEX IF NOT EXISTS idx_memory_user_convo_time ON memory (user, convo_id, timestamp)')
+c.execute('CREATE INDEX IF NOT EXISTS idx_memory_user_salience ON memory (user, salience)')
+c.execute('CREATE INDEX IF NOT EXISTS idx_memory_user_embedded ON memory (user) WHERE embedding IS NOT NULL')
+# Keyword index over memory text (external content via a view; triggers keep it in sync with every write path)
+fts_loaded = False
+try:
+    fts_sql = (c.execute("SELECT sql FROM sqlite_master WHERE name='memory_fts'").fetchone() or [""])[0]
+    if fts_sql and "memory_fts_src" not in fts_sql:
+        # Older raw-JSON index: replace with one over extracted text (summaries, string values)
+        c.executescript("DROP TRIGGER IF EXISTS memory_fts_ai; DROP TRIGGER IF EXISTS memory_fts_ad; "
+                        "DROP TRIGGER IF EXISTS memory_fts_au; DROP TABLE memory_fts;")
+    c.execute("CREATE VIEW IF NOT EXISTS memory_fts_src AS SELECT rowid AS id, mem_key AS key_text, hb_text(mem_value) AS body FROM memory")
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(key_text, body, content='memory_fts_src', content_rowid='id')")
+    c.executescript('''
+        CREATE TRIGGER IF NOT EXISTS memory_fts_ai AFTER INSERT ON memory BEGIN
+            INSERT INTO memory_fts (rowid, key_text, body) VALUES (new.rowid, new.mem_key, hb_text(new.mem_value));
+        END;
+        CREATE TRIGGER IF NOT EXISTS memory_fts_ad AFTER DELETE ON memory BEGIN
+            INSERT INTO memory_fts (memory_fts, rowid, key_text, body) VALUES ('delete', old.rowid, old.mem_key, hb_text(old.mem_value));
+        END;
+        CREATE TRIGGER IF NOT EXISTS memory_fts_au AFTER UPDATE OF mem_key, mem_value ON memory BEGIN
+            INSERT INTO memory_fts (memory_fts, rowid, key_text, body) VALUES ('delete', old.rowid, old.mem_key, hb_text(old.mem_value));
+            INSERT INTO memory_fts (rowid, key_text, body) VALUES (new.rowid, new.mem_key, hb_text(new.mem_value));
+        END;
+    ''')
+    if not fts_sql or "memory_fts_src" not in fts_sql:
+        c.execute("INSERT INTO memory_fts (memory_fts) VALUES ('rebuild')")  # Backfill existing rows
+    fts_loaded = True
+except sqlite3.OperationalError as e:
+    print(f"[LOG] FTS5 unavailable ({e})—keyword memory search disabled.")
+# Memory change log: every write path (tools, background jobs, prune, other processes) records the
+# keys it touched, so the shared memory cache can invalidate exactly those keys
+c.execute('''CREATE TABLE IF NOT EXISTS memory_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT,
+    convo_id INTEGER,
+    mem_key TEXT
+)''')
+c.executescript('''
+    CREATE TRIGGER IF NOT EXISTS memory_changes_ai AFTER INSERT ON memory BEGIN
+        INSERT INTO memory_changes (user, convo_id, mem_key) VALUES (new.user, new.convo_id, new.mem_key);
+    END;
+    CREATE TRIGGER IF NOT EXISTS memory_changes_ad AFTER DELETE ON memory BEGIN
+        INSERT INTO memory_changes (user, convo_id, mem_key) VALUES (old.user, old.convo_id, old.mem_key);
+    END;
+    CREATE TRIGGER IF NOT EXISTS memory_changes_au AFTER UPDATE OF user, convo_id, mem_key, mem_value ON memory BEGIN
+        INSERT INTO memory_changes (user, convo_id, mem_key) VALUES (old.user, old.convo_id, old.mem_key);
+        INSERT INTO memory_changes (user, convo_id, mem_key) VALUES (new.user, new.convo_id, new.mem_key);
+    END;
+''')
+# Web search cache (persistent across sessions, TTL per freshness filter)
+c.execute('''CREATE TABLE IF NOT EXISTS search_cache (
+    cache_key TEXT PRIMARY KEY,
+    response TEXT,
+    created_at REAL,
+    expires_at REAL
+)''')
+# Response cache for repeated questions (opt-in per session)
+c.execute('''CREATE TABLE IF NOT EXISTS response_cache (
+    cache_key TEXT PRIMARY KEY,
+    scope_key TEXT,
+    query TEXT,
+    embedding BLOB,
+    response TEXT,
+    created_at REAL,
+    expires_at REAL,
+    hits INTEGER DEFAULT 0
+)''')
+c.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_scope ON response_cache (scope_key, created_at)")
+# zstd dictionaries for compressed history/memory payloads (HOMEBOT_PAYLOAD_CODEC=zstd)
+c.execute('''CREATE TABLE IF NOT EXISTS payload_dicts (
+    dict_id INTEGER PRIMARY KEY,
+    data BLOB,
+    created_at REAL
+)''')
+# Full tool outputs behind the compacted results fed back to the model (paged via tool_output_page)
+c.execute('''CREATE TABLE IF NOT EXISTS tool_outputs (
+    handle TEXT PRIMARY KEY,
+    user TEXT,
+    tool TEXT,
+    content TEXT,
+    created_at REAL
+)''')
+# Login tokens (hashed); a refresh resumes the login from the homebot_auth cookie
+c.execute('''CREATE TABLE IF NOT EXISTS auth_sessions (
+    token_hash TEXT PRIMARY KEY,
+    user TEXT,
+    created_at REAL,
+    expires_at REAL
+)''')
+# Shared session state (HOMEBOT_SESSION_BACKEND=sqlite)
+c.execute('''CREATE TABLE IF NOT EXISTS session_state (
+    sid TEXT PRIMARY KEY,
+    data TEXT,
+    updated_at REAL
+)''')
+# Background job queue for memory consolidation (durable; survives restarts)
+c.execute('''CREATE TABLE IF NOT EXISTS memory_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT,
+    convo_id INTEGER,
+    mem_key TEXT,
+    payload TEXT,  -- interaction_data JSON
+    status TEXT DEFAULT 'pending',  -- pending | running | done | failed
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
+    created_at REAL,
+    updated_at REAL,
+    next_run_at REAL
+)''')
+c.execute('CREATE INDEX IF NOT EXISTS idx_memory_jobs_status ON memory_jobs (status, next_run_at)')
+try:
+    c.execute("ALTER TABLE memory_jobs ADD COLUMN embed INTEGER DEFAULT 1")  # Embed episodic data for vector search
+except sqlite3.OperationalError:
+    pass
 conn.commit()
 
+def open_db_connection():
+    """New connection to the app DB for background threads (own transactions, waits on locks)."""
+    db = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False, factory=TracedConnection)
+    db.execute("PRAGMA busy_timeout=30000")
+    db.create_function("hb_pow", 2, math.pow, deterministic=True)
+    db.create_function("hb_text", 1, memory_text, deterministic=True)
+    db.execute("PRAGMA recursive_triggers=ON")
+    return db
+
+class ThreadLocalProxy:
+    """Per-thread stand-in for a module global (conn, c, st.session_state) outside Streamlit's one-run-per-session model.
+    Used by server.py and benchmark.py: each worker thread gets its own connection, and a session's state is bound per turn."""
+    def __init__(self, factory=None):
+        self._factory = factory
+        self._local = threading.local()
+
+    def bind(self, obj):
+        self._local.obj = obj
+
+    def unbind(self):
+        self._local.obj = None
+
+    def _get(self):
+        obj = getattr(self._local, "obj", None)
+        if obj is None:
+            if self._factory is None:
+                raise RuntimeError("Nothing bound to this thread.")
+            obj = self._local.obj = self._factory()
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __setitem__(self, key, value):
+        self._get()[key] = value
+
+    def __delitem__(self, key):
+        del self._get()[key]
+
+    def __contains__(self, key):
+        return key in self._get()
+
+# Session State Store - Serializable per-session state shared by worker processes (memory | sqlite | socket)
+# Non-serializable state (REPL namespace, embedding model, uploaded images) stays in the worker that created it;
+# a reverse proxy keeps a browser on one worker with sticky routing on the homebot_sid cookie (see README).
+# Only small keys are shared: the open chat is reloaded from history by current_convo_id, the tool cache stays local.
+SESSION_BACKEND = os.getenv("HOMEBOT_SESSION_BACKEND", "memory")
+SESSION_SOCKET_PATH = os.getenv("HOMEBOT_SESSION_SOCKET", "/tmp/homebot-sessions.sock")
+SESSION_COOKIE = "homebot_sid"
+WORKER_COOKIE = "homebot_worker"
+WORKER_ID = os.getenv("HOMEBOT_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+SESSION_TTL_DAYS = 7
+SESSION_SHARED_KEYS = ("theme", "current_convo_id", "history_visible",
+                       "tool_categories", "tool_selection", "xai_conv_id", "prompt_usage", "routing_policy")
+
+def _session_default(obj):
+    if isinstance(obj, set):
+        return {"__set__": sorted(obj, key=str)}
+    if isinstance(obj, datetime):
+        return {"__datetime__": obj.isoformat()}
+    raise TypeError(f"{type(obj).__name__} is not session-serializable")
+
+def _session_object(d):
+    if len(d) == 1 and "__set__" in d:
+        return set(d["__set__"])
+    if len(d) == 1 and "__datetime__" in d:
+        return datetime.fromisoformat(d["__datetime__"])
+    return d
+
+def session_snapshot(state) -> str:
+    """JSON of the shared keys of a session state (st.session_state or a plain dict), tagged with its owner.
+    The owner only guards restores; login itself always comes from a verified auth token."""
+    shared = {key: state[key] for key in SESSION_SHARED_KEYS if key in state}
+    shared["owner"] = state.get("user")
+    return json.dumps(shared, default=_session_default, separators=(",", ":"))
+
+class InProcessSessionStore:
+    """Default: this process only (also the backing store of the socket server)."""
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            return entry[0] if entry else None
+
+    def put(self, sid, text):
+        with self._lock:
+            self._data[sid] = (text, time.time())
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def purge(self, max_age):
+        cutoff = time.time() - max_age
+        with self._lock:
+            stale = [sid for sid, (_, updated) in self._data.items() if updated < cutoff]
+            for sid in stale:
+                del self._data[sid]
+        return len(stale)
+
+class SQLiteSessionStore:
+    """session_state table in the app DB: shared by every worker on this host (and survives restarts)."""
+    def __init__(self):
+        self._db = open_db_connection()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM session_state WHERE sid=?", (sid,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, sid, text):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO session_state (sid, data, updated_at) VALUES (?, ?, ?)", (sid, text, time.time()))
+            self._db.commit()
+
+    def delete(self, sid):
+        with self._lock:
+            self._db.execute("DELETE FROM session_state WHERE sid=?", (sid,))
+            self._db.commit()
+
+    def purge(self, max_age):
+        with self._lock:
+            cur = self._db.execute("DELETE FROM session_state WHERE updated_at < ?", (time.time() - max_age,))
+            self._db.commit()
+        return cur.rowcount
+
+class SessionStateHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line: {"op": get|put|delete|purge, ...} -> one JSON reply per line."""
+    def handle(self):
+        store = self.server.store
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request["op"]
+                if op == "get":
+                    reply = {"data": store.get(request["sid"])}
+                elif op == "put":
+                    store.put(request["sid"], request["data"])
+                    reply = {"ok": True}
+                elif op == "delete":
+                    store.delete(request["sid"])
+                    reply = {"ok": True}
+                elif op == "purge":
+                    reply = {"purged": store.purge(request["max_age"])}
+                else:
+                    reply = {"error": f"unknown op {op}"}
+            except (ValueError, KeyError) as e:
+                reply = {"error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+class SessionStateServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class SocketSessionStore:
+    """Client of a local-socket state server shared by the workers on this host.
+    The first worker that finds no server hosts one (in memory); a lock file makes sure only one does."""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()  # One connection per thread
+        self._host_lock = None
+
+    def _host(self):
+        if self._host_lock is not None:
+            return
+        lock = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()  # Another worker hosts it (or is starting it)
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left behind by a worker that exited
+        server = SessionStateServer(self.path, SessionStateHandler)
+        server.store = InProcessSessionStore()
+        threading.Thread(target=server.serve_forever, daemon=True, name="session-state-server").start()
+        self._host_lock = lock
+        print(f"[LOG] Hosting session state server at {self.path} ({WORKER_ID})")
+
+    def _call(self, request):
+        for attempt in range(5):
+            stream = getattr(self._local, "stream", None)
+            try:
+                if stream is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.connect(self.path)
+                    stream = self._local.stream = sock.makefile("rwb")
+                stream.write(json.dumps(request).encode() + b"\n")
+                stream.flush()
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError("session state server closed the connection")
+                return json.loads(line)
+            except OSError:
+                self._local.stream = None
+                self._host()
+                time.sleep(0.05 * attempt)
+        raise ConnectionError(f"Session state server unavailable at {self.path}")
+
+    def get(self, sid):
+        return self._call({"op": "get", "sid": sid}).get("data")
+
+    def put(self, sid, text):
+        self._call({"op": "put", "sid": sid, "data": text})
+
+    def delete(self, sid):
+        self._call({"op": "delete", "sid": sid})
+
+    def purge(self, max_age):
+        return self._call({"op": "purge", "max_age": max_age}).get("purged", 0)
+
+@st.cache_resource
+def get_session_store():
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionStore()
+    if SESSION_BACKEND == "socket":
+        return SocketSessionStore(SESSION_SOCKET_PATH)
+    return InProcessSessionStore()
+
+def load_session_state(sid):
+    """Shared state saved for sid, or None."""
+    try:
+        text = get_session_store().get(sid)
+    except ConnectionError as e:
+        print(f"[LOG] Session state load failed: {e}")
+        return None
+    return json.loads(text, object_hook=_session_object) if text else None
+
+def save_session_state(sid, state):
+    get_session_store().put(sid, session_snapshot(state))
+
+def restore_session():
+    """Once per browser session: pick up the session id cookie and any state another worker saved for it."""
+    if 'session_id' in st.session_state:
+        return
+    sid = st.context.cookies.get(SESSION_COOKIE, "")
+    if not re.fullmatch(r"[0-9a-f]{32}", sid):
+        sid = uuid.uuid4().hex
+    # Refresh both cookies; the worker cookie lets a proxy pin this browser to the worker holding its local-only state
+    components.html(f"<script>window.parent.document.cookie = '{SESSION_COOKIE}={sid}; path=/; max-age={SESSION_TTL_DAYS * 86400}; SameSite=Strict';"
+                    f"window.parent.document.cookie = '{WORKER_COOKIE}={WORKER_ID}; path=/; SameSite=Strict';</script>", height=0)
+    st.session_state['session_id'] = sid
+    user = resume_auth_token(st.context.cookies.get(AUTH_COOKIE, ""))  # The only way a new browser session is logged in
+    if user:
+        st.session_state['logged_in'] = True
+        st.session_state['user'] = user
+        stored = load_session_state(sid) or {}
+        if stored.pop("owner", None) == user:
+            for key, value in stored.items():
+                if key not in st.session_state:
+                    st.session_state[key] = value
+            messages = history_messages(user, st.session_state.get('current_convo_id'))
+            if messages is None:
+                st.session_state.pop('current_convo_id', None)  # Deleted since; start a new chat
+            elif 'messages' not in st.session_state:
+                st.session_state['messages'] = messages
+    st.session_state['session_digest'] = hashlib.sha1(session_snapshot(st.session_state).encode()).hexdigest()
+    if st.context.cookies.get(WORKER_COOKIE) not in (None, WORKER_ID):
+        print(f"[LOG] Session {sid[:8]} moved to worker {WORKER_ID}; local-only state (REPL, uploads) starts fresh.")
+
+def persist_session():
+    """End of each script run: save the shared keys if they changed."""
+    sid = st.session_state.get('session_id')
+    if not sid or not st.session_state.get('logged_in'):  # Anonymous runs must not overwrite the owner's saved state
+        return
+    text = session_snapshot(st.session_state)
+    digest = hashlib.sha1(text.encode()).hexdigest()
+    if digest != st.session_state.get('session_digest'):
+        try:
+            get_session_store().put(sid, text)
+            st.session_state['session_digest'] = digest
+        except ConnectionError as e:
+            print(f"[LOG] Session state save failed: {e}")
+
+# Embedding Storage - Versioned blobs with float16 / int8 scalar quantization
+# Layout: b'HBE' + version byte + dtype byte, then [float32 scale (int8 only)] + vector.
+# Headerless blobs are legacy raw float32 (tobytes()) and still decode.
+EMBEDDING_FORMAT = os.getenv("HOMEBOT_EMBEDDING_FORMAT", "float16")  # float32 | float16 | int8
+EMBED_MAGIC = b'HBE'
+EMBED_VERSION = 1
+EMBED_DTYPES = {'float32': 1, 'float16': 2, 'int8': 3}
+EMBED_HEADER_SIZE = len(EMBED_MAGIC) + 2
+
+def encode_embedding(vector, fmt: str = None) -> bytes:
+    """Serialize an embedding vector in the configured storage format."""
+    fmt = fmt or EMBEDDING_FORMAT
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    header = EMBED_MAGIC + bytes([EMBED_VERSION, EMBED_DTYPES[fmt]])
+    if fmt == 'float16':
+        return header + vector.astype(np.float16).tobytes()
+    if fmt == 'int8':
+        scale = float(np.abs(vector).max()) / 127.0 or 1.0
+        quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return header + np.float32(scale).tobytes() + quantized.tobytes()
+    return header + vector.tobytes()
+
+def embedding_format(blob: bytes) -> str:
+    """Storage format of a blob ('legacy' for headerless float32)."""
+    if blob[:len(EMBED_MAGIC)] == EMBED_MAGIC and len(blob) > EMBED_HEADER_SIZE and blob[3] == EMBED_VERSION:
+        for name, code in EMBED_DTYPES.items():
+            if blob[4] == code:
+                return name
+    return 'legacy'
+
+def decode_embedding(blob: bytes) -> np.ndarray:
+    """Deserialize any stored embedding blob to a float32 vector."""
+    fmt = embedding_format(blob)
+    if fmt == 'legacy':
+        return np.frombuffer(blob, dtype=np.float32)
+    body = blob[EMBED_HEADER_SIZE:]
+    if fmt == 'float16':
+        return np.frombuffer(body, dtype=np.float16).astype(np.float32)
+    if fmt == 'int8':
+        scale = np.frombuffer(body[:4], dtype=np.float32)[0]
+        return np.frombuffer(body[4:], dtype=np.int8).astype(np.float32) * scale
+    return np.frombuffer(body, dtype=np.float32)
+
+def migrate_embeddings(db, fmt: str = None, batch: int = 500, max_batches: int = None) -> dict:
+    """Re-encode stored embeddings not yet in the target format (resumable, batched)."""
+    fmt = fmt or EMBEDDING_FORMAT
+    stats = {"converted": 0, "bytes_before": 0, "bytes_after": 0}
+    last_rowid, batches = 0, 0
+    while max_batches is None or batches < max_batches:
+        rows = db.execute("SELECT rowid, embedding FROM memory WHERE rowid > ? AND embedding IS NOT NULL ORDER BY rowid LIMIT ?",
+                          (last_rowid, batch)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for rowid, blob in rows:
+            if embedding_format(blob) != fmt:
+                new_blob = encode_embedding(decode_embedding(blob), fmt)
+                updates.append((new_blob, rowid))
+                stats["bytes_before"] += len(blob)
+                stats["bytes_after"] += len(new_blob)
+        db.executemany("UPDATE memory SET embedding=? WHERE rowid=?", updates)
+        db.commit()
+        stats["converted"] += len(updates)
+        last_rowid = rows[-1][0]
+        batches += 1
+    return stats
+
 # Load embedding model lazily (only if advanced memory tools might be used)
+@st.cache_resource
+def get_embed_model():
+    """Process-wide embedding model, shared by sessions and background workers."""
+    return SentenceTransformer('all-MiniLM-L6-v2')
+
 def load_embed_model():
     if 'embed_model' not in st.session_state:
         # Load only if advanced tools enabled or in prompt
         enable_tools = st.session_state.get('enable_tools', False)
         custom_prompt = st.session_state.get('custom_prompt', '')
         if enable_tools and ('advanced_memory' in custom_prompt or 'embedding' in custom_prompt):
-            st.session_state['embed_model'] = SentenceTransformer('all-MiniLM-L6-v2')
+            st.session_state['embed_model'] = get_embed_model()
             st.info("Loaded embedding model for advanced memory.")
         else:
             st.session_state['embed_model'] = None
@@ -107,11 +963,16 @@ fs_write_file(file_path, content): Write the provided content to a file in the s
 fs_list_files(dir_path optional): List all files in the specified directory in the sandbox (e.g., 'subdir'; default root). Use to check available files.
 fs_mkdir(dir_path): Create a new directory in the sandbox (e.g., 'subdir/newdir'). Supports nested paths. Use to organize files.
 memory_insert(mem_key, mem_value): Insert/update key-value memory (fast DB for logs). mem_value as dict.
-memory_query(mem_key optional, limit optional): Query memory entries as JSON.
+memory_query(mem_key optional, limit optional, scope optional): Query memory entries as JSON. scope 'user' searches all of the user's chats.
 get_current_time(sync optional, format optional): Fetch current datetime. sync: true for NTP, false for local. format: 'iso', 'human', 'json'.
 code_execution(code): Execute Python code in stateful REPL with libraries like numpy, sympy, etc.
 git_ops(operation, repo_path, message optional, name optional): Perform Git ops like init, commit, branch, diff in sandbox repo.
 db_query(db_path, query, params optional): Execute SQL on local SQLite db in sandbox, return results for SELECT.
+db_bulk(operation, db_path, file_path, table optional, query optional, format optional): Bulk import a CSV/TSV/JSONL/JSON/Parquet sandbox file into a table, or export SELECT results to CSV/TSV/JSONL. Use instead of many INSERTs.
+advanced_memory_consolidate(mem_key, interaction_data): Summarize + embed in the background; returns a job id.
+memory_job_status(job_id optional): Check consolidation job progress.
+load_tools(categories): Only the tools relevant to the conversation are attached; load more by category if the one you need is missing.
+tool_output_page(handle, offset optional, length optional): Page through a large tool result that was compacted (handle is in the '[Result compacted ...]' note).
 shell_exec(command): Run whitelisted shell commands (ls, grep, sed, etc.) in sandbox.
 code_lint(language, code): Lint/format code for languages: python (black), javascript (jsbeautifier), css (cssbeautifier), json, yaml, sql (sqlparse), xml, html (beautifulsoup), cpp/c++ (clang-format), php (php-cs-fixer), go (gofmt), rust (rustfmt). External tools required for some.
 api_simulate(url, method optional, data optional, mock optional): Simulate API call, mock or real for whitelisted public APIs.
@@ -124,9 +985,52 @@ if not any(f.endswith('.txt') for f in os.listdir(PROMPTS_DIR)):
         with open(os.path.join(PROMPTS_DIR, filename), 'w') as f:
             f.write(content)
 
+# Prompt Registry - Shared across sessions; files re-read only when their mtime/size changes
+class PromptRegistry:
+    """Prompt file listing and contents, validated against the filesystem on each access (one stat, no read)."""
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._listing = (None, [])  # (dir mtime_ns, sorted names); add/remove/rename bumps the dir mtime
+        self._files = {}  # name -> ((mtime_ns, size), content)
+        self.stats = {"reads": 0, "hits": 0}
+
+    def list(self):
+        mtime = os.stat(self.directory).st_mtime_ns
+        with self._lock:
+            if self._listing[0] != mtime:
+                names = sorted(f for f in os.listdir(self.directory) if f.endswith('.txt'))
+                self._listing = (mtime, names)
+                self._files = {name: entry for name, entry in self._files.items() if name in names}
+            return list(self._listing[1])
+
+    def read(self, name):
+        path = os.path.join(self.directory, name)
+        info = os.stat(path)
+        signature = (info.st_mtime_ns, info.st_size)
+        with self._lock:
+            cached = self._files.get(name)
+            if cached and cached[0] == signature:
+                self.stats["hits"] += 1
+                return cached[1]
+        with open(path, "r") as f:
+            content = f.read()
+        with self._lock:
+            self._files[name] = (signature, content)
+            self.stats["reads"] += 1
+        return content
+
+    def save(self, name, content):
+        with open(os.path.join(self.directory, name), "w") as f:
+            f.write(content)
+
+@st.cache_resource
+def get_prompt_registry():
+    return PromptRegistry(PROMPTS_DIR)
+
 # Function to Load Prompt Files
 def load_prompt_files():
-    return [f for f in os.listdir(PROMPTS_DIR) if f.endswith('.txt')]
+    return get_prompt_registry().list()
 
 # Sandbox Directory for FS Tools (create if not exists)
 SANDBOX_DIR = "./sandbox"
@@ -181,17 +1085,164 @@ st.markdown("""<style>
 </style>
 """, unsafe_allow_html=True)
 
+# Password Hashing - passlib CryptContext (bcrypt | argon2, tuned for a Pi); older hashes are upgraded at the next login
+# bcrypt and argon2-cffi hash in C without holding the GIL, so hashing inline in the login's own script thread
+# doesn't stall other sessions; a process-wide semaphore caps concurrent hashes (a login burst waits its turn).
+PASSWORD_SCHEME = os.getenv("HOMEBOT_PASSWORD_SCHEME", "bcrypt")  # bcrypt | argon2 (pip install argon2-cffi) | sha256_crypt
+BCRYPT_ROUNDS = int(os.getenv("HOMEBOT_BCRYPT_ROUNDS", "11"))  # ~0.2s per hash on a Pi 4; each +1 doubles it
+ARGON2_TIME_COST = int(os.getenv("HOMEBOT_ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_KIB = int(os.getenv("HOMEBOT_ARGON2_MEMORY_KIB", "19456"))  # 19 MiB
+PASSWORD_SCHEMES = ("bcrypt", "argon2", "sha256_crypt")  # All verify; all but the configured one are rehashed on login
+PASSWORD_SLOTS = 2  # Concurrent hashes (each pins a core)
+
+def _password_context() -> CryptContext:
+    scheme = PASSWORD_SCHEME
+    if not get_crypt_handler(scheme).has_backend():
+        print(f"[LOG] {scheme} backend not installed—hashing passwords with sha256_crypt.")
+        scheme = "sha256_crypt"
+    return CryptContext(schemes=[scheme] + [s for s in PASSWORD_SCHEMES if s != scheme], deprecated="auto",
+                        bcrypt__rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS, argon2__time_cost=ARGON2_TIME_COST,
+                        argon2__memory_cost=ARGON2_MEMORY_KIB, argon2__parallelism=1)
+
+pwd_context = _password_context()
+
+@st.cache_resource
+def get_password_slots():
+    return threading.BoundedSemaphore(PASSWORD_SLOTS)
+
 # Helper: Hash Password
 def hash_password(password):
-    return sha256_crypt.hash(password)
+    with get_password_slots():
+        return pwd_context.hash(password)
 
 # Helper: Verify Password
 def verify_password(stored, provided):
-    return sha256_crypt.verify(provided, stored)
+    """(matches, new hash or None); a new hash is returned when the stored one uses an old scheme or cost."""
+    try:
+        with get_password_slots():
+            return pwd_context.verify_and_update(provided, stored)
+    except (ValueError, MissingBackendError) as e:
+        print(f"[LOG] Password check failed: {e}")  # Unrecognized hash, or its scheme's backend isn't installed
+        return False, None
+
+def check_login(username, password) -> bool:
+    """True if the username exists and the password matches (login page and headless API)."""
+    c.execute("SELECT password FROM users WHERE username=?", (username,))
+    result = c.fetchone()
+    if not result:
+        return False
+    matches, new_hash = verify_password(result[0], password)
+    if matches and new_hash:
+        c.execute("UPDATE users SET password=? WHERE username=?", (new_hash, username))
+        conn.commit()
+        print(f"[LOG] Upgraded password hash for {username} to {pwd_context.default_scheme()}.")
+    return matches
+
+# Login Sessions - Signed, expiring tokens (cookie + auth_sessions table): a refresh or new tab resumes without rehashing
+AUTH_COOKIE = "homebot_auth"
+AUTH_TOKEN_TTL_DAYS = int(os.getenv("HOMEBOT_AUTH_TTL_DAYS", "7"))
+AUTH_SECRET_PATH = ".homebot_secret"  # Generated once, shared by workers on this host; or set HOMEBOT_AUTH_SECRET
+
+def _auth_secret() -> bytes:
+    """HMAC key for login tokens: HOMEBOT_AUTH_SECRET, else a random key created once next to chatapp.db."""
+    if os.getenv("HOMEBOT_AUTH_SECRET"):
+        return os.getenv("HOMEBOT_AUTH_SECRET").encode()
+    if not os.path.exists(AUTH_SECRET_PATH):
+        tmp = f"{AUTH_SECRET_PATH}.{os.getpid()}"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, AUTH_SECRET_PATH)  # Atomic: the first worker's key wins
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    with open(AUTH_SECRET_PATH) as f:
+        return f.read().strip().encode()
+
+AUTH_SECRET = _auth_secret()
+
+def _token_signature(payload: str) -> str:
+    return hmac.new(AUTH_SECRET, payload.encode(), hashlib.sha256).hexdigest()
+
+def _token_hash(token_id: str) -> str:
+    return hashlib.sha256(token_id.encode()).hexdigest()  # Only hashes are stored: a DB copy can't be replayed as cookies
+
+def issue_auth_token(user: str) -> str:
+    """New login token for user: '<id>.<expiry>.<hmac>'."""
+    expires = int(time.time()) + AUTH_TOKEN_TTL_DAYS * 86400
+    token_id = secrets.token_urlsafe(24)
+    c.execute("INSERT INTO auth_sessions (token_hash, user, created_at, expires_at) VALUES (?, ?, ?, ?)",
+              (_token_hash(token_id), user, time.time(), expires))
+    conn.commit()
+    payload = f"{token_id}.{expires}"
+    return f"{payload}.{_token_signature(payload)}"
+
+def resume_auth_token(token: str):
+    """User of a valid login token, or None. Forged or expired tokens are rejected before any DB read."""
+    parts = (token or "").split(".")
+    if len(parts) != 3 or not parts[1].isdigit() or int(parts[1]) < time.time():
+        return None
+    if not hmac.compare_digest(_token_signature(f"{parts[0]}.{parts[1]}"), parts[2]):
+        return None
+    c.execute("SELECT user FROM auth_sessions WHERE token_hash=? AND expires_at > ?", (_token_hash(parts[0]), time.time()))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def revoke_auth_token(token: str):
+    """Log a token out (other devices keep theirs)."""
+    c.execute("DELETE FROM auth_sessions WHERE token_hash=?", (_token_hash((token or "").split(".")[0]),))
+    conn.commit()
+
+def queue_cookie(name: str, value: str = "", max_age: int = 0):
+    """Set (or, with no value, clear) a cookie on the next run; st.rerun() would cut off an inline write."""
+    st.session_state.setdefault('pending_cookies', {})[name] = (value, max_age if value else 0)
+
+def write_pending_cookies():
+    """Send cookie changes queued by the previous run."""
+    pending = st.session_state.pop('pending_cookies', None)
+    if pending:
+        script = "".join(f"window.parent.document.cookie = '{name}={value}; path=/; max-age={max_age}; SameSite=Strict';"
+                         for name, (value, max_age) in pending.items())
+        components.html(f"<script>{script}</script>", height=0)
+
+def rotate_session_id():
+    """New session id at login/logout, so an id known before login (fixation) never maps to a logged-in session."""
+    old_sid = st.session_state.get('session_id')
+    if old_sid:
+        try:
+            get_session_store().delete(old_sid)
+        except ConnectionError as e:
+            print(f"[LOG] Session state delete failed: {e}")
+    sid = uuid.uuid4().hex
+    st.session_state['session_id'] = sid
+    st.session_state['session_digest'] = None  # persist_session saves under the new id
+    queue_cookie(SESSION_COOKIE, sid, SESSION_TTL_DAYS * 86400)
+
+def start_login(user: str):
+    """After a verified password: fresh session id, login token and cookies."""
+    rotate_session_id()
+    st.session_state['logged_in'] = True
+    st.session_state['user'] = user
+    st.session_state['auth_token'] = issue_auth_token(user)
+    queue_cookie(AUTH_COOKIE, st.session_state['auth_token'], AUTH_TOKEN_TTL_DAYS * 86400)
+
+def logout():
+    """Revoke this browser's login token and return to the login page."""
+    token = st.session_state.pop('auth_token', None) or st.context.cookies.get(AUTH_COOKIE)
+    if token:
+        revoke_auth_token(token)
+    queue_cookie(AUTH_COOKIE)
+    rotate_session_id()
+    st.session_state['logged_in'] = False
+    st.session_state['messages'] = []
+    st.session_state['current_convo_id'] = None
+    st.rerun()
 
 # Tool Cache Helper
 def get_tool_cache_key(func_name, args):
-    return f"tool_cache:{func_name}:{hash(json.dumps(args, sort_keys=True))}"
+    # sha1 of the sorted JSON args: a fixed-length key that is the same for equal args (the cache itself is worker-local)
+    return f"tool_cache:{func_name}:{hashlib.sha1(json.dumps(args, sort_keys=True).encode()).hexdigest()}"
 
 def get_cached_tool_result(func_name, args, ttl_minutes=5):
     if 'tool_cache' not in st.session_state:
@@ -204,12 +1255,17 @@ def get_cached_tool_result(func_name, args, ttl_minutes=5):
             return result
     return None
 
+TOOL_CACHE_MAX = 200  # Entries per session; oldest evicted first
+
 def set_cached_tool_result(func_name, args, result):
     if 'tool_cache' not in st.session_state:
         st.session_state['tool_cache'] = {}
     cache = st.session_state['tool_cache']
     key = get_tool_cache_key(func_name, args)
+    cache.pop(key, None)
     cache[key] = (datetime.now(), result)
+    while len(cache) > TOOL_CACHE_MAX:
+        del cache[next(iter(cache))]  # Dicts keep insertion order
 
 # Tool Functions (Sandboxed) - Optimized with Cache
 def fs_read_file(file_path: str) -> str:
@@ -301,19 +1357,69 @@ def fs_mkdir(dir_path: str) -> str:
     except Exception as e:
         return f"Error creating directory: {str(e)}"
 
-def get_current_time(sync: bool = False, format: str = 'iso') -> str:
-    """Fetch current time: host default, NTP if sync=true."""
-    try:
-        if sync:
+# Time Sync Service - Background NTP; synced time served from monotonic clock + measured offset
+NTP_SERVER = 'pool.ntp.org'
+NTP_SYNC_INTERVAL = 15 * 60  # Seconds between syncs once synced
+NTP_RETRY_INTERVAL = 60  # Seconds before retrying after a failed sync
+NTP_TIMEOUT = 2  # Seconds per NTP request (background thread only)
+
+class TimeSyncService:
+    """Process-wide NTP sync thread; now() never blocks on the network."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._anchor = None  # (monotonic at sync, true epoch seconds at sync)
+        self.offset = None  # Host clock offset vs NTP (seconds)
+        self.last_sync = None  # Monotonic time of last successful sync
+        self.last_error = None
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, daemon=True, name="ntp-sync").start()
+
+    def _sync_once(self):
+        response = ntplib.NTPClient().request(NTP_SERVER, version=3, timeout=NTP_TIMEOUT)
+        mono, wall = time.monotonic(), time.time()
+        with self._lock:
+            self.offset = response.offset
+            self._anchor = (mono, wall + response.offset)
+            self.last_sync = mono
+            self.last_error = None
+
+    def _run(self):
+        while True:
             try:
-                c = ntplib.NTPClient()
-                response = c.request('pool.ntp.org', version=3)
-                t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(response.tx_time))
-                source = "NTP"
+                self._sync_once()
+                delay = NTP_SYNC_INTERVAL
             except Exception as e:
                 print(f"[LOG] NTP Error: {e}")
-                t = time.strftime('%Y-%m-%d %H:%M:%S')
-                source = "host (NTP failed)"
+                self.last_error = str(e)
+                delay = NTP_RETRY_INTERVAL
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def request_sync(self):
+        """Ask the background thread to re-sync now (non-blocking)."""
+        self._wake.set()
+
+    def now(self):
+        """Return (epoch seconds, source) without touching the network."""
+        with self._lock:
+            anchor = self._anchor
+        if anchor:
+            return anchor[1] + (time.monotonic() - anchor[0]), "NTP"
+        return time.time(), "host (NTP failed)" if self.last_error else "host (NTP pending)"
+
+@st.cache_resource
+def get_time_sync_service():
+    return TimeSyncService()
+
+def get_current_time(sync: bool = False, format: str = 'iso') -> str:
+    """Fetch current time: host default, NTP-corrected if sync=true (served from background sync)."""
+    try:
+        if sync:
+            service = get_time_sync_service()
+            now, source = service.now()
+            if service.last_sync is not None and time.monotonic() - service.last_sync > NTP_SYNC_INTERVAL * 2:
+                service.request_sync()  # Stale anchor; refresh in background
+            t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
         else:
             t = time.strftime('%Y-%m-%d %H:%M:%S')
             source = "host"
@@ -355,146 +1461,800 @@ def code_execution(code: str) -> str:
     finally:
         sys.stdout = old_stdout
 
+def ensure_convo_id() -> int:
+    """Current chat's convo_id, creating its history row on the first memory write so memories link to it."""
+    convo_id = st.session_state.get('current_convo_id')
+    if convo_id is None:
+        c.execute("INSERT INTO history (user, title, messages) VALUES (?, ?, ?)", (st.session_state['user'], "New Chat", "[]"))
+        # Defer commit; the end-of-turn save updates this row
+        convo_id = st.session_state['current_convo_id'] = c.lastrowid
+    return convo_id
+
+def current_convo_id():
+    """Current chat's convo_id, or None if nothing has been saved for it yet (reads never create the row)."""
+    return st.session_state.get('current_convo_id')
+
+# Memory Cache - Process-wide LRU for memory_query key lookups, kept coherent via PRAGMA data_version + memory_changes
+MEMORY_CACHE_SIZE = 1024  # Cached (user, convo_id, mem_key) values across all sessions
+MEMORY_CHANGELOG_KEEP = 10000  # memory_changes rows kept by maintenance (older gaps force a full cache clear)
+MEMORY_CACHE_MISS = object()  # Sentinel, so falsy values ({} / 0 / "") are real hits
+
+class MemoryCache:
+    """Bounded LRU shared by all sessions. Its own connection's data_version changes whenever any other
+    connection or process commits; then only the keys logged in memory_changes since the last sync are dropped."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (user, convo_id, mem_key) -> value
+        self._db = open_db_connection()
+        self._data_version = None
+        self._seq = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM memory_changes").fetchone()[0]
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0, "skipped_puts": 0}
+
+    def _sync(self):
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+        self._data_version = version
+        oldest = self._db.execute("SELECT MIN(seq) FROM memory_changes").fetchone()[0]
+        if oldest is not None and oldest > self._seq + 1 and self._entries:
+            # Change log trimmed past our position: can't tell what changed
+            self.stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+        rows = self._db.execute("SELECT seq, user, convo_id, mem_key FROM memory_changes WHERE seq > ? ORDER BY seq",
+                                (self._seq,)).fetchall()
+        for seq, user, convo_id, mem_key in rows:
+            if self._entries.pop((user, convo_id, mem_key), MEMORY_CACHE_MISS) is not MEMORY_CACHE_MISS:
+                self.stats["invalidations"] += 1
+            self._seq = seq
+
+    def token(self):
+        """Change-log position; take it before a DB read whose rows will be put()."""
+        with self._lock:
+            self._sync()
+            return self._seq
+
+    def get(self, key):
+        """(value or MEMORY_CACHE_MISS, token); pass the token to put() after reading the DB on a miss."""
+        with self._lock:
+            self._sync()
+            value = self._entries.get(key, MEMORY_CACHE_MISS)
+            if value is MEMORY_CACHE_MISS:
+                self.stats["misses"] += 1
+            else:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+            return value, self._seq
+
+    def put(self, key, value, token):
+        """Cache a value read from the DB, unless any memory write committed since get() issued the token."""
+        with self._lock:
+            self._sync()
+            if self._seq != token:
+                self.stats["skipped_puts"] += 1
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > MEMORY_CACHE_SIZE:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, user, convo_id=None, mem_key=None):
+        """Write-through invalidation: one key, one conversation, or all of a user's entries."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user and convo_id in (None, k[1]) and mem_key in (None, k[2])]:
+                del self._entries[key]
+                self.stats["invalidations"] += 1
+
+@st.cache_resource
+def get_memory_cache():
+    return MemoryCache()
+
 def memory_insert(user: str, convo_id: int, mem_key: str, mem_value: dict) -> str:
     """Insert/update memory key-value (value as dict, stored as JSON). Syncs to DB."""
     try:
-        json_value = json.dumps(mem_value)
+        json_value = encode_payload(json.dumps(mem_value))
         c.execute("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value) VALUES (?, ?, ?, ?)",
                   (user, convo_id, mem_key, json_value))
-        # Defer commit to caller for batching
-        # Update cache
-        cache_key = f"{user}:{convo_id}:{mem_key}"
-        if 'memory_cache' not in st.session_state:
-            st.session_state['memory_cache'] = {}
-        st.session_state['memory_cache'][cache_key] = mem_value
+        # Defer commit to caller for batching; other sessions keep reading the committed value until then
+        get_memory_cache().invalidate(user, convo_id, mem_key)
         return "Memory inserted successfully."
     except Exception as e:
         return f"Error inserting memory: {str(e)}"
 
-def memory_query(user: str, convo_id: int, mem_key: str = None, limit: int = 10) -> str:
+def memory_query(user: str, convo_id: int, mem_key: str = None, limit: int = 10, scope: str = "convo") -> str:
     """Query memory: specific key or last N entries. Cache-first for speed."""
     try:
-        if 'memory_cache' not in st.session_state:
-            st.session_state['memory_cache'] = {}
+        if scope == "user":
+            # Across all of the user's conversations (newest first; not cached per convo)
+            if mem_key:
+                c.execute("SELECT mem_value FROM memory WHERE user=? AND mem_key=? ORDER BY timestamp DESC LIMIT 1", (user, mem_key))
+                result = c.fetchone()
+                return decode_payload(result[0]) if result else "Not found."
+            c.execute("SELECT convo_id, mem_key, mem_value FROM memory WHERE user=? ORDER BY timestamp DESC LIMIT ?", (user, limit))
+            return json.dumps([{"convo_id": row[0], "mem_key": row[1], "value": json.loads(decode_payload(row[2]))} for row in c.fetchall()])
+        cache = get_memory_cache()
+        # Uncommitted writes on this connection (mid tool batch) must be read back from the DB, not shared
+        use_cache = not conn.in_transaction
         if mem_key:
-            cache_key = f"{user}:{convo_id}:{mem_key}"
-            cached = st.session_state['memory_cache'].get(cache_key)
-            if cached:
-                return json.dumps(cached)  # Fast RAM hit
+            cache_key = (user, convo_id, mem_key)
+            if use_cache:
+                cached, token = cache.get(cache_key)
+                if cached is not MEMORY_CACHE_MISS:
+                    return json.dumps(cached)  # Fast RAM hit
             c.execute("SELECT mem_value FROM memory WHERE user=? AND convo_id=? AND mem_key=? ORDER BY timestamp DESC LIMIT 1",
                       (user, convo_id, mem_key))
             result = c.fetchone()
             if result:
-                value = json.loads(result[0])
-                st.session_state['memory_cache'][cache_key] = value  # Cache for next
+                value = json.loads(decode_payload(result[0]))
+                if use_cache:
+                    cache.put(cache_key, value, token)  # Cache for next
                 return json.dumps(value)
             return "Not found."
         else:
             # Recent entries (no specific key)
+            token = cache.token() if use_cache else None
             c.execute("SELECT mem_key, mem_value FROM memory WHERE user=? AND convo_id=? ORDER BY timestamp DESC LIMIT ?",
                       (user, convo_id, limit))
             results = c.fetchall()
-            output = {row[0]: json.loads(row[1]) for row in results}
+            output = {row[0]: json.loads(decode_payload(row[1])) for row in results}
             # Cache them
-            for k, v in output.items():
-                st.session_state['memory_cache'][f"{user}:{convo_id}:{k}"] = v
+            if use_cache:
+                for k, v in output.items():
+                    cache.put((user, convo_id, k), v, token)
             return json.dumps(output)
     except Exception as e:
         return f"Error querying memory: {str(e)}"
 
 # Advanced Memory Functions (Brain-inspired) - With vec fallback
+CONSOLIDATE_MODEL = "grok-3"  # Default summarizer for consolidation jobs (ROUTING_POLICY["consolidate"])
+MEMORY_JOB_WORKERS = 2  # Background consolidation threads
+# off: no memory-job or maintenance threads start, so one-shot scripts (migrate.py) are the only DB writer
+BACKGROUND_THREADS = os.getenv("HOMEBOT_BACKGROUND", "on") != "off"
+MEMORY_JOB_BATCH = 8  # Jobs folded into one summarize + one encode call
+MEMORY_JOB_LINGER = 0.5  # Seconds to let more jobs arrive before claiming a batch
+MEMORY_JOB_POLL = 2.0  # Seconds between idle polls (picks up jobs committed by other sessions)
+MEMORY_JOB_MAX_ATTEMPTS = 3
+MEMORY_JOB_BACKOFF = 10  # Seconds; doubled per failed attempt
+
+class MemoryJobQueue:
+    """SQLite-backed consolidation queue: summarize, embed and store off the user's turn."""
+    def __init__(self, workers=MEMORY_JOB_WORKERS):
+        self._wake = threading.Event()
+        self._client = None  # Created on first job (API key may be missing at startup)
+        if not BACKGROUND_THREADS:
+            return  # Jobs are still queued; the next app process runs them
+        db = open_db_connection()
+        # Jobs left running by a previous process go back to the queue
+        db.execute("UPDATE memory_jobs SET status='pending', updated_at=? WHERE status='running'", (time.time(),))
+        db.commit()
+        db.close()
+        for i in range(workers):
+            threading.Thread(target=self._run, daemon=True, name=f"memory-jobs-{i}").start()
+
+    def submit(self, cur, user, convo_id, mem_key, interaction_data, embed=True) -> int:
+        """Enqueue on the caller's cursor (committed with the turn's batch); returns job id."""
+        now = time.time()
+        cur.execute("INSERT INTO memory_jobs (user, convo_id, mem_key, payload, status, created_at, updated_at, next_run_at, embed) "
+                    "VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?)",
+                    (user, convo_id, mem_key, json.dumps(interaction_data), now, now, now, int(embed)))
+        self._wake.set()
+        return cur.lastrowid
+
+    def _claim(self, db):
+        """Atomically mark up to MEMORY_JOB_BATCH due jobs as running."""
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        rows = db.execute("SELECT job_id, user, convo_id, mem_key, payload, attempts, embed FROM memory_jobs "
+                          "WHERE status='pending' AND next_run_at <= ? ORDER BY job_id LIMIT ?",
+                          (now, MEMORY_JOB_BATCH)).fetchall()
+        if rows:
+            db.executemany("UPDATE memory_jobs SET status='running', attempts=attempts+1, updated_at=? WHERE job_id=?",
+                           [(now, row[0]) for row in rows])
+        db.commit()
+        return rows
+
+    def _summarize(self, payloads):
+        """One summarization request for the whole batch (JSON array reply)."""
+        if len(payloads) == 1:
+            messages = [{"role": "system", "content": "Summarize this in no more than 5 sentences:"},
+                        {"role": "user", "content": payloads[0]}]
+        else:
+            messages = [{"role": "system", "content": "Summarize each numbered item in no more than 5 sentences. "
+                                                      "Reply with only a JSON array of strings, one summary per item, in order."},
+                        {"role": "user", "content": "\n\n".join(f"Item {i + 1}: {p}" for i, p in enumerate(payloads))}]
+        if self._client is None:
+            self._client = OpenAI(api_key=API_KEY, base_url=XAI_BASE_URL)
+        start = time.perf_counter()
+        response = self._client.chat.completions.create(model=ROUTING_POLICY["consolidate"], messages=messages, stream=False)
+        get_route_stats().record("consolidate", ROUTING_POLICY["consolidate"], (time.perf_counter() - start) * 1000, None,
+                                 response.usage.prompt_tokens if response.usage else 0,
+                                 response.usage.completion_tokens if response.usage else 0)
+        text = response.choices[0].message.content.strip()
+        if len(payloads) == 1:
+            return [text]
+        text = text[text.find('['):text.rfind(']') + 1]
+        summaries = json.loads(text)
+        if not isinstance(summaries, list) or len(summaries) != len(payloads):
+            raise ValueError("summary count mismatch")
+        return [str(s).strip() for s in summaries]
+
+    def _process(self, db, rows):
+        payloads = [row[4] for row in rows]
+        try:
+            summaries = self._summarize(payloads)
+        except Exception:
+            if len(rows) == 1:
+                raise
+            # Batch reply unusable; fall back to one request per item
+            summaries = [self._summarize([p])[0] for p in payloads]
+        embeddings = [None] * len(rows)
+        to_embed = [i for i, row in enumerate(rows) if row[6]]
+        if to_embed:
+            with tracer.span("embed.encode", n=len(to_embed)):
+                vectors = get_embed_model().encode([payloads[i] for i in to_embed])  # One batched encode
+            for i, vector in zip(to_embed, vectors):
+                embeddings[i] = encode_embedding(vector)
+        now = utc_now()
+        for (job_id, user, convo_id, mem_key, payload, _, _), summary, embedding in zip(rows, summaries, embeddings):
+            # Store semantic summary as parent, episodic (full data) as child
+            cur = db.execute("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value, salience, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                             (user, convo_id, f"{mem_key}_semantic", encode_payload(json.dumps({"summary": summary})), 1.0, now))
+            parent_id = cur.lastrowid
+            db.execute("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value, embedding, parent_id, salience, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (user, convo_id, mem_key, encode_payload(payload), embedding, parent_id, 1.0, now))
+            db.execute("UPDATE memory_jobs SET status='done', error=NULL, updated_at=? WHERE job_id=?", (time.time(), job_id))
+        db.commit()
+
+    def _fail(self, db, rows, error):
+        db.rollback()
+        now = time.time()
+        for row in rows:
+            job_id, attempts = row[0], row[5] + 1
+            if attempts >= MEMORY_JOB_MAX_ATTEMPTS:
+                db.execute("UPDATE memory_jobs SET status='failed', error=?, updated_at=? WHERE job_id=?", (error, now, job_id))
+            else:
+                db.execute("UPDATE memory_jobs SET status='pending', error=?, updated_at=?, next_run_at=? WHERE job_id=?",
+                           (error, now, now + MEMORY_JOB_BACKOFF * 2 ** (attempts - 1), job_id))
+        db.commit()
+
+    def _run(self):
+        db = open_db_connection()
+        while True:
+            if self._wake.wait(MEMORY_JOB_POLL):
+                self._wake.clear()
+                time.sleep(MEMORY_JOB_LINGER)  # Let a burst of submissions batch up
+            try:
+                while True:
+                    rows = self._claim(db)
+                    if not rows:
+                        break
+                    try:
+                        self._process(db, rows)
+                        print(f"[LOG] Consolidated {len(rows)} memory job(s).")
+                    except Exception as e:
+                        print(f"[LOG] Memory job error: {e}")
+                        self._fail(db, rows, str(e))
+            except sqlite3.Error as e:
+                print(f"[LOG] Memory job DB error: {e}")
+                db.rollback()
+
+@st.cache_resource
+def get_memory_job_queue():
+    return MemoryJobQueue()
+
 def advanced_memory_consolidate(user: str, convo_id: int, mem_key: str, interaction_data: dict) -> str:
-    """Consolidate: Summarize (via Grok call), embed, store hierarchically."""
+    """Consolidate: queue summarize (via Grok), embed and hierarchical store; returns a job id at once."""
     try:
-        load_embed_model()  # Ensure loaded
-        # Summarize using Grok (simple API call; assume client is available)
-        client = OpenAI(api_key=API_KEY, base_url="https://api.x.ai/v1/")
-        summary_response = client.chat.completions.create(
-            model="grok-3",  # Or your default model
-            messages=[{"role": "system", "content": "Summarize this in no more than 5 sentences:"},
-                      {"role": "user", "content": json.dumps(interaction_data)}],
-            stream=False
-        )
-        summary = summary_response.choices[0].message.content.strip()
-        # Embed full data if vec available
-        embed_model = st.session_state.get('embed_model')
-        embedding = None
-        if embed_model and st.session_state.get('vec_loaded', False):
-            embedding = embed_model.encode(json.dumps(interaction_data)).astype(np.float32).tobytes()
-        # Store semantic summary as parent
-        semantic_value = {"summary": summary}
-        json_semantic = json.dumps(semantic_value)
-        salience = 1.0
-        c.execute("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value, salience, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                  (user, convo_id, f"{mem_key}_semantic", json_semantic, salience, datetime.now()))
-        parent_id = c.lastrowid
-        # Store episodic (full data) as child
-        json_episodic = json.dumps(interaction_data)
-        c.execute("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value, embedding, parent_id, salience, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                  (user, convo_id, mem_key, json_episodic, embedding, parent_id, salience, datetime.now()))
+        load_embed_model()  # Embed only if advanced memory is enabled for this session
+        embed = st.session_state.get('embed_model') is not None
+        job_id = get_memory_job_queue().submit(c, user, convo_id, mem_key, interaction_data, embed)
         # Defer commit
-        return "Memory consolidated successfully."
+        return f"Memory consolidation queued (job {job_id}). Check progress with memory_job_status."
     except Exception as e:
         return f"Error consolidating memory: {str(e)}"
 
-def advanced_memory_retrieve(user: str, convo_id: int, query: str, top_k: int = 5) -> str:
-    """Retrieve top-k relevant memories via embedding similarity."""
+def memory_job_status(user: str, job_id: int = None, limit: int = 10) -> str:
+    """Status of one consolidation job, or the user's most recent jobs."""
+    try:
+        columns = "job_id, mem_key, status, attempts, error, created_at, updated_at"
+        if job_id is not None:
+            c.execute(f"SELECT {columns} FROM memory_jobs WHERE user=? AND job_id=?", (user, job_id))
+        else:
+            c.execute(f"SELECT {columns} FROM memory_jobs WHERE user=? ORDER BY job_id DESC LIMIT ?", (user, limit))
+        rows = c.fetchall()
+        if not rows:
+            return "Not found."
+        jobs = [dict(zip(["job_id", "mem_key", "status", "attempts", "error", "created_at", "updated_at"], row)) for row in rows]
+        return json.dumps(jobs[0] if job_id is not None else jobs)
+    except Exception as e:
+        return f"Error querying memory jobs: {str(e)}"
+
+# Memory Retrieval - Vector + FTS5 (BM25) + recency, fused by reciprocal rank, per conversation or across a user's conversations
+RETRIEVE_CANDIDATES = 50  # Per signal, before fusion
+RETRIEVE_FILTER_POOL = 10  # Vector pool multiplier when filters apply (post-filtered before fusion)
+RRF_K = 60  # Reciprocal-rank fusion constant: score = sum(1 / (RRF_K + rank)) over signals
+RETRIEVE_LEVELS = ("any", "summary", "detail")  # summary: consolidated *_semantic parents; detail: their episodic children
+FTS_KEY_WEIGHT = 2.0  # bm25 weight of mem_key matches relative to value text
+FTS_MAX_PHRASE_MATCHES = 2000  # Query phrases matching more rows than this are treated as stopwords
+MEMORY_INDEX_USERS = 8  # Users whose embedding matrices stay in RAM (LRU)
+
+class MemoryVectorIndex:
+    """Normalized float32 embedding matrix per user, refreshed incrementally from the memory table."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # user -> {"rowids", "convo_ids", "matrix"}
+        self._versions = {}  # user -> DB change signature at last refresh
+
+    def invalidate(self, user=None):
+        with self._lock:
+            if user is None:
+                self._users.clear()
+                self._versions.clear()
+            else:
+                self._users.pop(user, None)
+                self._versions.pop(user, None)
+
+    @staticmethod
+    def _load(cur, user, after_rowid=0):
+        cur.execute("SELECT rowid, convo_id, embedding FROM memory WHERE user=? AND embedding IS NOT NULL AND rowid > ? ORDER BY rowid",
+                    (user, after_rowid))
+        rows = cur.fetchall()
+        if not rows:
+            return None
+        matrix = np.stack([decode_embedding(row[2]) for row in rows])
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        return {"rowids": np.array([row[0] for row in rows], dtype=np.int64),
+                "convo_ids": np.array([row[1] if row[1] is not None else -1 for row in rows], dtype=np.int64),
+                "matrix": matrix}
+
+    def _refresh(self, cur, user):
+        # No memory write anywhere since the last refresh: reuse as is. memory_changes.seq (AUTOINCREMENT, bumped by
+        # triggers on every insert/update/delete) is database-wide; per-connection counters restart on each new connection.
+        # user_version is the vacuum generation (see vacuum_memory_db): a VACUUM in any process renumbers rowids.
+        version = cur.execute("SELECT user_version, (SELECT MAX(seq) FROM memory_changes) FROM pragma_user_version").fetchone()
+        if user in self._users and self._versions.get(user) == version:
+            self._users.move_to_end(user)
+            return self._users[user]
+        if self._versions.get(user, version)[0] != version[0]:
+            self._users.pop(user, None)  # Cached rowids predate a VACUUM; reload in full
+        # Count/max-rowid probe is covered by idx_memory_user_embedded; appends load only new rows.
+        # INSERT OR REPLACE and deletes leave the count out of step, which forces a rebuild.
+        count, max_rowid = cur.execute("SELECT COUNT(*), MAX(rowid) FROM memory WHERE user=? AND embedding IS NOT NULL",
+                                       (user,)).fetchone()
+        entry = self._users.get(user)
+        if not count:
+            self._users.pop(user, None)
+            self._versions.pop(user, None)
+            return None
+        if entry is not None and max_rowid > entry["rowids"][-1]:
+            added = self._load(cur, user, int(entry["rowids"][-1]))
+            if added is not None:
+                entry = {key: np.concatenate([entry[key], added[key]]) for key in entry}
+        if entry is None or len(entry["rowids"]) != count or max_rowid < entry["rowids"][-1]:
+            entry = self._load(cur, user)
+        self._users[user] = entry
+        self._versions[user] = version
+        self._users.move_to_end(user)
+        while len(self._users) > MEMORY_INDEX_USERS:
+            self._versions.pop(self._users.popitem(last=False)[0], None)
+        return entry
+
+    def search(self, cur, user, query_vec, k, convo_id=None, allowed=None):
+        """Top-k (rowid, cosine similarity), best first; optionally within one conversation / allowed rowids."""
+        with self._lock:
+            entry = self._refresh(cur, user)
+        if entry is None or entry["matrix"].shape[1] != query_vec.shape[0]:
+            return []
+        matrix, rowids = entry["matrix"], entry["rowids"]
+        mask = None
+        if convo_id is not None:
+            mask = entry["convo_ids"] == convo_id
+        if allowed is not None:
+            allowed_mask = np.isin(rowids, allowed)
+            mask = allowed_mask if mask is None else mask & allowed_mask
+        if mask is not None:
+            matrix, rowids = matrix[mask], rowids[mask]
+        sims = matrix @ query_vec
+        top = np.argpartition(-sims, k)[:k] if len(sims) > k else np.arange(len(sims))
+        top = top[np.argsort(-sims[top])]
+        return [(int(rowids[i]), float(sims[i])) for i in top]
+
+@st.cache_resource
+def get_memory_index():
+    return MemoryVectorIndex()
+
+def fts_match_query(cur, text: str) -> str:
+    """FTS5 MATCH for free text: each whitespace chunk as a quoted phrase (keeps identifiers and
+    file names together), OR-ed; no operator injection. Near-stopword phrases are dropped, since
+    ranking every row they match dominates search time while their BM25 weight is negligible."""
+    phrases = []
+    for chunk in text.split()[:16]:
+        terms = re.findall(r"\w+", chunk)
+        if not terms:
+            continue
+        phrase = '"' + " ".join(terms) + '"'
+        cur.execute("SELECT COUNT(*) FROM (SELECT 1 FROM memory_fts WHERE memory_fts MATCH ? LIMIT ?)",
+                    (phrase, FTS_MAX_PHRASE_MATCHES + 1))
+        if cur.fetchone()[0] <= FTS_MAX_PHRASE_MATCHES:
+            phrases.append(phrase)
+    return " OR ".join(phrases)
+
+def memory_filter_sql(key_prefix: str = None, since: str = None, until: str = None, level: str = "any"):
+    """SQL clauses (AND-joined, for the memory table) and params for retrieval filters."""
+    clauses, params = [], []
+    if key_prefix:
+        clauses.append("mem_key LIKE ? ESCAPE '\\'")
+        params.append(re.sub(r"([\\%_])", r"\\\1", key_prefix) + "%")
+    # Stored timestamps are 'YYYY-MM-DD HH:MM:SS[.ffffff]' text, so normalized bounds compare as strings
+    if since:
+        clauses.append("timestamp >= ?")
+        params.append(datetime.fromisoformat(since).isoformat(sep=" "))
+    if until:
+        clauses.append("timestamp <= ?")
+        params.append(datetime.fromisoformat(until).isoformat(sep=" "))
+    if level == "summary":
+        clauses.append("mem_key LIKE '%\\_semantic' ESCAPE '\\'")
+    elif level == "detail":
+        clauses.append("parent_id IS NOT NULL")
+    elif level not in RETRIEVE_LEVELS:
+        raise ValueError(f"level must be one of {', '.join(RETRIEVE_LEVELS)}")
+    return " AND ".join(clauses), params
+
+def keyword_search(cur, user, query, k, convo_id=None, filter_sql="", filter_params=()):
+    """Top-k (rowid, bm25) keyword matches, best (lowest bm25) first."""
+    if not fts_loaded:
+        return []
+    match = fts_match_query(cur, query)
+    if not match:
+        return []
+    convo_sql = "AND memory.convo_id = ?" if convo_id is not None else ""
+    extra_sql = f"AND {filter_sql}" if filter_sql else ""
+    cur.execute(f"""
+        SELECT memory.rowid, bm25(memory_fts, {FTS_KEY_WEIGHT}, 1.0) AS score
+        FROM memory_fts JOIN memory ON memory.rowid = memory_fts.rowid
+        WHERE memory_fts MATCH ? AND memory.user = ? {convo_sql} {extra_sql}
+        ORDER BY score LIMIT ?
+    """, (match, user, *([convo_id] if convo_id is not None else []), *filter_params, k))
+    return cur.fetchall()
+
+def hybrid_memory_search(cur, user, query, top_k=5, convo_id=None, query_vec=None,
+                         key_prefix=None, since=None, until=None, level="any"):
+    """Fuse vector, keyword and recency rankings (reciprocal rank), scaled by salience."""
+    filter_sql, filter_params = memory_filter_sql(key_prefix, since, until, level)
+    scope_sql = "user = ?" + (" AND convo_id = ?" if convo_id is not None else "")
+    scope_params = [user] + ([convo_id] if convo_id is not None else [])
+    where_sql = scope_sql + (f" AND {filter_sql}" if filter_sql else "")
+    ranks = {}  # rowid -> {signal: 1-based rank}
+    if query_vec is not None:
+        index = get_memory_index()
+        if not filter_sql:
+            hits = index.search(cur, user, query_vec, RETRIEVE_CANDIDATES, convo_id)
+        else:
+            # Filter a wide unfiltered pool first: the survivors are exactly the best filtered hits.
+            # Only when too few survive, pre-select matching rowids (a scan of the user's rows).
+            pool = index.search(cur, user, query_vec, RETRIEVE_CANDIDATES * RETRIEVE_FILTER_POOL, convo_id)
+            cur.execute(f"SELECT rowid FROM memory WHERE rowid IN ({','.join('?' * len(pool))}) AND {filter_sql}",
+                        (*[rowid for rowid, _ in pool], *filter_params))
+            passing = {row[0] for row in cur.fetchall()}
+            hits = [hit for hit in pool if hit[0] in passing][:RETRIEVE_CANDIDATES]
+            if len(hits) < top_k and len(pool) == RETRIEVE_CANDIDATES * RETRIEVE_FILTER_POOL:
+                cur.execute(f"SELECT rowid FROM memory WHERE {where_sql}", (*scope_params, *filter_params))
+                allowed = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+                hits = index.search(cur, user, query_vec, RETRIEVE_CANDIDATES, convo_id, allowed) if len(allowed) else []
+        for rank, (rowid, _) in enumerate(hits, 1):
+            ranks.setdefault(rowid, {})["vector"] = rank
+    for rank, (rowid, _) in enumerate(keyword_search(cur, user, query, RETRIEVE_CANDIDATES, convo_id, filter_sql, filter_params), 1):
+        ranks.setdefault(rowid, {})["keyword"] = rank
+    if not ranks:
+        # No semantic or keyword signal: most recent memories
+        order = "timestamp DESC" if convo_id is not None else "rowid DESC"
+        cur.execute(f"SELECT rowid FROM memory WHERE {where_sql} ORDER BY {order} LIMIT ?", (*scope_params, *filter_params, top_k))
+        ranks = {row[0]: {} for row in cur.fetchall()}
+        if not ranks:
+            return []
+    placeholders = ",".join("?" * len(ranks))
+    cur.execute(f"""
+        SELECT rowid, convo_id, mem_key, mem_value, parent_id, salience
+        FROM memory WHERE rowid IN ({placeholders})
+        ORDER BY julianday(timestamp) DESC
+    """, tuple(ranks))
+    ranked = []
+    for recency_rank, (rowid, mem_convo, mem_key, mem_value, parent_id, salience) in enumerate(cur.fetchall(), 1):
+        signals = ranks[rowid]
+        signals["recency"] = recency_rank
+        rrf = sum(1.0 / (RRF_K + rank) for rank in signals.values())
+        ranked.append({"rowid": rowid, "convo_id": mem_convo, "mem_key": mem_key, "mem_value": mem_value,
+                       "parent_id": parent_id, "score": rrf * (salience or 0.0),
+                       "matched": sorted(name for name in signals if name != "recency")})
+    ranked.sort(key=lambda r: r["score"], reverse=True)
+    return ranked[:top_k]
+
+def advanced_memory_retrieve(user: str, convo_id: int, query: str, top_k: int = 5, scope: str = "convo",
+                             key_prefix: str = None, since: str = None, until: str = None, level: str = "any") -> str:
+    """Retrieve top-k relevant memories (vector + keyword + recency fusion) from this conversation or all of the user's."""
     try:
+        if scope != "user" and convo_id is None:
+            return json.dumps([])  # Unsaved chat: nothing stored for it yet
         load_embed_model()
         embed_model = st.session_state.get('embed_model')
-        if not embed_model or not st.session_state.get('vec_loaded', False):
-            # Fallback: Retrieve by timestamp
-            c.execute("SELECT mem_key, mem_value, salience FROM memory WHERE user=? AND convo_id=? ORDER BY timestamp DESC LIMIT ?",
-                      (user, convo_id, top_k))
-            results = c.fetchall()
-            retrieved = []
-            for row in results:
-                mem_key, mem_value_json, salience = row
-                value = json.loads(mem_value_json)
-                retrieved.append({"mem_key": mem_key, "value": value, "relevance": float(salience)})
-            return json.dumps(retrieved)
-        query_embed = embed_model.encode(query).astype(np.float32)
-        query_embed_bytes = query_embed.tobytes()
-        # Query with vec
-        c.execute("""
-            SELECT mem_key, mem_value, parent_id, salience,
-                   vec_distance_cosine(embedding, ?) as distance
-            FROM memory
-            WHERE user = ? AND convo_id = ? AND embedding IS NOT NULL
-            ORDER BY (1 - vec_distance_cosine(embedding, ?)) * salience DESC
-            LIMIT ?
-        """, (query_embed_bytes, user, convo_id, query_embed_bytes, top_k))
-        results = c.fetchall()
+        query_vec = None
+        if embed_model:
+            with tracer.span("embed.encode", n=1):
+                query_vec = embed_model.encode(query).astype(np.float32)
+            query_vec /= np.linalg.norm(query_vec) or 1.0
+        results = hybrid_memory_search(c, user, query, top_k, None if scope == "user" else convo_id, query_vec,
+                                       key_prefix, since, until, level)
         retrieved = []
-        for row in results:
-            mem_key, mem_value_json, parent_id, salience, distance = row
-            value = json.loads(mem_value_json)
-            sim = 1 - distance
-            # Boost salience
-            if parent_id:
-                c.execute("UPDATE memory SET salience = salience + 0.1 WHERE rowid = ?", (parent_id,))
-            c.execute("UPDATE memory SET salience = salience + 0.1 WHERE user = ? AND convo_id = ? AND mem_key = ?",
-                      (user, convo_id, mem_key))
-            retrieved.append({"mem_key": mem_key, "value": value, "relevance": float(sim)})
+        now = utc_now()
+        for r in results:
+            # Boost salience (access also restarts time-based decay)
+            boost_ids = [r["rowid"]] + ([r["parent_id"]] if r["parent_id"] else [])
+            c.executemany("UPDATE memory SET salience = salience + 0.1, last_accessed = ? WHERE rowid = ?",
+                          [(now, rowid) for rowid in boost_ids])
+            item = {"mem_key": r["mem_key"], "value": json.loads(decode_payload(r["mem_value"])), "relevance": round(r["score"], 5),
+                    "matched": r["matched"]}
+            if scope == "user":
+                item["convo_id"] = r["convo_id"]
+            retrieved.append(item)
         # Defer commit
         return json.dumps(retrieved)
     except Exception as e:
         return f"Error retrieving memory: {str(e)}"
 
+# Memory Prefetch - Speculative user-wide retrieval for the incoming message, run while the request is built,
+# injected ahead of the model's first call (saves the usual advanced_memory_retrieve round-trip)
+MEMORY_PREFETCH_TOP_K = 4
+MEMORY_PREFETCH_TOKENS = 400  # Budget for injected memories (~4 chars per token)
+MEMORY_PREFETCH_VALUE_CHARS = 400  # Per memory, before the budget applies
+MEMORY_PREFETCH_TIMEOUT = 0.5  # Seconds to wait once the request is ready; later results are dropped
+RETRIEVAL_TOOLS = ("advanced_memory_retrieve", "memory_query")
+
+class MemoryPrefetcher:
+    """Process-wide; own pool and per-thread connections, read-only (no salience boost for speculative reads)."""
+    def __init__(self):
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-prefetch")
+        self._db = ThreadLocalProxy(open_db_connection)
+        self.stats = {"turns": 0, "injected": 0, "empty": 0, "late": 0, "model_asked": 0, "covered": 0}
+
+    def submit(self, user, message):
+        self.stats["turns"] += 1
+        return self._pool.submit(self._retrieve, user, message)
+
+    def _retrieve(self, user, message):
+        with tracer.span("memory.prefetch"):
+            with tracer.span("embed.encode", n=1):
+                query_vec = get_embed_model().encode(message).astype(np.float32)
+            query_vec /= np.linalg.norm(query_vec) or 1.0
+            return hybrid_memory_search(self._db.cursor(), user, message, MEMORY_PREFETCH_TOP_K, None, query_vec)
+
+    def context_message(self, future):
+        """(system message with the memories that fit the budget, their keys); (None, []) if late or empty."""
+        try:
+            results = future.result(timeout=MEMORY_PREFETCH_TIMEOUT)
+        except FutureTimeout:
+            future.cancel()
+            self.stats["late"] += 1
+            return None, []
+        except Exception as e:
+            print(f"[LOG] Memory prefetch failed: {e}")
+            return None, []
+        lines, keys, budget = [], [], MEMORY_PREFETCH_TOKENS * 4
+        for r in results:
+            line = f"- {r['mem_key']}: {memory_text(r['mem_value'])[:MEMORY_PREFETCH_VALUE_CHARS]}"
+            if len(line) > budget:
+                break
+            budget -= len(line)
+            lines.append(line)
+            keys.append(r["mem_key"])
+        if not lines:
+            self.stats["empty"] += 1
+            return None, []
+        self.stats["injected"] += 1
+        content = ("Possibly relevant memories (retrieved automatically for this message; "
+                   "only call a memory tool if you need something not listed):\n" + "\n".join(lines))
+        return {"role": "system", "content": content}, keys
+
+    def record_model_retrieval(self, keys, result):
+        """The model called a retrieval tool on a prefetched turn; covered = it got back something already injected."""
+        self.stats["model_asked"] += 1
+        if any(key in result for key in keys):
+            self.stats["covered"] += 1
+
+@st.cache_resource
+def get_memory_prefetcher():
+    return MemoryPrefetcher()
+
+# Memory Maintenance - Time-based salience decay, bounded pruning, idle VACUUM/optimize
+SALIENCE_HALF_LIFE_DAYS = 30.0  # Salience halves per 30 days without access
+PRUNE_SALIENCE_THRESHOLD = 0.1
+MAINT_BATCH = 500  # Rows per decay/prune statement (keeps write locks short)
+MAINT_MAX_BATCHES = 200  # Per run, per phase
+MAINT_INTERVAL = 30 * 60  # Seconds between maintenance runs
+MAINT_IDLE_SECONDS = 120  # Only run after this long without a chat turn
+MAINT_CHECK_INTERVAL = 60  # Seconds between idle checks
+MAINT_VACUUM_PAGES = 2000  # Pages freed per incremental_vacuum
+JOB_RETENTION_DAYS = 7  # Finished consolidation jobs kept this long
+TOOL_OUTPUT_RETENTION_DAYS = 2  # Stored full tool outputs (tool_output_page handles) kept this long
+
+# Decay from the later of the last decay pass and the last access, so the result depends on
+# elapsed time only (not on how often maintenance runs)
+DECAY_SQL = """UPDATE memory SET
+    salience = salience * hb_pow(0.5, MAX(0, julianday(?) - MAX(
+        julianday(COALESCE(decayed_at, timestamp)), julianday(COALESCE(last_accessed, timestamp)))) / ?),
+    decayed_at = ?
+"""
+
+def utc_now() -> datetime:
+    """Naive UTC datetime, comparable with memory.timestamp (CURRENT_TIMESTAMP is UTC)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def decay_and_prune(cur, where: str = "", params: tuple = (), max_batches: int = MAINT_MAX_BATCHES, start_rowid: int = 0) -> dict:
+    """Apply time-based decay then delete low-salience rows, in rowid batches. No commit.
+    Decay starts after start_rowid; stats["next_rowid"] is where to resume (None once the pass reached the end)."""
+    now = utc_now()
+    stats = {"decayed": 0, "pruned": 0, "next_rowid": None}
+    filter_sql = f"AND {where}" if where else ""
+    last_rowid = start_rowid
+    for _ in range(max_batches):
+        cur.execute(f"SELECT rowid FROM memory WHERE rowid > ? {filter_sql} ORDER BY rowid LIMIT ?",
+                    (last_rowid, *params, MAINT_BATCH))
+        rowids = [row[0] for row in cur.fetchall()]
+        if not rowids:
+            break
+        cur.execute(DECAY_SQL + f"WHERE rowid BETWEEN ? AND ? {filter_sql}",
+                    (now, SALIENCE_HALF_LIFE_DAYS, now, rowids[0], rowids[-1], *params))
+        stats["decayed"] += cur.rowcount
+        last_rowid = rowids[-1]
+    else:
+        stats["next_rowid"] = last_rowid  # Batch budget used up: continue from here next run
+    for _ in range(max_batches):
+        cur.execute(f"DELETE FROM memory WHERE rowid IN (SELECT rowid FROM memory WHERE salience < ? {filter_sql} LIMIT ?)",
+                    (PRUNE_SALIENCE_THRESHOLD, *params, MAINT_BATCH))
+        stats["pruned"] += cur.rowcount
+        if cur.rowcount < MAINT_BATCH:
+            break
+    return stats
+
 def advanced_memory_prune(user: str, convo_id: int) -> str:
-    """Prune low-salience memories (decay over time)."""
+    """Prune low-salience memories (time-based decay)."""
     try:
-        decay_factor = 0.99
-        one_week_ago = datetime.now() - timedelta(days=7)
-        c.execute("UPDATE memory SET salience = salience * ? WHERE user=? AND convo_id=? AND timestamp < ?",
-                  (decay_factor, user, convo_id, one_week_ago))
-        c.execute("DELETE FROM memory WHERE user=? AND convo_id=? AND salience < 0.1",
-                  (user, convo_id))
+        stats = decay_and_prune(c, "user=? AND convo_id=?", (user, convo_id))
+        if stats["pruned"]:
+            get_memory_cache().invalidate(user, convo_id)
         # Defer commit
-        return "Memory pruned successfully."
+        return f"Memory pruned successfully ({stats['pruned']} removed)."
     except Exception as e:
         return f"Error pruning memory: {str(e)}"
 
+def vacuum_generation(db) -> int:
+    """Count of vacuum_memory_db runs on this database, from any process."""
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def vacuum_memory_db(db):
+    """Full VACUUM that keeps memory links intact. memory has no INTEGER PRIMARY KEY, so VACUUM may renumber its
+    rowids: parent_id links are re-pointed via the (user, convo_id, mem_key) key, the keyword index is rebuilt,
+    and PRAGMA user_version (the vacuum generation) is bumped so every process drops its rowid-keyed state."""
+    db.commit()
+    db.execute("DROP TABLE IF EXISTS temp.vacuum_links")
+    db.execute("""CREATE TEMP TABLE vacuum_links AS
+        SELECT child.user, child.convo_id, child.mem_key, parent.user AS p_user, parent.convo_id AS p_convo, parent.mem_key AS p_key
+        FROM memory child JOIN memory parent ON parent.rowid = child.parent_id""")
+    db.commit()
+    try:
+        db.execute("VACUUM")
+        db.execute("""UPDATE memory SET parent_id = (
+            SELECT parent.rowid FROM vacuum_links link JOIN memory parent
+                ON parent.user IS link.p_user AND parent.convo_id IS link.p_convo AND parent.mem_key IS link.p_key
+            WHERE link.user IS memory.user AND link.convo_id IS memory.convo_id AND link.mem_key IS memory.mem_key)
+            WHERE parent_id IS NOT NULL""")
+        if fts_loaded:
+            db.execute("INSERT INTO memory_fts (memory_fts) VALUES ('rebuild')")
+        db.execute(f"PRAGMA user_version={vacuum_generation(db) + 1}")
+        db.commit()
+    finally:
+        db.execute("DROP TABLE IF EXISTS temp.vacuum_links")
+        get_memory_index().invalidate()
+
+class MaintenanceScheduler:
+    """Background maintenance across all users; runs only while the app is idle."""
+    def __init__(self):
+        self.last_activity = time.monotonic()
+        self.last_run = None
+        self.decay_cursor = 0  # Rowid the next decay pass resumes after (large tables take several runs)
+        self.vacuum_generation = None  # The cursor is only valid within one vacuum generation
+        self.metrics = {"runs": 0, "rows_decayed": 0, "rows_pruned": 0, "embeddings_migrated": 0, "payloads_migrated": 0,
+                        "jobs_purged": 0, "cache_rows_purged": 0, "sessions_purged": 0, "bytes_reclaimed": 0, "last_duration": 0.0, "last_error": None}
+        threading.Thread(target=self._run, daemon=True, name="memory-maintenance").start()
+
+    def touch(self):
+        """Record chat activity (maintenance waits for an idle period)."""
+        self.last_activity = time.monotonic()
+
+    def _db_bytes(self, db):
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        return db.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+    def run_once(self) -> dict:
+        start = time.monotonic()
+        db = open_db_connection()
+        try:
+            size_before = self._db_bytes(db)
+            generation = vacuum_generation(db)
+            if generation != self.vacuum_generation:
+                self.decay_cursor = 0  # A VACUUM (here or in migrate.py) renumbered rowids
+                self.vacuum_generation = generation
+            stats = decay_and_prune(db.cursor(), start_rowid=self.decay_cursor)
+            db.commit()
+            self.decay_cursor = stats["next_rowid"] or 0
+            migrated = migrate_embeddings(db, batch=MAINT_BATCH, max_batches=MAINT_MAX_BATCHES)["converted"]
+            payloads = migrate_payloads(db, batch=MAINT_BATCH, max_batches=MAINT_MAX_BATCHES)["converted"]
+            if migrated:
+                get_memory_index().invalidate()  # Re-encoded vectors don't touch memory_changes
+            cur = db.execute("DELETE FROM memory_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                             (time.time() - JOB_RETENTION_DAYS * 86400,))
+            jobs_purged = cur.rowcount
+            cur = db.execute("DELETE FROM search_cache WHERE expires_at < ?", (time.time(),))
+            cache_purged = cur.rowcount
+            cur = db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+            cache_purged += cur.rowcount
+            cur = db.execute("DELETE FROM tool_outputs WHERE created_at < ?", (time.time() - TOOL_OUTPUT_RETENTION_DAYS * 86400,))
+            cache_purged += cur.rowcount
+            sessions_purged = get_session_store().purge(SESSION_TTL_DAYS * 86400)
+            sessions_purged += db.execute("DELETE FROM auth_sessions WHERE expires_at < ?", (time.time(),)).rowcount
+            db.execute("DELETE FROM memory_changes WHERE seq < (SELECT MAX(seq) FROM memory_changes) - ?", (MEMORY_CHANGELOG_KEEP,))
+            db.commit()
+            try:
+                if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    # One-time switch to incremental auto-vacuum (needs a full VACUUM to take effect)
+                    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    vacuum_memory_db(db)
+                    self.decay_cursor, self.vacuum_generation = 0, vacuum_generation(db)
+                db.execute(f"PRAGMA incremental_vacuum({MAINT_VACUUM_PAGES})").fetchall()
+                db.execute("PRAGMA optimize")
+            except sqlite3.OperationalError as e:
+                print(f"[LOG] Maintenance vacuum skipped: {e}")  # DB busy; next run retries
+            reclaimed = max(size_before - self._db_bytes(db), 0)
+            self.metrics.update({
+                "runs": self.metrics["runs"] + 1,
+                "rows_decayed": self.metrics["rows_decayed"] + stats["decayed"],
+                "rows_pruned": self.metrics["rows_pruned"] + stats["pruned"],
+                "embeddings_migrated": self.metrics["embeddings_migrated"] + migrated,
+                "payloads_migrated": self.metrics["payloads_migrated"] + payloads,
+                "jobs_purged": self.metrics["jobs_purged"] + jobs_purged,
+                "cache_rows_purged": self.metrics["cache_rows_purged"] + cache_purged,
+                "sessions_purged": self.metrics["sessions_purged"] + sessions_purged,
+                "bytes_reclaimed": self.metrics["bytes_reclaimed"] + reclaimed,
+                "last_duration": round(time.monotonic() - start, 3),
+                "last_error": None,
+            })
+            print(f"[LOG] Maintenance: decayed {stats['decayed']}, pruned {stats['pruned']}, reclaimed {reclaimed} bytes.")
+            return {**stats, "embeddings_migrated": migrated, "payloads_migrated": payloads, "jobs_purged": jobs_purged,
+                    "cache_rows_purged": cache_purged, "sessions_purged": sessions_purged, "bytes_reclaimed": reclaimed}
+        finally:
+            db.close()
+
+    def _run(self):
+        while True:
+            time.sleep(MAINT_CHECK_INTERVAL)
+            now = time.monotonic()
+            if now - self.last_activity < MAINT_IDLE_SECONDS:
+                continue
+            if self.last_run is not None and now - self.last_run < MAINT_INTERVAL:
+                continue
+            self.last_run = now
+            try:
+                self.run_once()
+            except Exception as e:
+                self.metrics["last_error"] = str(e)
+                print(f"[LOG] Maintenance error: {e}")
+
+@st.cache_resource
+def get_maintenance_scheduler():
+    return MaintenanceScheduler()
+
+if BACKGROUND_THREADS:
+    get_maintenance_scheduler()  # Start background maintenance with the app
+
 # Git Ops Tool - With Cache
 def git_ops(operation: str, repo_path: str = "", **kwargs) -> str:
     """Perform basic Git operations in sandboxed repo."""
@@ -566,6 +2326,256 @@ def db_query(db_path: str, query: str, params: list = []) -> str:
         if db_conn:
             db_conn.close()
 
+# DB Bulk Tool - Streaming import/export (executemany in large transactions)
+BULK_BATCH_SIZE = 50000  # Rows per executemany + commit
+BULK_SAMPLE_ROWS = 1000  # Rows sampled for column type inference
+BULK_FORMATS = {'.csv': 'csv', '.tsv': 'tsv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'json', '.parquet': 'parquet'}
+BULK_BLOB_PREFIX = "base64:"  # BLOB cells in exported text files; decoded back to bytes on import
+
+def _quote_ident(name) -> str:
+    """Quote an SQL identifier (table/column name)."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _bulk_infer_type(values) -> str:
+    """Infer SQLite column type (INTEGER/REAL/TEXT/BLOB) from sampled values."""
+    col_type = None
+    for value in values:
+        if value is None or value == '':
+            continue
+        if isinstance(value, bytes) or (isinstance(value, str) and value.startswith(BULK_BLOB_PREFIX)):
+            value_type = 'BLOB'
+        elif isinstance(value, bool) or isinstance(value, int):
+            value_type = 'INTEGER'
+        elif isinstance(value, float):
+            value_type = 'REAL'
+        elif isinstance(value, str):
+            try:
+                int(value)
+                value_type = 'INTEGER'
+            except ValueError:
+                try:
+                    float(value)
+                    value_type = 'REAL'
+                except ValueError:
+                    return 'TEXT'
+        else:
+            return 'TEXT'
+        if col_type is not None and col_type != value_type and 'BLOB' in (col_type, value_type):
+            return 'TEXT'  # Blobs mixed with numbers: keep everything as written
+        if col_type is None or (col_type == 'INTEGER' and value_type == 'REAL'):
+            col_type = value_type
+    return col_type or 'TEXT'
+
+def _bulk_converter(col_type):
+    """Build a per-column value converter for the inferred type."""
+    def convert(value):
+        if value is None or value == '':
+            return None
+        if col_type == 'BLOB' and isinstance(value, str) and value.startswith(BULK_BLOB_PREFIX):
+            return base64.b64decode(value[len(BULK_BLOB_PREFIX):])
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, str) and col_type != 'TEXT':
+            try:
+                return int(value) if col_type == 'INTEGER' else float(value)
+            except ValueError:
+                return value  # SQLite keeps mixed values as-is
+        return value
+    return convert
+
+def _bulk_read_rows(path: str, fmt: str):
+    """Stream (columns, row iterator) from a CSV/TSV/JSONL/JSON/Parquet file."""
+    if fmt in ('csv', 'tsv'):
+        f = open(path, 'r', newline='')
+        reader = csv.reader(f, delimiter='\t' if fmt == 'tsv' else ',')
+        columns = next(reader, [])
+        def rows():
+            with f:
+                yield from reader
+        return columns, rows()
+    if fmt == 'jsonl':
+        f = open(path, 'r')
+        records = (json.loads(line) for line in f if line.strip())
+        sample = list(itertools.islice(records, BULK_SAMPLE_ROWS))
+        columns = list(dict.fromkeys(k for rec in sample for k in rec))
+        def rows():
+            with f:
+                for rec in itertools.chain(sample, records):
+                    yield tuple(rec.get(col) for col in columns)
+        return columns, rows()
+    if fmt == 'json':
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if isinstance(data, dict):  # Columnar: {"col": [values...]}
+            columns = list(data)
+            return columns, zip(*(data[col] for col in columns))
+        columns = list(dict.fromkeys(k for rec in data[:BULK_SAMPLE_ROWS] for k in rec))
+        return columns, (tuple(rec.get(col) for col in columns) for rec in data)
+    if fmt == 'parquet':
+        if pq is None:
+            raise RuntimeError("pyarrow not installed—Parquet import unavailable.")
+        pfile = pq.ParquetFile(path)
+        columns = pfile.schema_arrow.names
+        def rows():
+            for batch in pfile.iter_batches(batch_size=BULK_BATCH_SIZE):
+                yield from zip(*(col.to_pylist() for col in batch.columns))
+        return columns, rows()
+    raise ValueError(f"Unsupported format: {fmt}")
+
+def db_bulk_import(db_path: str, file_path: str, table: str, format: str = "", mode: str = "append", progress=None) -> str:
+    """Bulk-load a sandbox data file into a SQLite table with type inference."""
+    safe_db = os.path.abspath(os.path.normpath(os.path.join(SANDBOX_DIR, db_path)))
+    safe_file = os.path.abspath(os.path.normpath(os.path.join(SANDBOX_DIR, file_path)))
+    if not safe_db.startswith(os.path.abspath(SANDBOX_DIR)) or not safe_file.startswith(os.path.abspath(SANDBOX_DIR)):
+        return "Invalid path."
+    if not os.path.isfile(safe_file):
+        return "File not found."
+    if not table:
+        return "Table name required."
+    fmt = (format or BULK_FORMATS.get(os.path.splitext(safe_file)[1].lower(), '')).lower()
+    if fmt not in BULK_FORMATS.values():
+        return "Unsupported format (csv, tsv, jsonl, json, parquet)."
+    db_conn = None
+    prev_journal, prev_sync = None, None
+    start = time.time()
+    try:
+        columns, rows = _bulk_read_rows(safe_file, fmt)
+        if not columns:
+            return "No columns found in file."
+        sample = list(itertools.islice(rows, BULK_SAMPLE_ROWS))
+        col_types = [_bulk_infer_type(row[i] if i < len(row) else None for row in sample) for i in range(len(columns))]
+        converters = [_bulk_converter(t) for t in col_types]
+        db_conn = sqlite3.connect(safe_db)
+        # Tuned for load speed; restored in finally
+        prev_journal = db_conn.execute("PRAGMA journal_mode").fetchone()[0]
+        prev_sync = db_conn.execute("PRAGMA synchronous").fetchone()[0]
+        db_conn.execute("PRAGMA synchronous=OFF")
+        db_conn.execute("PRAGMA journal_mode=MEMORY")
+        db_conn.execute("PRAGMA cache_size=-65536")  # 64MB page cache during load
+        qtable = _quote_ident(table)
+        if mode == 'replace':
+            db_conn.execute(f"DROP TABLE IF EXISTS {qtable}")
+        col_defs = ", ".join(f"{_quote_ident(col)} {t}" for col, t in zip(columns, col_types))
+        db_conn.execute(f"CREATE TABLE IF NOT EXISTS {qtable} ({col_defs})")
+        insert_sql = (f"INSERT INTO {qtable} ({', '.join(_quote_ident(col) for col in columns)}) "
+                      f"VALUES ({', '.join('?' for _ in columns)})")
+        ncols = len(columns)
+        converted = (
+            tuple(conv(v) for conv, v in zip(converters, row)) + (None,) * (ncols - len(row))
+            for row in itertools.chain(sample, rows)
+        )
+        total = 0
+        while True:
+            batch = list(itertools.islice(converted, BULK_BATCH_SIZE))
+            if not batch:
+                break
+            db_conn.executemany(insert_sql, batch)
+            db_conn.commit()  # One transaction per batch
+            total += len(batch)
+            elapsed = time.time() - start
+            print(f"[LOG] db_bulk import: {total} rows ({total / max(elapsed, 1e-6):.0f} rows/s)")
+            if progress:
+                progress(total, elapsed)
+        elapsed = time.time() - start
+        schema = ", ".join(f"{col} {t}" for col, t in zip(columns, col_types))
+        return (f"Imported {total} rows into '{table}' in {elapsed:.2f}s "
+                f"({total / max(elapsed, 1e-6):.0f} rows/s). Schema: {schema}")
+    except Exception as e:
+        return f"Bulk import error: {str(e)}"
+    finally:
+        if db_conn:
+            try:
+                if prev_journal:
+                    db_conn.execute(f"PRAGMA journal_mode={prev_journal}")
+                if prev_sync is not None:
+                    db_conn.execute(f"PRAGMA synchronous={int(prev_sync)}")
+            except sqlite3.Error:
+                pass
+            db_conn.close()
+
+def db_bulk_export(db_path: str, query: str, file_path: str, format: str = "", params: list = [], progress=None) -> str:
+    """Stream SELECT results from a sandbox SQLite DB to a CSV/JSONL file."""
+    safe_db = os.path.abspath(os.path.normpath(os.path.join(SANDBOX_DIR, db_path)))
+    safe_file = os.path.abspath(os.path.normpath(os.path.join(SANDBOX_DIR, file_path)))
+    if not safe_db.startswith(os.path.abspath(SANDBOX_DIR)) or not safe_file.startswith(os.path.abspath(SANDBOX_DIR)):
+        return "Invalid path."
+    if not os.path.exists(safe_db):
+        return "DB not found."
+    if not query.strip().upper().startswith(('SELECT', 'WITH')):
+        return "Export requires a SELECT query."
+    fmt = (format or BULK_FORMATS.get(os.path.splitext(safe_file)[1].lower(), 'csv')).lower()
+    if fmt not in ('csv', 'tsv', 'jsonl'):
+        return "Unsupported export format (csv, tsv, jsonl)."
+    if not os.path.isdir(os.path.dirname(safe_file)):
+        return "Parent directory does not exist. Create it first with fs_mkdir."
+    db_conn = None
+    start = time.time()
+    try:
+        db_conn = sqlite3.connect(safe_db)
+        cur = db_conn.execute(query, params)
+        columns = [d[0] for d in cur.description]
+        total = 0
+        # BLOBs (e.g. embeddings) become prefixed base64 text instead of b'...' reprs, so import can restore them
+        to_text = lambda v: BULK_BLOB_PREFIX + base64.b64encode(v).decode() if isinstance(v, bytes) else v
+        with open(safe_file, 'w', newline='') as f:
+            if fmt == 'jsonl':
+                write_rows = lambda rows: f.writelines(json.dumps(dict(zip(columns, row)), default=lambda v: str(to_text(v))) + "\n"
+                                                       for row in rows)
+            else:
+                writer = csv.writer(f, delimiter='\t' if fmt == 'tsv' else ',')
+                writer.writerow(columns)
+                write_rows = lambda rows: writer.writerows(map(to_text, row) for row in rows)
+            while True:
+                rows = cur.fetchmany(BULK_BATCH_SIZE)
+                if not rows:
+                    break
+                write_rows(rows)
+                total += len(rows)
+                elapsed = time.time() - start
+                print(f"[LOG] db_bulk export: {total} rows ({total / max(elapsed, 1e-6):.0f} rows/s)")
+                if progress:
+                    progress(total, elapsed)
+        elapsed = time.time() - start
+        return f"Exported {total} rows to {file_path} in {elapsed:.2f}s."
+    except Exception as e:
+        return f"Bulk export error: {str(e)}"
+    finally:
+        if db_conn:
+            db_conn.close()
+
+def db_bulk(operation: str, db_path: str, file_path: str, table: str = "", query: str = "", format: str = "", params: list = [], mode: str = "append",
+            progress=None) -> str:
+    """Bulk import a data file into a sandbox DB, or export query results to a file; progress(rows, seconds) after each batch."""
+    if operation == 'import':
+        return db_bulk_import(db_path, file_path, table, format, mode, progress)
+    elif operation == 'export':
+        return db_bulk_export(db_path, query, file_path, format, params, progress)
+    return "Unsupported operation."
+
+# Tool Progress - progress(rows, seconds) callback handed to long tools (db_bulk) through ctx
+# Each batch updates the tool's trace span and a live status line under the streaming thought process;
+# the line is cleared when the tool returns. Headless (server.py) turns have no script context and only trace.
+class ToolProgress:
+    """Rows-done reporter for one tool call."""
+    def __init__(self, func_name, span_attrs):
+        self.func_name = func_name
+        self.span_attrs = span_attrs
+        self._line = None
+
+    def __call__(self, done, elapsed):
+        self.span_attrs.update(rows=done, seconds=round(elapsed, 2))
+        if get_script_run_ctx(suppress_warning=True) is None:
+            return
+        if self._line is None:
+            self._line = st.empty()
+        self._line.caption(f"⏳ {self.func_name}: {done:,} rows in {elapsed:.1f}s ({done / max(elapsed, 1e-6):,.0f} rows/s)")
+
+    def clear(self):
+        if self._line is not None:
+            self._line.empty()
+
 # Shell Exec Tool - Tightened Security (no shell=True)
 WHITELISTED_COMMANDS = ['ls', 'grep', 'sed', 'cat', 'echo', 'pwd']  # Add more safe ones as needed
 def shell_exec(command: str) -> str:
@@ -581,102 +2591,319 @@ def shell_exec(command: str) -> str:
     except Exception as e:
         return f"Shell error: {str(e)}"
 
-# Code Lint Tool - Unchanged
-def code_lint(language: str, code: str) -> str:
-    """Lint and format code snippets for multiple languages."""
-    lang = language.lower()
-    try:
+# Code Lint Tool - Formatter subsystem (content-hash cache, per-language timeouts, parallel pool)
+LINT_CACHE_SIZE = 512  # Formatted results kept in RAM (LRU)
+LINT_TIMEOUTS = {'cpp': 10, 'php': 20, 'go': 10, 'rust': 15}  # Seconds per external formatter call
+LINT_ALIASES = {'c': 'cpp', 'c++': 'cpp'}
+LINT_EXTERNAL = {
+    'cpp': ['clang-format', '-style=google'],
+    'go': ['gofmt'],
+    'rust': ['rustfmt', '--emit=stdout'],
+}
+BLACK_MODE = FileMode(line_length=88)  # Reused in-process (blackd-style; no per-call setup)
+
+class FormatterService:
+    """Process-wide formatter: LRU result cache keyed by content hash, thread pool for parallel lints."""
+    def __init__(self, max_workers=None):
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers or min(4, os.cpu_count() or 1), thread_name_prefix="lint")
+        self._binaries = {}  # Resolved formatter binaries (None = not installed)
+        self.hits = 0
+        self.misses = 0
+
+    def _binary(self, name):
+        if name not in self._binaries:
+            self._binaries[name] = shutil.which(name)
+        return self._binaries[name]
+
+    def _run_external(self, lang, cmd, code):
+        binary = self._binary(cmd[0])
+        if not binary:
+            return f"{cmd[0]} not available: not installed."
+        try:
+            proc = subprocess.run([binary] + cmd[1:], input=code.encode(), capture_output=True,
+                                  timeout=LINT_TIMEOUTS.get(lang, 10), check=True)
+            return proc.stdout.decode()
+        except subprocess.TimeoutExpired:
+            raise
+        except subprocess.CalledProcessError as e:
+            return f"{cmd[0]} error: {e.stderr.decode().strip() or str(e)}"
+
+    def _run_php(self, code):
+        binary = self._binary('php-cs-fixer')
+        if not binary:
+            return "php-cs-fixer not available: not installed."
+        # php-cs-fixer only fixes files in place
+        fd, tmp_path = tempfile.mkstemp(suffix='.php')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                tmp.write(code)
+            subprocess.run([binary, 'fix', tmp_path, '--quiet'], capture_output=True,
+                           timeout=LINT_TIMEOUTS['php'], check=True)
+            with open(tmp_path, 'r') as f:
+                return f.read()
+        except subprocess.CalledProcessError as e:
+            return f"php-cs-fixer error: {e.stderr.decode().strip() or str(e)}"
+        finally:
+            os.unlink(tmp_path)
+
+    def _format_uncached(self, lang, code):
         if lang == 'python':
-            formatted = format_str(code, mode=FileMode(line_length=88))
-        elif lang == 'javascript':
-            opts = jsbeautifier.default_options()
-            formatted = jsbeautifier.beautify(code, opts)
-        elif lang == 'css':
+            return format_str(code, mode=BLACK_MODE)
+        elif lang in ('javascript', 'css'):
             opts = jsbeautifier.default_options()
-            formatted = jsbeautifier.beautify(code, opts)  # Uses jsbeautifier for CSS
+            return jsbeautifier.beautify(code, opts)  # Uses jsbeautifier for CSS
         elif lang == 'json':
-            formatted = json.dumps(json.loads(code), indent=4)
+            return json.dumps(json.loads(code), indent=4)
         elif lang == 'yaml':
-            formatted = yaml.safe_dump(yaml.safe_load(code), indent=2)
+            return yaml.safe_dump(yaml.safe_load(code), indent=2)
         elif lang == 'sql':
-            formatted = sqlparse.format(code, reindent=True, keyword_case='upper')
+            return sqlparse.format(code, reindent=True, keyword_case='upper')
         elif lang == 'xml':
-            dom = xml.dom.minidom.parseString(code)
-            formatted = dom.toprettyxml(indent="  ")
+            return xml.dom.minidom.parseString(code).toprettyxml(indent="  ")
         elif lang == 'html':
-            soup = BeautifulSoup(code, 'html.parser')
-            formatted = soup.prettify()
-        elif lang in ['c', 'cpp', 'c++']:
-            try:
-                formatted = subprocess.check_output(['clang-format', '-style=google'], input=code.encode()).decode()
-            except Exception as e:
-                return f"clang-format not available: {str(e)}"
+            return BeautifulSoup(code, 'html.parser').prettify()
+        elif lang in LINT_EXTERNAL:
+            return self._run_external(lang, LINT_EXTERNAL[lang], code)
         elif lang == 'php':
-            try:
-                with tempfile.NamedTemporaryFile(suffix='.php', delete=False) as tmp:
-                    tmp.write(code.encode())
-                    tmp.flush()
-                    subprocess.check_call(['php-cs-fixer', 'fix', tmp.name, '--quiet'])
-                    with open(tmp.name, 'r') as f:
-                        formatted = f.read()
-                os.unlink(tmp.name)
-            except Exception as e:
-                return f"php-cs-fixer not available: {str(e)}"
-        elif lang == 'go':
-            try:
-                formatted = subprocess.check_output(['gofmt'], input=code.encode()).decode()
-            except Exception as e:
-                return f"gofmt not available: {str(e)}"
-        elif lang == 'rust':
-            try:
-                formatted = subprocess.check_output(['rustfmt', '--emit=stdout'], input=code.encode()).decode()
-            except Exception as e:
-                return f"rustfmt not available: {str(e)}"
-        else:
-            return "Unsupported language."
-        return formatted
-    except Exception as e:
-        return f"Lint error: {str(e)}"
+            return self._run_php(code)
+        return "Unsupported language."
+
+    def format(self, language: str, code: str) -> str:
+        lang = LINT_ALIASES.get(language.lower(), language.lower())
+        key = hashlib.sha256(f"{lang}\0{code}".encode()).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+        try:
+            result = self._format_uncached(lang, code)
+        except subprocess.TimeoutExpired:
+            return f"Lint error: formatter timed out after {LINT_TIMEOUTS.get(lang, 10)}s."  # Not cached
+        except Exception as e:
+            result = f"Lint error: {str(e)}"
+        with self._lock:
+            self._cache[key] = result
+            if len(self._cache) > LINT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def format_many(self, items) -> list:
+        """Format [(language, code), ...] concurrently; results in input order."""
+        return list(self._pool.map(lambda item: self.format(*item), items))
+
+@st.cache_resource
+def get_formatter_service():
+    return FormatterService()
+
+def code_lint(language: str, code: str) -> str:
+    """Lint and format code snippets for multiple languages."""
+    return get_formatter_service().format(language, code)
+
+def code_lint_many(items: list) -> list:
+    """Lint independent (language, code) snippets in parallel."""
+    return get_formatter_service().format_many(items)
+
+# Shared HTTP Client - Per-host keep-alive pools, capped streaming reads, conditional revalidation, rate limits
+HTTP_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+HTTP_MAX_BYTES = 256 * 1024  # Response bodies are cut off past this size
+HTTP_ERROR_BODY_BYTES = 4096  # 4xx/5xx bodies are returned (not raised), cut off past this size
+HTTP_POOL_HOSTS = 16  # Hosts with a cached connection pool
+HTTP_POOL_SIZE = 4  # Keep-alive connections per host
+HTTP_RATE_PER_HOST = 5.0  # Sustained requests/second per host
+HTTP_RATE_BURST = 10  # Requests allowed in a burst per host
+HTTP_RATE_MAX_WAIT = 5.0  # Longest a call waits for a rate-limit token (seconds)
+HTTP_CACHE_SIZE = 256  # URLs kept for ETag/Last-Modified revalidation
+HTTP_CACHE_TTL = 60  # Seconds a cached GET is served without revalidating
+
+class HttpClient:
+    """Process-wide HTTP client for real (non-mock) tool calls."""
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._buckets = {}  # host -> [tokens, last_refill]
+        self._cache = OrderedDict()  # url -> dict(etag, last_modified, body, truncated, stored_at)
+        self.stats = {"requests": 0, "revalidated": 0, "fresh_hits": 0, "truncated": 0, "rate_limited_waits": 0,
+                      "error_statuses": 0}  # Updated under _lock (shared by all sessions)
 
-# API Simulate Tool - With Cache
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _acquire(self, host):
+        """Token-bucket rate limit per host; waits briefly, raises if over budget."""
+        deadline = time.monotonic() + HTTP_RATE_MAX_WAIT
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (HTTP_RATE_BURST, now))
+                tokens = min(HTTP_RATE_BURST, tokens + (now - last) * HTTP_RATE_PER_HOST)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / HTTP_RATE_PER_HOST
+            if time.monotonic() + wait > deadline:
+                raise RuntimeError(f"rate limit exceeded for {host}")
+            self._count("rate_limited_waits")
+            time.sleep(wait)
+
+    def _read_capped(self, resp, max_bytes):
+        chunks, size, truncated = [], 0, False
+        for chunk in resp.iter_content(chunk_size=16384):
+            if size + len(chunk) > max_bytes:
+                chunks.append(chunk[:max_bytes - size])
+                truncated = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return b"".join(chunks).decode(resp.encoding or 'utf-8', errors='replace'), truncated
+
+    def request(self, method: str, url: str, json_body=None, max_bytes: int = HTTP_MAX_BYTES, timeout=HTTP_TIMEOUT) -> dict:
+        """Perform a request; returns dict(status, body, truncated, cached). Error statuses return their (capped) body too."""
+        method = method.upper()
+        headers = {}
+        entry = None
+        if method == 'GET':
+            with self._lock:
+                entry = self._cache.get(url)
+                if entry:
+                    self._cache.move_to_end(url)
+            if entry and time.time() - entry['stored_at'] < HTTP_CACHE_TTL:
+                self._count("fresh_hits")
+                return {"status": 200, "body": entry['body'], "truncated": entry['truncated'], "cached": True}
+            if entry and entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry and entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        self._acquire(urlparse(url).netloc)
+        self._count("requests")
+        with self.session.request(method, url, json=json_body, headers=headers, timeout=timeout, stream=True) as resp:
+            if resp.status_code == 304 and entry:
+                with self._lock:
+                    self.stats["revalidated"] += 1
+                    entry['stored_at'] = time.time()
+                return {"status": 200, "body": entry['body'], "truncated": entry['truncated'], "cached": True}
+            if resp.status_code >= 400:
+                self._count("error_statuses")
+                body, truncated = self._read_capped(resp, min(max_bytes, HTTP_ERROR_BODY_BYTES))
+                return {"status": resp.status_code, "body": body, "truncated": truncated, "cached": False}  # Never cached
+            body, truncated = self._read_capped(resp, max_bytes)
+            if truncated:
+                self._count("truncated")
+            etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+        if method == 'GET' and (etag or last_modified):
+            with self._lock:
+                self._cache[url] = {"etag": etag, "last_modified": last_modified, "body": body,
+                                    "truncated": truncated, "stored_at": time.time()}
+                self._cache.move_to_end(url)
+                if len(self._cache) > HTTP_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return {"status": resp.status_code, "body": body, "truncated": truncated, "cached": False}
+
+@st.cache_resource
+def get_http_client():
+    return HttpClient()
+
+# API Simulate Tool - Mocks cached per session; real calls via shared HTTP client
 def api_simulate(url: str, method: str = 'GET', data: dict = None, mock: bool = True) -> str:
     """Simulate or perform API calls."""
-    cache_args = {'url': url, 'method': method, 'data': data, 'mock': mock}
-    cached = get_cached_tool_result('api_simulate', cache_args)
-    if cached:
-        return cached
     if mock:
+        cache_args = {'url': url, 'method': method, 'data': data, 'mock': mock}
+        cached = get_cached_tool_result('api_simulate', cache_args)
+        if cached:
+            return cached
         result = json.dumps({"status": "mocked", "url": url, "method": method, "data": data})
-    else:
-        if not any(url.startswith(base) for base in API_WHITELIST):
-            result = "URL not in whitelist."
-        else:
-            try:
-                if method.upper() == 'GET':
-                    resp = requests.get(url, timeout=5)
-                elif method.upper() == 'POST':
-                    resp = requests.post(url, json=data, timeout=5)
-                else:
-                    result = "Unsupported method."
-                    set_cached_tool_result('api_simulate', cache_args, result)
-                    return result
-                resp.raise_for_status()
-                result = resp.text
-            except Exception as e:
-                result = f"API error: {str(e)}"
-    set_cached_tool_result('api_simulate', cache_args, result)
-    return result
+        set_cached_tool_result('api_simulate', cache_args, result)
+        return result
+    if not any(url.startswith(base) for base in API_WHITELIST):
+        return "URL not in whitelist."
+    if method.upper() not in ('GET', 'POST'):
+        return "Unsupported method."
+    try:
+        resp = get_http_client().request(method, url, json_body=data)
+        result = resp['body']
+        if resp['truncated']:
+            result += f"\n[Response truncated at {HTTP_ERROR_BODY_BYTES if resp['status'] >= 400 else HTTP_MAX_BYTES} bytes]"
+        if resp['status'] >= 400:
+            return f"HTTP {resp['status']}: {result}"  # The error payload often says what to fix
+        return result
+    except Exception as e:
+        return f"API error: {str(e)}"
 
 API_WHITELIST = [
     'https://jsonplaceholder.typicode.com/',
     'https://api.openweathermap.org/'  # Assuming free basics
 ]  # Add more public APIs
 
+# Web Search - Pooled session with retries, persistent query cache, slimmed results
+LANGSEARCH_URL = "https://api.langsearch.com/v1/web-search"
+SEARCH_TIMEOUT = (3.05, 20)  # (connect, read) seconds
+SEARCH_CACHE_TTLS = {  # Seconds; fresher filters expire sooner
+    "oneDay": 15 * 60,
+    "oneWeek": 60 * 60,
+    "oneMonth": 6 * 60 * 60,
+    "oneYear": 24 * 60 * 60,
+    "noLimit": 24 * 60 * 60,
+}
+SEARCH_RESULT_BUDGET = 6000  # Max bytes of result JSON handed to the model
+SEARCH_FIELDS = {"title": "name", "url": "url", "snippet": "snippet", "summary": "summary"}
+
+@st.cache_resource
+def get_search_session():
+    """Shared requests.Session with keep-alive pool and retry/backoff for LangSearch."""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=frozenset(['POST']))
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8, max_retries=retry))
+    return session
+
+def slim_search_response(data: dict, budget: int = SEARCH_RESULT_BUDGET) -> str:
+    """Keep only title/url/snippet/summary per result, trimmed to a byte budget."""
+    pages = ((data.get('data') or {}).get('webPages') or {}).get('value') or []
+    json_bytes = lambda obj: len(json.dumps(obj, ensure_ascii=False).encode())  # UTF-8, as sent (CJK is 3 bytes a char)
+    results = []
+    used = json_bytes({"results": []})
+    for page in pages:
+        item = {field: page[src] for field, src in SEARCH_FIELDS.items() if page.get(src)}
+        size = json_bytes(item) + 2
+        if used + size > budget:
+            # Out of room: keep a shortened, summary-less entry if it still fits
+            item.pop('summary', None)
+            overflow = used + json_bytes(item) + 2 - budget
+            if overflow > 0:
+                snippet = item.get('snippet', '').encode()
+                keep = len(snippet) - overflow - len("…".encode())
+                while keep >= 80:
+                    item['snippet'] = snippet[:keep].decode(errors='ignore') + "…"  # Drops a split trailing character
+                    overflow = used + json_bytes(item) + 2 - budget
+                    if overflow <= 0:
+                        break
+                    keep -= overflow  # JSON escapes cost more than the raw bytes
+                if overflow > 0:
+                    break
+            results.append(item)
+            break
+        results.append(item)
+        used += size
+    return json.dumps({"results": results}, ensure_ascii=False)
+
 def langsearch_web_search(query: str, freshness: str = "noLimit", summary: bool = False, count: int = 5) -> str:
-    """Perform a web search using LangSearch API and return results as JSON."""
+    """Perform a web search using LangSearch API and return slimmed results as JSON."""
     if not LANGSEARCH_API_KEY:
         return "LangSearch API key not set—configure in .env."
-    url = "https://api.langsearch.com/v1/web-search"
+    cache_key = hashlib.sha256(json.dumps([query, freshness, count, bool(summary)]).encode()).hexdigest()
+    now = time.time()
+    c.execute("SELECT response FROM search_cache WHERE cache_key=? AND expires_at > ?", (cache_key, now))
+    cached = c.fetchone()
+    if cached:
+        return cached[0]
     payload = json.dumps({
         "query": query,
         "freshness": freshness,
@@ -688,9 +2915,14 @@ def langsearch_web_search(query: str, freshness: str = "noLimit", summary: bool
         'Content-Type': 'application/json'
     }
     try:
-        response = requests.post(url, headers=headers, data=payload)
+        response = get_search_session().post(LANGSEARCH_URL, headers=headers, data=payload, timeout=SEARCH_TIMEOUT)
         response.raise_for_status()
-        return json.dumps(response.json())  # Return full JSON for AI to parse
+        result = slim_search_response(response.json())
+        ttl = SEARCH_CACHE_TTLS.get(freshness, SEARCH_CACHE_TTLS["noLimit"])
+        c.execute("INSERT OR REPLACE INTO search_cache (cache_key, response, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                  (cache_key, result, now, now + ttl))
+        # Defer commit
+        return result
     except Exception as e:
         return f"LangSearch error: {str(e)}"
 
@@ -758,7 +2990,7 @@ TOOLS = [
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "sync": {"type": "boolean", "description": "True for NTP sync (requires network), false for local host time. Default: false."},
+                    "sync": {"type": "boolean", "description": "True for NTP-corrected time (from background sync; falls back to host clock), false for local host time. Default: false."},
                     "format": {"type": "string", "description": "Output format: 'iso' (default), 'human', 'json'."}
                 },
                 "required": []
@@ -803,7 +3035,8 @@ TOOLS = [
                 "type": "object",
                 "properties": {
                     "mem_key": {"type": "string", "description": "Specific key to query (optional)."},
-                    "limit": {"type": "integer", "description": "Max recent entries if no key (default 10)."}
+                    "limit": {"type": "integer", "description": "Max recent entries if no key (default 10)."},
+                    "scope": {"type": "string", "enum": ["convo", "user"], "description": "convo (default): this chat only; user: across all of the user's chats."}
                 },
                 "required": []
             }
@@ -842,6 +3075,27 @@ TOOLS = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "db_bulk",
+            "description": "Bulk import a CSV/TSV/JSONL/JSON/Parquet file from the sandbox into a SQLite table (types inferred, one call for millions of rows), or export SELECT results to a CSV/TSV/JSONL file. Use instead of row-by-row db_query INSERTs.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "operation": {"type": "string", "enum": ["import", "export"]},
+                    "db_path": {"type": "string", "description": "Relative path to DB file."},
+                    "file_path": {"type": "string", "description": "Relative path to the data file to read (import) or write (export)."},
+                    "table": {"type": "string", "description": "Target table (for import; created if missing)."},
+                    "query": {"type": "string", "description": "SELECT query (for export)."},
+                    "format": {"type": "string", "description": "csv, tsv, jsonl, json or parquet. Optional; inferred from file extension."},
+                    "params": {"type": "array", "items": {"type": "string"}, "description": "Query parameters (for export)."},
+                    "mode": {"type": "string", "enum": ["append", "replace"], "description": "Append to or replace the table (import; default append)."}
+                },
+                "required": ["operation", "db_path", "file_path"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -892,7 +3146,7 @@ TOOLS = [
         "type": "function",
         "function": {
             "name": "advanced_memory_consolidate",
-            "description": "Brain-like consolidation: Summarize and embed data for hierarchical storage. Use for chat logs to create semantic summaries and episodic details.",
+            "description": "Brain-like consolidation: Summarize and embed data for hierarchical storage. Use for chat logs to create semantic summaries and episodic details. Runs in the background and returns a job id immediately.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -903,16 +3157,36 @@ TOOLS = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "memory_job_status",
+            "description": "Check background consolidation jobs (from advanced_memory_consolidate): pending, running, done or failed.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "job_id": {"type": "integer", "description": "Job id returned by advanced_memory_consolidate (optional; default: recent jobs)."},
+                    "limit": {"type": "integer", "description": "Max recent jobs if no job_id (default 10)."}
+                },
+                "required": []
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
             "name": "advanced_memory_retrieve",
-            "description": "Retrieve relevant memories via embedding similarity. Use before queries to augment context efficiently.",
+            "description": "Retrieve relevant memories: embedding similarity, keyword/BM25 match (exact identifiers, file names, error strings) and recency, fused in one ranking. Use before queries to augment context efficiently.",
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "query": {"type": "string", "description": "Query string for similarity search."},
-                    "top_k": {"type": "integer", "description": "Number of top results (default 5)."}
+                    "query": {"type": "string", "description": "Natural-language query and/or exact terms."},
+                    "top_k": {"type": "integer", "description": "Number of top results (default 5)."},
+                    "scope": {"type": "string", "enum": ["convo", "user"], "description": "convo (default): this chat only; user: across all of the user's chats."},
+                    "key_prefix": {"type": "string", "description": "Only memories whose mem_key starts with this (optional)."},
+                    "since": {"type": "string", "description": "Only memories at/after this ISO datetime (optional)."},
+                    "until": {"type": "string", "description": "Only memories at/before this ISO datetime (optional)."},
+                    "level": {"type": "string", "enum": ["any", "summary", "detail"], "description": "summary: consolidated summaries; detail: their full episodic data; any (default)."}
                 },
                 "required": ["query"]
             }
@@ -949,13 +3223,468 @@ TOOLS = [
     },
 ]
 
+# Tool Registry - Each tool's schema (from TOOLS), handler, cost class and category; dispatch is a dict lookup
+# Handlers take (args, ctx); ctx carries the session user plus per-batch state (e.g. parallel lint results).
+# cost: low = local and fast, medium = CPU/disk heavy, high = network or LLM calls
+# side_effects: writes files, memory, repos or remote state (turns calling these are never response-cached)
+# volatile: reads data that changes over time (clock, memory, files, the web); turns calling these aren't response-cached either
+TOOL_REGISTRY = {
+    "fs_read_file": {"category": "file", "cost": "low", "volatile": True,
+                     "handler": lambda a, ctx: fs_read_file(a.get('file_path', ''))},
+    "fs_write_file": {"category": "file", "cost": "low", "side_effects": True,
+                      "handler": lambda a, ctx: fs_write_file(a.get('file_path', ''), a.get('content', ''))},
+    "fs_list_files": {"category": "file", "cost": "low", "volatile": True,
+                      "handler": lambda a, ctx: fs_list_files(a.get('dir_path', ""))},
+    "fs_mkdir": {"category": "file", "cost": "low", "side_effects": True,
+                 "handler": lambda a, ctx: fs_mkdir(a.get('dir_path', ''))},
+    "get_current_time": {"category": "time", "cost": "low", "volatile": True,
+                         "handler": lambda a, ctx: get_current_time(a.get('sync', False), a.get('format', 'iso'))},
+    "code_execution": {"category": "code", "cost": "medium", "side_effects": True,
+                       "handler": lambda a, ctx: code_execution(a.get('code', ''))},
+    "memory_insert": {"category": "memory", "cost": "low", "core": True, "db_op": True, "side_effects": True,
+                      "handler": lambda a, ctx: memory_insert(ctx["user"], ensure_convo_id(), a.get('mem_key', ''), a.get('mem_value', {}))},
+    "memory_query": {"category": "memory", "cost": "low", "core": True, "volatile": True,
+                     "handler": lambda a, ctx: memory_query(ctx["user"], current_convo_id(), a.get('mem_key'), a.get('limit', 10),
+                                                            a.get('scope', 'convo'))},
+    "git_ops": {"category": "git", "cost": "medium", "side_effects": True,
+                "handler": lambda a, ctx: git_ops(a.get('operation', ''), a.get('repo_path', ''),
+                                                  **{k: v for k, v in a.items() if k in ['message', 'name']})},
+    "db_query": {"category": "db", "cost": "medium", "side_effects": True,
+                 "handler": lambda a, ctx: db_query(a.get('db_path', ''), a.get('query', ''), a.get('params', []))},
+    "db_bulk": {"category": "db", "cost": "medium", "side_effects": True,
+                "handler": lambda a, ctx: db_bulk(a.get('operation', ''), a.get('db_path', ''), a.get('file_path', ''),
+                                                  a.get('table', ''), a.get('query', ''), a.get('format', ''),
+                                                  a.get('params', []), a.get('mode', 'append'), ctx.get("progress"))},
+    "shell_exec": {"category": "shell", "cost": "medium", "side_effects": True,
+                   "handler": lambda a, ctx: shell_exec(a.get('command', ''))},
+    "code_lint": {"category": "code", "cost": "medium",
+                  "handler": lambda a, ctx: (ctx["lint_results"][ctx["tool_call_id"]] if ctx["tool_call_id"] in ctx["lint_results"]
+                                             else code_lint(a.get('language', ''), a.get('code', '')))},
+    "api_simulate": {"category": "web", "cost": "high", "side_effects": True,
+                     "handler": lambda a, ctx: api_simulate(a.get('url', ''), a.get('method', 'GET'), a.get('data'), a.get('mock', True))},
+    "advanced_memory_consolidate": {"category": "memory", "cost": "high", "db_op": True, "side_effects": True,
+                                    "handler": lambda a, ctx: advanced_memory_consolidate(ctx["user"], ensure_convo_id(), a.get('mem_key', ''),
+                                                                                          a.get('interaction_data', {}))},
+    "memory_job_status": {"category": "memory", "cost": "low", "volatile": True,
+                          "handler": lambda a, ctx: memory_job_status(ctx["user"], a.get('job_id'), a.get('limit', 10))},
+    "advanced_memory_retrieve": {"category": "memory", "cost": "medium", "volatile": True,
+                                 "handler": lambda a, ctx: advanced_memory_retrieve(
+                                     ctx["user"], current_convo_id(), a.get('query', ''), a.get('top_k', 5), a.get('scope', 'convo'),
+                                     a.get('key_prefix'), a.get('since'), a.get('until'), a.get('level', 'any'))},
+    "advanced_memory_prune": {"category": "memory", "cost": "medium", "db_op": True, "side_effects": True,
+                              "handler": lambda a, ctx: advanced_memory_prune(ctx["user"], current_convo_id())},
+    "langsearch_web_search": {"category": "web", "cost": "high", "volatile": True,
+                              "handler": lambda a, ctx: langsearch_web_search(a.get('query', ''), a.get('freshness', "noLimit"),
+                                                                              a.get('summary', True), a.get('count', 5))},
+}
+TOOL_CATEGORIES = sorted({spec["category"] for spec in TOOL_REGISTRY.values()})
+
+# Meta tool: lets the model pull in categories the selector left out (applies from the next iteration)
+TOOLS.append({
+    "type": "function",
+    "function": {
+        "name": "load_tools",
+        "description": "Load more tools when the one you need is not available. Categories: " + "; ".join(
+            f"{cat} ({', '.join(name for name, spec in TOOL_REGISTRY.items() if spec['category'] == cat)})" for cat in TOOL_CATEGORIES) + ".",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "categories": {"type": "array", "items": {"type": "string", "enum": TOOL_CATEGORIES}, "description": "Tool categories to load."}
+            },
+            "required": ["categories"]
+        }
+    }
+})
+
+def load_tools(categories, ctx) -> str:
+    """Add tool categories to this conversation's selection."""
+    valid = [cat for cat in categories if cat in TOOL_CATEGORIES]
+    if not valid:
+        return f"No valid categories. Choose from: {', '.join(TOOL_CATEGORIES)}."
+    ctx["categories"].update(valid)
+    names = [name for name, spec in TOOL_REGISTRY.items() if spec["category"] in valid]
+    return f"Loaded tools: {', '.join(names)}. Call them in your next step."
+
+TOOL_REGISTRY["load_tools"] = {"category": "meta", "cost": "low", "core": True,
+                               "handler": lambda a, ctx: load_tools(a.get('categories', []), ctx)}
+
+# Tool Result Compaction - Per-tool size budgets, JSON field pruning / top rows, head+tail text; full output kept under a handle
+TOOL_RESULT_BUDGET = int(os.getenv("HOMEBOT_TOOL_RESULT_BUDGET", "4000"))  # Chars fed back to the model per tool result
+TOOL_RESULT_BUDGETS = {"fs_read_file": 6000, "git_ops": 6000, "db_query": 4000, "db_bulk": 2000, "langsearch_web_search": 5000,
+                       "api_simulate": 3000, "shell_exec": 4000, "code_execution": 4000, "code_lint": 6000, "memory_query": 3000}
+TOOL_OUTPUT_STORE = os.getenv("HOMEBOT_TOOL_OUTPUT_STORE", "sqlite")  # sqlite | off (plain truncation, nothing to page)
+TOOL_OUTPUT_PAGE_SIZE = 4000  # Default chars per tool_output_page call
+JSON_PRUNE_LEVELS = ((1000, 50), (300, 20), (100, 10), (40, 5), (20, 3))  # (max string chars, max list items), loosest first
+
+def _prune_json(value, max_chars, max_items):
+    """Shorten long strings and lists in a JSON value, noting what was dropped."""
+    if isinstance(value, str):
+        return value if len(value) <= max_chars else value[:max_chars] + f"... [{len(value) - max_chars} chars]"
+    if isinstance(value, list):
+        kept = [_prune_json(item, max_chars, max_items) for item in value[:max_items]]
+        return kept + [f"... {len(value) - max_items} more rows"] if len(value) > max_items else kept
+    if isinstance(value, dict):
+        return {key: _prune_json(item, max_chars, max_items) for key, item in value.items()}
+    return value
+
+def _head_tail(text: str, budget: int) -> str:
+    """First ~2/3 and last ~1/3 of a text, cut on line boundaries where possible."""
+    head, tail = text[:budget * 2 // 3], text[len(text) - budget // 3:]
+    if "\n" in head[len(head) // 2:]:
+        head = head[:head.rindex("\n") + 1]
+    if "\n" in tail[:len(tail) // 2]:
+        tail = tail[tail.index("\n") + 1:]
+    return f"{head}\n[... {len(text) - len(head) - len(tail)} chars omitted ...]\n{tail}"
+
+def store_tool_output(user: str, func_name: str, tool_call_id: str, content: str) -> str:
+    """Keep a full tool output for paging; committed with the tool batch. Returns its handle."""
+    handle = "out_" + hashlib.sha1(f"{user}:{tool_call_id}:{content}".encode()).hexdigest()[:12]
+    c.execute("INSERT OR REPLACE INTO tool_outputs (handle, user, tool, content, created_at) VALUES (?, ?, ?, ?, ?)",
+              (handle, user, func_name, content, time.time()))
+    return handle
+
+def compact_tool_result(func_name: str, result, user: str, tool_call_id: str, categories=None) -> str:
+    """Fit a tool result into its budget before it goes back to the model (and into the UI/history).
+    When the full output is stored, the 'meta' category joins the selection so tool_output_page is offered next iteration."""
+    result = result if isinstance(result, str) else json.dumps(result)
+    budget = TOOL_RESULT_BUDGETS.get(func_name, TOOL_RESULT_BUDGET)
+    if len(result) <= budget or func_name == "tool_output_page":
+        return result
+    compact = None
+    try:
+        data = json.loads(result)
+    except ValueError:
+        data = None
+    if isinstance(data, (list, dict)):
+        for max_chars, max_items in JSON_PRUNE_LEVELS:
+            candidate = json.dumps(_prune_json(data, max_chars, max_items))
+            if len(candidate) <= budget:
+                compact = candidate
+                break
+    if compact is None:
+        compact = _head_tail(result, budget)
+    if TOOL_OUTPUT_STORE == "off":
+        return compact + f"\n[Result compacted from {len(result)} chars.]"
+    try:
+        handle = store_tool_output(user, func_name, tool_call_id, result)
+    except sqlite3.Error as e:
+        print(f"[LOG] Tool output store failed: {e}")
+        return compact + f"\n[Result compacted from {len(result)} chars.]"
+    if categories is not None:
+        categories.add("meta")
+    return compact + f"\n[Result compacted from {len(result)} chars; full output: tool_output_page(handle='{handle}', offset=0).]"
+
+def tool_output_page(user: str, handle: str, offset: int = 0, length: int = TOOL_OUTPUT_PAGE_SIZE) -> str:
+    """Page through a stored full tool output."""
+    c.execute("SELECT tool, content FROM tool_outputs WHERE handle=? AND user=?", (handle, user))
+    row = c.fetchone()
+    if not row:
+        return "Unknown or expired handle."
+    offset = max(int(offset), 0)
+    length = min(max(int(length), 1), TOOL_RESULT_BUDGET * 2)
+    content = row[1][offset:offset + length]
+    next_offset = offset + len(content) if offset + len(content) < len(row[1]) else None
+    return json.dumps({"handle": handle, "tool": row[0], "offset": offset, "next_offset": next_offset,
+                       "total_chars": len(row[1]), "content": content})
+
+TOOLS.append({
+    "type": "function",
+    "function": {
+        "name": "tool_output_page",
+        "description": "Read more of a tool result that was compacted. Use the handle from the '[Result compacted ...]' note; continue with next_offset until it is null.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle from the compaction note."},
+                "offset": {"type": "integer", "description": "Character offset to start from (default 0)."},
+                "length": {"type": "integer", "description": f"Characters to return (default {TOOL_OUTPUT_PAGE_SIZE})."}
+            },
+            "required": ["handle"]
+        }
+    }
+})
+TOOL_REGISTRY["tool_output_page"] = {"category": "meta", "cost": "low",
+                                     "handler": lambda a, ctx: tool_output_page(ctx["user"], a.get('handle', ''), a.get('offset', 0),
+                                                                                a.get('length', TOOL_OUTPUT_PAGE_SIZE))}
+for schema in TOOLS:
+    TOOL_REGISTRY[schema["function"]["name"]]["schema"] = schema
+assert all("schema" in spec for spec in TOOL_REGISTRY.values()), "every registered tool needs a TOOLS schema"
+
+# Tool Selection - Per-turn subset from user intent, the system prompt and recent tool use (sticky per conversation)
+TOOL_INTENT_KEYWORDS = {
+    "file": ("file", "folder", "directory", "sandbox", "read", "write", "save", "path", "txt", "md"),
+    "code": ("code", "coder", "coding", "python", "script", "run", "execute", "lint", "format", "function", "bug", "compute", "calculate",
+             "program", "programming"),
+    "memory": ("remember", "recall", "memory", "memories", "forget", "earlier", "last time", "previous", "consolidate"),
+    "git": ("git", "commit", "branch", "diff", "repo"),
+    "db": ("sql", "database", "sqlite", "table", "csv", "tsv", "jsonl", "parquet", "import", "export", "rows"),
+    "shell": ("shell", "command", "grep", "ls", "sed", "terminal", "wc"),
+    "web": ("search", "web", "news", "latest", "look up", "lookup", "online", "internet", "url", "http", "api", "website"),
+    "time": ("time", "date", "today", "now", "clock", "timestamp", "ntp"),
+}
+TOOL_INTENT_PATTERNS = {cat: re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + r")\b", re.IGNORECASE)
+                        for cat, keywords in TOOL_INTENT_KEYWORDS.items()}
+TOOL_RESULT_PATTERN = re.compile(r"\[Tool Result \((\w+)\)")
+TOOL_RECENT_MESSAGES = 10  # Assistant messages scanned for recent tool use
+TOOL_SCHEMA_TOKENS = {name: len(json.dumps(spec["schema"])) // 4 for name, spec in TOOL_REGISTRY.items()}  # ~4 chars/token
+
+def select_tools(messages, sys_prompt, categories):
+    """Tool schemas for this request, in registry order (same set -> same bytes for prompt caching).
+    categories is the conversation's sticky selection; it only grows, so the cached prefix rarely changes."""
+    last_user = next((m['content'] for m in reversed(messages) if m['role'] == 'user' and isinstance(m['content'], str)), "")
+    texts = [last_user]
+    if not any(name + "(" in sys_prompt for name in TOOL_REGISTRY):
+        texts.append(sys_prompt)  # Prompts that don't list tools still signal intent (e.g. "expert coder")
+    for text in texts:
+        categories.update(cat for cat, pattern in TOOL_INTENT_PATTERNS.items() if pattern.search(text))
+    recent = [m['content'] for m in messages if m['role'] == 'assistant' and isinstance(m['content'], str)][-TOOL_RECENT_MESSAGES:]
+    for content in recent:
+        categories.update(TOOL_REGISTRY[name]["category"] for name in TOOL_RESULT_PATTERN.findall(content) if name in TOOL_REGISTRY)
+    return [spec["schema"] for spec in TOOL_REGISTRY.values() if spec.get("core") or spec["category"] in categories]
+
+def record_tool_selection(tools):
+    """Per-request schema token accounting: selected vs full tool list."""
+    names = [schema["function"]["name"] for schema in tools]
+    sent = sum(TOOL_SCHEMA_TOKENS[name] for name in names)
+    full = sum(TOOL_SCHEMA_TOKENS.values())
+    st.session_state['tool_selection'] = {"tools": names, "sent_tokens": sent, "full_tokens": full}
+    print(f"[LOG] Tools: {len(names)}/{len(TOOL_REGISTRY)} sent (~{sent}/{full} schema tokens, ~{full - sent} saved).")
+
+def conversation_tool_categories(messages):
+    """Sticky category set for the current conversation (reset when the chat is cleared or switched)."""
+    convo_marker = messages[0].get('id') or messages[0]['content'][:64] if messages else None
+    state = st.session_state.get('tool_categories')
+    if not state or state["convo"] != convo_marker:
+        state = st.session_state['tool_categories'] = {"convo": convo_marker, "categories": set()}
+    return state["categories"]
+
+# Prompt Caching - Byte-stable prefix (system prompt + tools first, unchanged across turns) and cached-token accounting
+PROMPT_USAGE_HISTORY = 50  # Per-request usage records kept per session
+
+def prompt_prefix_hash(sys_prompt, tools):
+    """Fingerprint of the cacheable request prefix; a change means the provider cache starts over."""
+    return hashlib.sha256((sys_prompt + "\0" + json.dumps(tools, sort_keys=True)).encode()).hexdigest()[:12]
+
+def record_prompt_usage(usage, model, prefix_hash):
+    """Log cached vs uncached prompt tokens for one API request."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    total = usage.prompt_tokens or 0
+    usage_log = st.session_state.setdefault('prompt_usage', [])
+    if usage_log and usage_log[-1]["prefix"] != prefix_hash:
+        print(f"[LOG] Prompt prefix changed ({usage_log[-1]['prefix']} -> {prefix_hash}); provider cache restarts.")
+    usage_log.append({"model": model, "prefix": prefix_hash, "prompt_tokens": total, "cached_tokens": cached,
+                      "uncached_tokens": total - cached, "completion_tokens": usage.completion_tokens or 0})
+    del usage_log[:-PROMPT_USAGE_HISTORY]
+    print(f"[LOG] Prompt tokens: {cached}/{total} cached (prefix {prefix_hash}).")
+
+# Model Routing - "auto" picks a model per request from task type, prompt size and tool continuation
+# Policy maps route -> model; HOMEBOT_ROUTING_POLICY (JSON) overrides defaults, the sidebar overrides per session.
+# Note: a route change between iterations starts a new provider prompt cache (caches are per model).
+ROUTE_MODELS = ("grok-4", "grok-3", "grok-3-mini", "grok-code-fast-1")
+ROUTES = ("simple", "tool_followup", "code", "long", "default")
+ROUTING_POLICY = {"simple": "grok-3-mini", "tool_followup": "grok-3-mini", "code": "grok-code-fast-1",
+                  "long": "grok-4", "default": "grok-4", "consolidate": CONSOLIDATE_MODEL}
+
+def _routing_overrides(text: str) -> dict:
+    """Valid route -> model pairs from HOMEBOT_ROUTING_POLICY; bad JSON or unknown routes are logged and ignored."""
+    try:
+        overrides = json.loads(text)
+    except json.JSONDecodeError as e:
+        print(f"[LOG] HOMEBOT_ROUTING_POLICY is not valid JSON ({e}); using the default policy.")
+        return {}
+    if not isinstance(overrides, dict):
+        print("[LOG] HOMEBOT_ROUTING_POLICY must be a JSON object of route -> model; using the default policy.")
+        return {}
+    valid = {}
+    for route, model in overrides.items():
+        if route not in ROUTING_POLICY:
+            print(f"[LOG] HOMEBOT_ROUTING_POLICY: unknown route {route!r} ignored (routes: {', '.join(ROUTING_POLICY)}).")
+        elif not isinstance(model, str) or not model:
+            print(f"[LOG] HOMEBOT_ROUTING_POLICY: route {route!r} needs a model name; default kept.")
+        else:
+            valid[route] = model
+    return valid
+
+ROUTING_POLICY.update(_routing_overrides(os.getenv("HOMEBOT_ROUTING_POLICY", "{}")))
+ROUTE_SIMPLE_CHARS = 160  # User messages this short (without code) are simple
+ROUTE_LONG_TOKENS = 8000  # Estimated prompt tokens from which the full model is used
+ROUTE_CODE_PATTERN = re.compile(r"```|\b(code|coding|python|javascript|script|function|bug|traceback|stack trace|regex|sql|refactor|compile)\b", re.I)
+ROUTE_STATS_WINDOW = 500  # Requests kept per (route, model) for latency percentiles
+
+def classify_request(messages, iteration, tools=None) -> str:
+    if iteration > 1:
+        return "tool_followup"  # Reading tool results back, usually short
+    chars = sum(len(m['content']) if isinstance(m['content'], str) else 1000 for m in messages)
+    tool_tokens = sum(TOOL_SCHEMA_TOKENS.get(t["function"]["name"], 0) for t in tools or [])
+    if chars // 4 + tool_tokens > ROUTE_LONG_TOKENS:
+        return "long"
+    last_user = next((m['content'] for m in reversed(messages) if m['role'] == 'user' and isinstance(m['content'], str)), "")
+    if ROUTE_CODE_PATTERN.search(last_user):
+        return "code"
+    if len(last_user) <= ROUTE_SIMPLE_CHARS:
+        return "simple"
+    return "default"
+
+def route_model(model, messages, iteration, tools=None):
+    """(model to call, route name); a model picked in the UI is pinned."""
+    if model != "auto":
+        return model, "pinned"
+    route = classify_request(messages, iteration, tools)
+    return {**ROUTING_POLICY, **st.session_state.get('routing_policy', {})}[route], route
+
+class RouteStats:
+    """Per (route, model): request count, latency / time-to-first-token percentiles, token averages."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, model, duration_ms, ttft_ms=None, prompt_tokens=0, completion_tokens=0):
+        with self._lock:
+            entry = self._routes.setdefault((route, model), {"requests": 0, "latency": deque(maxlen=ROUTE_STATS_WINDOW),
+                                                             "ttft": deque(maxlen=ROUTE_STATS_WINDOW), "prompt_tokens": 0, "completion_tokens": 0})
+            entry["requests"] += 1
+            entry["latency"].append(duration_ms)
+            if ttft_ms is not None:
+                entry["ttft"].append(ttft_ms)
+            entry["prompt_tokens"] += prompt_tokens or 0
+            entry["completion_tokens"] += completion_tokens or 0
+
+    def summary(self):
+        rows = []
+        with self._lock:
+            for (route, model), entry in sorted(self._routes.items()):
+                latency, ttft = sorted(entry["latency"]), sorted(entry["ttft"])
+                rows.append({"route": route, "model": model, "requests": entry["requests"],
+                             "ttft_p50": round(ttft[len(ttft) // 2], 1) if ttft else None,
+                             "latency_p50": round(latency[len(latency) // 2], 1),
+                             "latency_p95": round(latency[min(len(latency) - 1, int(len(latency) * 0.95))], 1),
+                             "prompt_tokens_avg": entry["prompt_tokens"] // entry["requests"],
+                             "completion_tokens_avg": entry["completion_tokens"] // entry["requests"]})
+        return rows
+
+@st.cache_resource
+def get_route_stats():
+    return RouteStats()
+
+# Response Cache - Opt-in replay of answers to repeated questions (exact key, then MiniLM similarity)
+# Keyed on user, model, system prompt hash, tools flag and the normalized recent context. Turns that ran a tool
+# with side effects are never stored, so a replay never skips a write; nor are turns that read volatile data
+# (time, memory, files, web search), whose answers would replay stale facts.
+RESPONSE_CACHE_TTL = 3600  # Seconds, unless a rule below or a "cache-ttl: N" line in the system prompt says otherwise
+RESPONSE_CACHE_TTLS = [  # (pattern on the user message, seconds); first match wins, 0 = never cache
+    (re.compile(r"\b(time|date|today|tonight|now|tomorrow|yesterday|clock)\b", re.I), 0),
+    (re.compile(r"\b(weather|forecast|news|latest|current|price|score|status)\b", re.I), 600),
+    (re.compile(r"\b(file|folder|directory|sandbox|repo)\b|\w\.\w{1,4}\b", re.I), 300),  # Files change
+]
+RESPONSE_CACHE_PROMPT_TTL = re.compile(r"^cache-ttl:\s*(\d+)\s*$", re.I | re.M)
+RESPONSE_CACHE_CONTEXT = 2  # Prior messages that must match exactly
+RESPONSE_CACHE_SIMILARITY = 0.9  # Cosine similarity of the user message for a semantic hit
+RESPONSE_CACHE_CANDIDATES = 200  # Newest live entries compared per lookup
+
+def normalize_cache_text(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", str(text).lower()).split())
+
+def response_cache_ttl(sys_prompt: str, message: str) -> int:
+    for pattern, ttl in RESPONSE_CACHE_TTLS:
+        if pattern.search(message):
+            return ttl
+    match = RESPONSE_CACHE_PROMPT_TTL.search(sys_prompt)
+    return int(match.group(1)) if match else RESPONSE_CACHE_TTL
+
+class ResponseCache:
+    """Process-wide, persistent (response_cache table) and shared by sessions, per user."""
+    def __init__(self):
+        self._db = open_db_connection()
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "exact_hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0, "stored": 0, "skipped_side_effects": 0,
+                      "skipped_volatile": 0}  # Updated under _lock (shared by all sessions)
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def lookup(self, user, model, sys_prompt, messages, enable_tools):
+        """(cached response or None, entry context for store(); None context = not cacheable)."""
+        message = messages[-1]['content'] if messages and messages[-1]['role'] == 'user' else None
+        ttl = response_cache_ttl(sys_prompt, message) if isinstance(message, str) else 0
+        if not ttl:
+            self._count("bypassed")
+            return None, None
+        context = [f"{m['role']}:{normalize_cache_text(m['content'])}" for m in messages[-1 - RESPONSE_CACHE_CONTEXT:-1]]
+        scope = hashlib.sha256(json.dumps([user, model, hashlib.sha256(sys_prompt.encode()).hexdigest(),
+                                           bool(enable_tools), context]).encode()).hexdigest()
+        query = normalize_cache_text(message)
+        ctx = {"key": hashlib.sha256(f"{scope}\0{query}".encode()).hexdigest(), "scope": scope, "query": query, "ttl": ttl}
+        now = time.time()
+        with tracer.span("cache.lookup") as span:
+            with self._lock:
+                self.stats["lookups"] += 1
+                row = self._db.execute("SELECT response FROM response_cache WHERE cache_key=? AND expires_at > ?", (ctx["key"], now)).fetchone()
+                if row:
+                    self._db.execute("UPDATE response_cache SET hits=hits+1 WHERE cache_key=?", (ctx["key"],))
+                    self._db.commit()
+                    self.stats["exact_hits"] += 1
+                    span["hit"] = "exact"
+                    return row[0], ctx
+                candidates = self._db.execute("SELECT cache_key, embedding, response FROM response_cache WHERE scope_key=? AND expires_at > ? "
+                                              "ORDER BY created_at DESC LIMIT ?", (scope, now, RESPONSE_CACHE_CANDIDATES)).fetchall()
+            with tracer.span("embed.encode", n=1):
+                vector = get_embed_model().encode(query).astype(np.float32)
+            ctx["embedding"] = vector
+            if candidates:
+                matrix = np.stack([decode_embedding(blob) for _, blob, _ in candidates])
+                scores = (matrix @ vector) / (np.maximum(np.linalg.norm(matrix, axis=1), 1e-12) * (np.linalg.norm(vector) or 1.0))
+                best = int(np.argmax(scores))
+                if scores[best] >= RESPONSE_CACHE_SIMILARITY:
+                    with self._lock:
+                        self._db.execute("UPDATE response_cache SET hits=hits+1 WHERE cache_key=?", (candidates[best][0],))
+                        self._db.commit()
+                        self.stats["semantic_hits"] += 1
+                    span.update(hit="semantic", similarity=round(float(scores[best]), 3))
+                    return candidates[best][2], ctx
+            self._count("misses")
+            span["hit"] = None
+        return None, ctx
+
+    def store(self, ctx, response, side_effects=False, volatile=False):
+        if side_effects or volatile:
+            self._count("skipped_side_effects" if side_effects else "skipped_volatile")
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO response_cache (cache_key, scope_key, query, embedding, response, created_at, expires_at, hits) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                             (ctx["key"], ctx["scope"], ctx["query"], encode_embedding(ctx["embedding"]), response, now, now + ctx["ttl"]))
+            self._db.commit()
+            self.stats["stored"] += 1
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
 # API Wrapper with Streaming and Tool Handling - With batch commit and safe args
-def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, enable_tools=False):
-    client = OpenAI(
+@st.cache_resource
+def get_xai_client():
+    """Process-wide xAI client: pooled connections, and no per-turn client setup (CA bundle load costs ~35ms of CPU)."""
+    return OpenAI(
         api_key=API_KEY,
-        base_url="https://api.x.ai/v1",
+        base_url=XAI_BASE_URL,
         timeout=3600
     )
+
+def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, enable_tools=False, cache=False, prefetch=False):
+    cache_ctx = None
+    if cache and stream and not image_files:
+        cached, cache_ctx = get_response_cache().lookup(st.session_state['user'], model, sys_prompt, messages, enable_tools)
+        if cached is not None:
+            return iter([cached])  # Replayed in one chunk, no model call
+    turn = {"side_effects": False, "volatile": False, "retrieved": False}  # Tool effects seen this turn (caching / prefetch metrics)
+    prefetch_future = None
+    if prefetch and messages and messages[-1]['role'] == 'user':
+        prefetcher = get_memory_prefetcher()
+        prefetch_future = prefetcher.submit(st.session_state['user'], messages[-1]['content'])  # Runs while we build the request
+    client = get_xai_client()
     # Prepare messages (system first, then history)
     api_messages = [{"role": "system", "content": sys_prompt}]
     for msg in messages:
@@ -966,10 +3695,22 @@ def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, ena
                 img_data = base64.b64encode(img_file.read()).decode('utf-8')
                 content_parts.append({"type": "image_url", "image_url": {"url": f"data:{img_file.type};base64,{img_data}"}})
         api_messages.append({"role": msg['role'], "content": content_parts if len(content_parts) > 1 else msg['content']})
-    full_response = ""
+    # Tool subset is sticky per conversation and in registry order, so the request prefix stays byte-identical
+    tool_categories = conversation_tool_categories(messages) if enable_tools else set()
+    tools_param = select_tools(messages, sys_prompt, tool_categories) if enable_tools else None
+    prefix_hash = prompt_prefix_hash(sys_prompt, tools_param or [])
+    # Route a session's requests to the same cache (xAI prompt caching)
+    cache_headers = {"x-grok-conv-id": st.session_state.setdefault('xai_conv_id', uuid.uuid4().hex)}
+    prefetched_keys = []
+    if prefetch_future is not None:
+        memory_message, prefetched_keys = prefetcher.context_message(prefetch_future)
+        if memory_message:
+            # Own system message right before the user turn; the system prompt + tools prefix stays cacheable
+            api_messages.insert(len(api_messages) - 1, memory_message)
     def generate(current_messages):
-        nonlocal full_response
-        max_iterations = 3 
+        nonlocal tools_param, prefix_hash
+        max_iterations = 3
+        response_len = 0  # Streamed chars so far (progress metric; no string concatenation)
         iteration = 0
         previous_tool_calls = set()
         progress_metric = 0  # Track progress to avoid false loops
@@ -977,28 +3718,55 @@ def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, ena
         while iteration < max_iterations:
             iteration += 1
             print(f"[LOG] API Call Iteration: {iteration}")  # Debug
-            c.execute("BEGIN")  # Start transaction for batch
-            tools_param = TOOLS if enable_tools else None
-            response = client.chat.completions.create(
-                model=model,
-                messages=current_messages,
-                tools=tools_param,
-                tool_choice="auto" if enable_tools else None,
-                stream=True
-            )
+            if BACKGROUND_THREADS:
+                get_maintenance_scheduler().touch()  # Defer maintenance while chatting
+            # Tool writes open a transaction implicitly and are committed as one batch below;
+            # reads before the first write run in autocommit, so they may use the shared memory cache
+            if enable_tools:
+                tools_param = select_tools(messages, sys_prompt, tool_categories)  # Picks up load_tools requests
+                prefix_hash = prompt_prefix_hash(sys_prompt, tools_param)
+                record_tool_selection(tools_param)
             tool_calls = []
-            chunk_response = ""
             has_content = False
-            for chunk in response:
-                delta = chunk.choices[0].delta
-                if delta.content is not None:
-                    content = delta.content
-                    chunk_response += content
-                    yield content
-                    has_content = True
-                if delta.tool_calls:
-                    tool_calls += delta.tool_calls  # Collect partial calls
-            full_response += chunk_response
+            request_model, route = route_model(model, messages, iteration, tools_param)
+            usage = None
+            # Span covers request + stream; ttft is time to the first chunk (content or tool call)
+            with tracer.span("model.stream", model=request_model, route=route, iteration=iteration) as stream_span:
+                stream_start = time.perf_counter()
+                first_chunk = None
+                response = client.chat.completions.create(
+                    model=request_model,
+                    messages=current_messages,
+                    tools=tools_param,
+                    tool_choice="auto" if enable_tools else None,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    extra_headers=cache_headers
+                )
+                for chunk in response:
+                    if chunk.usage:
+                        usage = chunk.usage
+                        record_prompt_usage(usage, request_model, prefix_hash)
+                        stream_span["completion_tokens"] = usage.completion_tokens
+                    if not chunk.choices:
+                        continue  # Usage-only final chunk
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter()
+                        stream_span["ttft_ms"] = round((first_chunk - stream_start) * 1000, 1)
+                        tracer.record("model.ttft", stream_start, duration=first_chunk - stream_start, model=request_model)
+                    delta = chunk.choices[0].delta
+                    if delta.content is not None:
+                        content = delta.content
+                        response_len += len(content)
+                        yield content
+                        has_content = True
+                    if delta.tool_calls:
+                        tool_calls += delta.tool_calls  # Collect partial calls
+                if first_chunk and stream_span.get("completion_tokens"):
+                    elapsed = time.perf_counter() - first_chunk
+                    stream_span["tokens_per_sec"] = round(stream_span["completion_tokens"] / elapsed, 1) if elapsed else None
+                get_route_stats().record(route, request_model, (time.perf_counter() - stream_start) * 1000, stream_span.get("ttft_ms"),
+                                         usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0)
             if not has_content and not tool_calls:
                 print("[DEBUG] No progress; breaking")
                 break
@@ -1017,119 +3785,100 @@ def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, ena
             # Robust loop detection with progress check
             if (
                 current_tool_names == previous_tool_calls
-                and len(full_response) == progress_metric
+                and response_len == progress_metric
                 and iteration > 1
             ):
                 yield "Detected potential tool loop—no progress—breaking."
                 break
             previous_tool_calls = current_tool_names.copy()
-            progress_metric = len(full_response)  # Update metric
+            progress_metric = response_len  # Update metric
             # Process batched tools
             for func_name, calls in tool_batches.items():
+                lint_results = {}
+                if func_name == "code_lint" and len(calls) > 1:
+                    # Independent lint requests run in parallel on the formatter pool
+                    lint_items = []
+                    for tool_call in calls:
+                        try:
+                            lint_args = json.loads(tool_call.function.arguments)
+                        except Exception:
+                            lint_args = {}
+                        lint_items.append((lint_args.get('language', ''), lint_args.get('code', '')))
+                    lint_results = dict(zip([tc.id for tc in calls], code_lint_many(lint_items)))
                 for tool_call in calls:
                     try:
                         # Safe args parse
                         try:
                             args = json.loads(tool_call.function.arguments)
                         except:
-                            args = {}
+                            args = None
+                        spec = TOOL_REGISTRY.get(func_name)
+                        if args is None:
                             result = "Invalid tool args."
-                        if func_name == "fs_read_file":
-                            result = fs_read_file(args.get('file_path', ''))
-                        elif func_name == "fs_write_file":
-                            result = fs_write_file(args.get('file_path', ''), args.get('content', ''))
-                        elif func_name == "fs_list_files":
-                            dir_path = args.get('dir_path', "")
-                            result = fs_list_files(dir_path)
-                        elif func_name == "fs_mkdir":
-                            result = fs_mkdir(args.get('dir_path', ''))
-                        elif func_name == "get_current_time":
-                            sync = args.get('sync', False)
-                            fmt = args.get('format', 'iso')
-                            result = get_current_time(sync, fmt)
-                        elif func_name == "code_execution":
-                            result = code_execution(args.get('code', ''))
-                        elif func_name == "memory_insert":
-                            user = st.session_state['user']
-                            convo_id = st.session_state.get('current_convo_id', 0)
-                            result = memory_insert(user, convo_id, args.get('mem_key', ''), args.get('mem_value', {}))
-                            db_ops.append('memory_insert')
-                        elif func_name == "memory_query":
-                            user = st.session_state['user']
-                            convo_id = st.session_state.get('current_convo_id', 0)
-                            mem_key = args.get('mem_key')
-                            limit = args.get('limit', 10)
-                            result = memory_query(user, convo_id, mem_key, limit)
-                        elif func_name == "git_ops":
-                            operation = args.get('operation', '')
-                            repo_path = args.get('repo_path', '')
-                            result = git_ops(operation, repo_path, **{k: v for k, v in args.items() if k in ['message', 'name']})
-                        elif func_name == "db_query":
-                            db_path = args.get('db_path', '')
-                            query = args.get('query', '')
-                            params = args.get('params', [])
-                            result = db_query(db_path, query, params)
-                        elif func_name == "shell_exec":
-                            command = args.get('command', '')
-                            result = shell_exec(command)
-                        elif func_name == "code_lint":
-                            language = args.get('language', '')
-                            code = args.get('code', '')
-                            result = code_lint(language, code)
-                        elif func_name == "api_simulate":
-                            url = args.get('url', '')
-                            method = args.get('method', 'GET')
-                            data = args.get('data')
-                            mock = args.get('mock', True)
-                            result = api_simulate(url, method, data, mock)
-                        elif func_name == "advanced_memory_consolidate":
-                            user = st.session_state['user']
-                            convo_id = st.session_state.get('current_convo_id', 0)
-                            result = advanced_memory_consolidate(user, convo_id, args.get('mem_key', ''), args.get('interaction_data', {}))
-                            db_ops.append('advanced_memory_consolidate')
-                        elif func_name == "advanced_memory_retrieve":
-                            user = st.session_state['user']
-                            convo_id = st.session_state.get('current_convo_id', 0)
-                            query = args.get('query', '')
-                            top_k = args.get('top_k', 5)
-                            result = advanced_memory_retrieve(user, convo_id, query, top_k)
-                        elif func_name == "advanced_memory_prune":
-                            user = st.session_state['user']
-                            convo_id = st.session_state.get('current_convo_id', 0)
-                            result = advanced_memory_prune(user, convo_id)
-                            db_ops.append('advanced_memory_prune')
-                        elif func_name == "langsearch_web_search":
-                            query = args.get('query', '')
-                            freshness = args.get('freshness', "noLimit")
-                            summary = args.get('summary', True)
-                            count = args.get('count', 5)
-                            result = langsearch_web_search(query, freshness, summary, count)
-                        else:
+                        elif spec is None:
                             result = "Unknown tool."
+                        else:
+                            ctx = {"user": st.session_state['user'], "tool_call_id": tool_call.id,
+                                   "lint_results": lint_results, "categories": tool_categories}
+                            with tracer.span("tool." + func_name, category=spec["category"]) as span_attrs:
+                                ctx["progress"] = ToolProgress(func_name, span_attrs)
+                                try:
+                                    result = spec["handler"](args, ctx)
+                                finally:
+                                    ctx["progress"].clear()
+                            if spec.get("side_effects"):
+                                turn["side_effects"] = True
+                            if spec.get("volatile"):
+                                turn["volatile"] = True
+                            if prefetched_keys and func_name in RETRIEVAL_TOOLS and not turn["retrieved"]:
+                                turn["retrieved"] = True
+                                prefetcher.record_model_retrieval(prefetched_keys, result)
+                            if spec.get("db_op"):
+                                db_ops.append(func_name)
                     except Exception as e:
                         result = f"Tool error: {traceback.format_exc()}"
                         print(f"[LOG] Tool Error: {result}")  # Debug
                         with open('app.log', 'a') as log:
                             log.write(f"Tool Error: {result}\n")
+                    # Budgeted copy for the model, UI and saved history (full output stays pageable by handle)
+                    result = compact_tool_result(func_name, result, st.session_state['user'], tool_call.id, tool_categories)
                     yield f"\n[Tool Result ({func_name}): {result}]\n"
                     # Append to messages for next iteration
                     current_messages.append({"role": "tool", "content": result, "tool_call_id": tool_call.id})
-            conn.commit()  # Batch commit after tools
+            with tracer.span("db.batch_commit", ops=len(db_ops)):
+                conn.commit()  # Batch commit after tools
             if db_ops:
                 print(f"[LOG] Batched {len(set(db_ops))} DB ops.")
         if iteration >= max_iterations:
             yield "Max iterations reached—summarizing."
+    def cached_generate(current_messages):
+        parts = []
+        for chunk in generate(current_messages):
+            parts.append(chunk)
+            yield chunk
+        if parts:
+            get_response_cache().store(cache_ctx, "".join(parts), turn["side_effects"], turn["volatile"])
     try:
         if stream:
+            if cache_ctx is not None:
+                return cached_generate(api_messages)
             return generate(api_messages)  # Return generator for streaming
         else:
+            request_model, route = route_model(model, messages, 1, tools_param)
+            start = time.perf_counter()
             response = client.chat.completions.create(
-                model=model,
+                model=request_model,
                 messages=api_messages,
-                tools=TOOLS if enable_tools else None,
+                tools=tools_param,
                 tool_choice="auto" if enable_tools else None,
-                stream=False
+                stream=False,
+                extra_headers=cache_headers
             )
+            if response.usage:
+                record_prompt_usage(response.usage, request_model, prefix_hash)
+            get_route_stats().record(route, request_model, (time.perf_counter() - start) * 1000, None,
+                                     response.usage.prompt_tokens if response.usage else 0,
+                                     response.usage.completion_tokens if response.usage else 0)
             full_response = response.choices[0].message.content
             return lambda: [full_response]  # Mock generator for non-stream
     except Exception as e:
@@ -1138,7 +3887,7 @@ def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, ena
         with open('app.log', 'a') as log:
             log.write(f"{error_msg}\n")
         time.sleep(5)
-        return call_xai_api(model, messages, sys_prompt, stream, image_files, enable_tools)  # Retry
+        return call_xai_api(model, messages, sys_prompt, stream, image_files, enable_tools, cache, prefetch)  # Retry
 
 # Login Page - Unchanged
 def login_page():
@@ -1152,11 +3901,8 @@ def login_page():
             password = st.text_input("Password", type="password", key="login_pass")
             submitted = st.form_submit_button("Login")
             if submitted:
-                c.execute("SELECT password FROM users WHERE username=?", (username,))
-                result = c.fetchone()
-                if result and verify_password(result[0], password):
-                    st.session_state['logged_in'] = True
-                    st.session_state['user'] = username
+                if check_login(username, password):
+                    start_login(username)
                     st.success(f"Logged in as {username}!")
                     st.rerun()
                 else:
@@ -1176,6 +3922,115 @@ def login_page():
                     conn.commit()
                     st.success("Registered! Please login.")
 
+# Chat Rendering - Cached message blocks, paged history, fragments (no full re-render per rerun)
+HISTORY_PAGE_SIZE = 20  # Messages rendered per "Load earlier" page
+FINAL_ANSWER_MARKER = "### Final Answer"
+
+def new_message(role: str, content: str) -> dict:
+    """Chat message with a stable id and content hash."""
+    return {"id": uuid.uuid4().hex, "role": role, "content": content,
+            "hash": hashlib.sha1(content.encode()).hexdigest()}
+
+def split_final_answer(content: str):
+    """Split a response into (thought, answer) at the Final Answer marker."""
+    if FINAL_ANSWER_MARKER in content:
+        thought, answer = content.split(FINAL_ANSWER_MARKER, 1)
+        return thought.strip(), FINAL_ANSWER_MARKER + answer
+    return "", content
+
+def render_message(msg: dict):
+    # Splitting is a cheap string scan; the savings come from paging and the fragment, not from caching this
+    thought, body = split_final_answer(msg['content']) if msg['role'] == "assistant" else ("", msg['content'])
+    with st.chat_message(msg["role"]):
+        if thought:
+            with st.expander("Thought process"):
+                st.markdown(thought, unsafe_allow_html=True)
+        st.markdown(body, unsafe_allow_html=True)
+
+def load_earlier_messages():
+    st.session_state['history_visible'] = st.session_state.get('history_visible', HISTORY_PAGE_SIZE) + HISTORY_PAGE_SIZE
+
+@st.fragment
+def render_chat_history():
+    """Render the newest page of messages; older ones load on demand."""
+    messages = st.session_state["messages"]
+    visible = st.session_state.get('history_visible', HISTORY_PAGE_SIZE)
+    hidden = max(len(messages) - visible, 0)
+    if hidden:
+        st.button(f"Load earlier messages ({hidden} hidden)", key="load_earlier", on_click=load_earlier_messages)
+    for msg in messages[hidden:]:
+        render_message(msg)
+
+@st.fragment
+def render_history_list():
+    """Sidebar history search/list; reruns on its own without touching the chat."""
+    search_term = st.text_input("Search History")
+    c.execute(
+        "SELECT convo_id, title FROM history WHERE user=?",
+        (st.session_state["user"],),
+    )
+    histories = c.fetchall()
+    filtered_histories = [
+        h for h in histories if search_term.lower() in h[1].lower()
+    ]
+    for convo_id, title in filtered_histories:
+        col1, col2 = st.columns([3, 1])
+        # Full-app reruns (not fragment callbacks) so the chat pane updates too
+        if col1.button(f"{title}", key=f"load_{convo_id}"):
+            load_history(convo_id)
+        if col2.button("🗑", key=f"delete_{convo_id}"):
+            delete_history(convo_id)
+
+# Stream Rendering - Coalesced chunks; each flush re-sends only the open tail segment
+STREAM_FLUSH_INTERVAL = 0.075  # Seconds between UI flushes while streaming
+STREAM_FLUSH_CHARS = 1500  # Flush early once this much new text is pending
+STREAM_SEGMENT_CHARS = 3000  # Seal the live segment at a paragraph break past this size
+
+class StreamRenderer:
+    """Buffers streamed chunks and renders them as sealed segments plus one live tail."""
+    def __init__(self, placeholder):
+        self._placeholder = placeholder  # st.empty(); later .markdown() calls replace everything
+        self._container = placeholder.container()
+        self._sealed = []  # Finished segments (rendered once, never re-sent)
+        self._tail = []  # Chunks of the open segment
+        self._tail_slot = self._container.empty()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, chunk: str):
+        self._tail.append(chunk)
+        self._pending += len(chunk)
+        if self._pending >= STREAM_FLUSH_CHARS or time.monotonic() - self._last_flush >= STREAM_FLUSH_INTERVAL:
+            self.flush()
+
+    def _seal_point(self, text: str) -> int:
+        """Last paragraph break outside a code fence, or -1."""
+        pos = text.rfind("\n\n")
+        while pos > 0:
+            if text.count("```", 0, pos) % 2 == 0:
+                return pos + 2
+            pos = text.rfind("\n\n", 0, pos)
+        return -1
+
+    def flush(self):
+        tail = "".join(self._tail)
+        if len(tail) > STREAM_SEGMENT_CHARS:
+            cut = self._seal_point(tail)
+            if cut > 0:
+                self._tail_slot.markdown(tail[:cut], unsafe_allow_html=False)
+                self._sealed.append(tail[:cut])
+                tail = tail[cut:]
+                self._tail_slot = self._container.empty()
+        self._tail = [tail] if tail else []
+        self._tail_slot.markdown(tail, unsafe_allow_html=False)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def finish(self) -> str:
+        """Flush what is left and return the full text."""
+        self.flush()
+        return "".join(self._sealed + self._tail)
+
 # Chat Page - Fixed history save, prompt cache, always show response
 def chat_page():
     st.title(f"Grok Chat - {st.session_state['user']}")
@@ -1184,13 +4039,23 @@ def chat_page():
         st.header("Chat Settings")
         model = st.selectbox(
             "Select Model",
-            ["grok-4", "grok-3-mini", "grok-3", "grok-code-fast-1"],
+            ["grok-4", "grok-3-mini", "grok-3", "grok-code-fast-1", "auto"],
             key="model_select",
-        )  # Extensible
-        # Load Prompt Files Dynamically - Cached
-        if 'prompt_files' not in st.session_state:
-            st.session_state['prompt_files'] = load_prompt_files()
-        prompt_files = st.session_state['prompt_files']
+        )  # Extensible; "auto" routes each request (see Routing Policy)
+        if model == "auto":
+            with st.expander("Routing Policy"):
+                overrides = {}
+                for route in ROUTES:
+                    default = ROUTING_POLICY[route]
+                    current = st.session_state.get('routing_policy', {}).get(route, default)
+                    choice = st.selectbox(route.replace("_", " ").title(), ROUTE_MODELS, index=ROUTE_MODELS.index(current)
+                                          if current in ROUTE_MODELS else 0, key=f"route_{route}")
+                    if choice != default:
+                        overrides[route] = choice
+                st.session_state['routing_policy'] = overrides
+                st.caption("Simple: short messages. Tool followup: reading tool results. Long: large prompts.")
+        # Load Prompt Files Dynamically - Shared registry, refreshed when ./prompts/ changes
+        prompt_files = load_prompt_files()
         if not prompt_files:
             st.warning("No prompt files found in ./prompts/. Add some .txt files!")
             custom_prompt = st.text_area(
@@ -1203,8 +4068,7 @@ def chat_page():
             selected_file = st.selectbox(
                 "Select System Prompt File", prompt_files, key="prompt_select"
             )
-            with open(os.path.join(PROMPTS_DIR, selected_file), "r") as f:
-                prompt_content = f.read()
+            prompt_content = get_prompt_registry().read(selected_file)
             custom_prompt = st.text_area(
                 "Edit System Prompt",
                 value=prompt_content,
@@ -1212,19 +4076,40 @@ def chat_page():
                 key="prompt_editor",
             )
         st.session_state['custom_prompt'] = custom_prompt  # Store for lazy load
+        tool_selection = st.session_state.get('tool_selection')
+        if tool_selection and st.session_state.get('enable_tools'):
+            st.caption(f"Tools: {len(tool_selection['tools'])}/{len(TOOL_REGISTRY)} attached "
+                       f"(~{tool_selection['sent_tokens']}/{tool_selection['full_tokens']} schema tokens).")
+        usage_log = st.session_state.get('prompt_usage')
+        if usage_log:
+            last = usage_log[-1]
+            total = sum(u["prompt_tokens"] for u in usage_log)
+            cached = sum(u["cached_tokens"] for u in usage_log)
+            st.caption(f"Prompt cache: last request {last['cached_tokens']}/{last['prompt_tokens']} tokens cached; "
+                       f"session {cached / total:.0%} of {total} cached." if total else "Prompt cache: no prompt tokens yet.")
+        with st.expander("Performance"):
+            stage_stats = get_tracer().stage_stats()
+            if stage_stats:
+                st.dataframe([{"stage": name, **stat} for name, stat in
+                              sorted(stage_stats.items(), key=lambda item: item[1]["p95"], reverse=True)],
+                             hide_index=True, use_container_width=True)
+                st.caption(f"ms over the last {TRACE_RING_SIZE} spans; sink: {TRACE_SINK}"
+                           + (f"; Prometheus on :{METRICS_PORT}/metrics" if METRICS_PORT else ""))
+            else:
+                st.caption("No spans recorded yet.")
+            route_rows = get_route_stats().summary()
+            if route_rows:
+                st.dataframe(route_rows, hide_index=True, use_container_width=True)
+                st.caption("Model requests per route (ms, tokens); pinned = model chosen in the selector.")
         # Save Edited Prompt
         with st.form("save_prompt_form"):
             new_filename = st.text_input("Save as (e.g., my-prompt.txt)", value="")
             save_submitted = st.form_submit_button("Save Prompt to File")
             if save_submitted and new_filename.endswith(".txt"):
                 save_path = os.path.join(PROMPTS_DIR, new_filename)
-                with open(save_path, "w") as f:
-                    f.write(custom_prompt)
-                if "love" in new_filename.lower():  # Show Love
-                    with open(save_path, "a") as f:
-                        f.write("\n<3")  # Append heart
+                heart = "\n<3" if "love" in new_filename.lower() else ""  # Show Love: append heart
+                get_prompt_registry().save(new_filename, custom_prompt + heart)
                 st.success(f"Saved to {save_path}!")
-                st.session_state['prompt_files'] = load_prompt_files()  # Refresh cache
                 st.rerun()  # Refresh dropdown
         # Image Upload for Vision (Multi-file support) - Store in session
         uploaded_images = st.file_uploader(
@@ -1242,36 +4127,32 @@ def chat_page():
             st.info(
                 "Tools enabled: AI can read/write/list files in ./sandbox/. Copy files there to access."
             )
+        if st.checkbox("Cache Responses (repeat questions answer instantly)", value=False, key='response_cache'):
+            cache_stats = get_response_cache().stats
+            hits = cache_stats["exact_hits"] + cache_stats["semantic_hits"]
+            st.caption(f"Response cache: {hits}/{cache_stats['lookups']} hits ({cache_stats['exact_hits']} exact, "
+                       f"{cache_stats['semantic_hits']} similar); {cache_stats['bypassed']} time-sensitive bypassed, "
+                       f"{cache_stats['skipped_side_effects']} not stored (tool side effects), "
+                       f"{cache_stats['skipped_volatile']} not stored (read live data).")
+        if st.checkbox("Prefetch Memories (recall before the model asks)", value=False, key='memory_prefetch'):
+            prefetch_stats = get_memory_prefetcher().stats
+            st.caption(f"Memory prefetch: injected on {prefetch_stats['injected']}/{prefetch_stats['turns']} turns "
+                       f"({prefetch_stats['late']} too slow); model still retrieved on {prefetch_stats['model_asked']}, "
+                       f"{prefetch_stats['covered']} of them already covered.")
         st.header("Chat History")
-        search_term = st.text_input("Search History")
-        c.execute(
-            "SELECT convo_id, title FROM history WHERE user=?",
-            (st.session_state["user"],),
-        )
-        histories = c.fetchall()
-        filtered_histories = [
-            h for h in histories if search_term.lower() in h[1].lower()
-        ]
-        for convo_id, title in filtered_histories:
-            col1, col2 = st.columns([3, 1])
-            col1.button(
-                f"{title}",
-                key=f"load_{convo_id}",
-                on_click=lambda cid=convo_id: load_history(cid),
-            )
-            col2.button(
-                "🗑",
-                key=f"delete_{convo_id}",
-                on_click=lambda cid=convo_id: delete_history(cid),
-            )
+        render_history_list()
         if st.button("Clear Current Chat"):
             st.session_state["messages"] = []
+            st.session_state['current_convo_id'] = None  # Next turn starts a new history row (and memory scope)
+            st.session_state['history_visible'] = HISTORY_PAGE_SIZE
             st.rerun()
         # Dark Mode Toggle with CSS Injection
         if st.button("Toggle Dark Mode"):
             current_theme = st.session_state.get("theme", "light")
             st.session_state["theme"] = "dark" if current_theme == "light" else "light"
             st.rerun()  # Rerun to apply
+        if st.button("Log Out"):
+            logout()
         # Inject theme attribute
         st.markdown(
             f'<body data-theme="{st.session_state.get("theme", "light")}"></body>',
@@ -1288,18 +4169,12 @@ def chat_page():
         st.session_state["messages"] = st.session_state["messages"][-50:]
         st.warning("Chat truncated to last 50 messages for performance.")
     if st.session_state["messages"]:
-        chunk_size = 10  # Group every 10 messages
-        for i in range(0, len(st.session_state["messages"]), chunk_size):
-            chunk = st.session_state["messages"][i : i + chunk_size]
-            with st.expander(f"Messages {i+1}-{i+len(chunk)}"):
-                for msg in chunk:
-                    with st.chat_message(msg["role"]):
-                        st.markdown(msg["content"], unsafe_allow_html=True)  # Standard rendering
+        render_chat_history()
 
     # Chat Input
     prompt = st.chat_input("Type your message here...")
     if prompt:
-        st.session_state['messages'].append({"role": "user", "content": prompt})
+        st.session_state['messages'].append(new_message("user", prompt))
         with st.chat_message("user"):
             st.markdown(prompt, unsafe_allow_html=False)  # Standard user message
         with st.chat_message("assistant"):
@@ -1307,43 +4182,51 @@ def chat_page():
             with st.expander("Thinking... (Deep Thought Process)"):
                 thought_container = st.empty()
                 image_files = st.session_state.get('uploaded_images', [])
-                generator = call_xai_api(model, st.session_state['messages'], st.session_state['custom_prompt'], stream=True, image_files=image_files, enable_tools=st.session_state.get('enable_tools', False))
-                full_response = ""
+                generator = call_xai_api(model, st.session_state['messages'], st.session_state['custom_prompt'], stream=True, image_files=image_files,
+                                         enable_tools=st.session_state.get('enable_tools', False), cache=st.session_state.get('response_cache', False),
+                                         prefetch=st.session_state.get('memory_prefetch', False))
+                renderer = StreamRenderer(thought_container)
                 for chunk in generator:
-                    full_response += chunk
-                    thought_container.markdown(full_response, unsafe_allow_html=False)  # Stream into expander
+                    renderer.write(chunk)  # Coalesced, segmented updates into expander
+                full_response = renderer.finish()
             # Always display response outside: parse if marker, else full
-            marker = "### Final Answer"
             display_response = full_response
-            if marker in full_response:
-                parts = full_response.split(marker, 1)
-                thought_part = parts[0].strip()
-                final_part = marker + (parts[1] if len(parts) > 1 else "")
+            thought_part, final_part = split_final_answer(full_response)
+            if FINAL_ANSWER_MARKER in full_response:
                 # Update expander with only thought part
                 thought_container.markdown(thought_part, unsafe_allow_html=False)
                 display_response = final_part
             st.markdown(display_response, unsafe_allow_html=False)
-        st.session_state['messages'].append({"role": "assistant", "content": full_response})
-        # Save to History (Fixed: Insert if new, update if existing)
-        title = st.session_state['messages'][0]['content'][:50] + "..." if st.session_state['messages'] else "New Chat"
-        messages_json = json.dumps(st.session_state['messages'])
-        current_convo_id = st.session_state.get('current_convo_id')
-        if current_convo_id is None:
-            c.execute("INSERT INTO history (user, title, messages) VALUES (?, ?, ?)",
-                      (st.session_state['user'], title, messages_json))
-            conn.commit()
-            st.session_state['current_convo_id'] = c.lastrowid
-        else:
-            c.execute("UPDATE history SET title=?, messages=? WHERE convo_id=?",
-                      (title, messages_json, current_convo_id))
-            conn.commit()
+        st.session_state['messages'].append(new_message("assistant", full_response))
+        st.session_state['current_convo_id'] = save_history(st.session_state['user'], st.session_state['messages'],
+                                                            st.session_state.get('current_convo_id'))
 
-# Load History - Unchanged
+# Save History - Insert if new, update if existing; returns the convo_id
+def save_history(user, messages, convo_id=None):
+    title = messages[0]['content'][:50] + "..." if messages else "New Chat"
+    messages_json = encode_payload(json.dumps(messages))
+    if convo_id is None:
+        c.execute("INSERT INTO history (user, title, messages) VALUES (?, ?, ?)", (user, title, messages_json))
+        convo_id = c.lastrowid
+    else:
+        c.execute("UPDATE history SET title=?, messages=? WHERE convo_id=?", (title, messages_json, convo_id))
+    conn.commit()
+    return convo_id
+
+# History Messages - The user's stored conversation, or None
+def history_messages(user, convo_id):
+    if convo_id is None:
+        return None
+    row = c.execute("SELECT messages FROM history WHERE convo_id=? AND user=?", (convo_id, user)).fetchone()
+    return json.loads(decode_payload(row[0])) if row else None
+
+# Load History - Resets history paging
 def load_history(convo_id):
     c.execute("SELECT messages FROM history WHERE convo_id=?", (convo_id,))
-    messages = json.loads(c.fetchone()[0])
+    messages = json.loads(decode_payload(c.fetchone()[0]))
     st.session_state['messages'] = messages
     st.session_state['current_convo_id'] = convo_id
+    st.session_state['history_visible'] = HISTORY_PAGE_SIZE
     st.rerun()
 
 # Delete History - Unchanged
@@ -1354,14 +4237,19 @@ def delete_history(convo_id):
 
 # Main App with Init Time Check - Unchanged
 if __name__ == "__main__":
+    restore_session()  # Token login, then shared state and the open chat before defaults
+    write_pending_cookies()  # Login/logout cookies queued by the previous run
     if 'logged_in' not in st.session_state:
         st.session_state['logged_in'] = False
         st.session_state['theme'] = 'light'  # Default theme
-    # Init Time Check (on app start)
+    # Init Time Check (on app start) - non-blocking; NTP sync runs in the background
     if 'init_time' not in st.session_state:
-        st.session_state['init_time'] = get_current_time(sync=True)  # Auto-sync on start
+        st.session_state['init_time'] = get_current_time(sync=True)
         print(f"[LOG] Init Time: {st.session_state['init_time']}")
-    if not st.session_state['logged_in']:
-        login_page()
-    else:
-        chat_page()
+    try:
+        if not st.session_state['logged_in']:
+            login_page()
+        else:
+            chat_page()
+    finally:
+        persist_session()  # Also runs when st.rerun() cuts the script short
@@ -0,0 +1,24 @@
+"""Import the HomeBot Streamlit app as a plain module, for the scripts that reuse its code
+(server.py, benchmark.py, migrate.py)."""
+import importlib.util
+import os
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "HomeBot-Rev1.1.py")
+
+
+def load_app(workdir=None, background=True):
+    """Import the app as module homebot_app, from workdir (where chatapp.db lives) if given.
+
+    background=False sets HOMEBOT_BACKGROUND=off before the import, so the maintenance
+    scheduler and memory-job workers never start and the caller is the only writer.
+    """
+    if workdir:
+        os.chdir(workdir)
+    if not background:
+        os.environ["HOMEBOT_BACKGROUND"] = "off"
+    spec = importlib.util.spec_from_file_location("homebot_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["homebot_app"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,661 @@
+"""Offline benchmarks for HomeBot hot paths.
+
+Runs against local stand-in servers and a scratch working directory, so no
+API credits or real network access are needed.
+
+Usage:
+    python benchmark.py http [--requests 200]
+    python benchmark.py embeddings [--vectors 20000] [--queries 200] [--k 10] [--db chatapp.db]
+    python benchmark.py retrieval [--memories 100000] [--queries 100]
+    python benchmark.py load [--sessions 8] [--turns 5] [--tools memory_insert,memory_query,fs_write_file,fs_read_file]
+    python benchmark.py payloads [--convos 20] [--turns 30]
+"""
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app_loader
+
+APP_PATH = app_loader.APP_PATH
+
+
+def load_app(workdir=None):
+    """Import the Streamlit app as a module inside a scratch working directory."""
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    return app_loader.load_app(workdir or tempfile.mkdtemp(prefix="homebot-bench-"))
+
+
+def percentiles(samples):
+    """p50/p95/max of a list of seconds, in milliseconds."""
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    return {
+        "p50": round(statistics.median(ordered) * 1000, 2),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+        "max": round(ordered[-1] * 1000, 2),
+    }
+
+
+class BenchHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Default backlog of 5 drops SYNs under concurrent sessions (1s retransmit stalls)
+
+
+def start_server(handler_cls):
+    """Serve handler_cls on a free localhost port in a daemon thread."""
+    server = BenchHTTPServer(("127.0.0.1", 0), handler_cls)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+# HTTP stand-in: JSON with ETag/Last-Modified, an oversized body, and a POST echo
+class StandInAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so connection reuse is observable
+    disable_nagle_algorithm = True
+    connections = 0
+    requests_served = 0
+    bytes_sent = 0
+    lock = threading.Lock()
+    last_modified = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+    def setup(self):
+        super().setup()
+        with StandInAPIHandler.lock:
+            StandInAPIHandler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            return  # Client stopped reading (size cap)
+        with StandInAPIHandler.lock:
+            StandInAPIHandler.requests_served += 1
+            StandInAPIHandler.bytes_sent += len(body)
+
+    def do_GET(self):
+        if self.path.startswith("/big"):
+            self._send(200, b"x" * (5 * 1024 * 1024), {"Content-Type": "text/plain"})
+            return
+        body = json.dumps({"path": self.path, "items": list(range(2000))}).encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, headers={"ETag": etag})
+            return
+        self._send(200, body, {"Content-Type": "application/json", "ETag": etag, "Last-Modified": self.last_modified})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self._send(200, self.rfile.read(length), {"Content-Type": "application/json"})
+
+
+def bench_http(args):
+    """api_simulate real-call path: pooling, revalidation, size cap and rate limiting."""
+    import requests
+
+    app = load_app()
+    server, base = start_server(StandInAPIHandler)
+    app.API_WHITELIST.append(base)
+    client = app.get_http_client()
+    report = {}
+    n = args.requests
+
+    # Bare requests.get per call (old behaviour) vs the pooled client
+    StandInAPIHandler.connections = 0
+    bare = []
+    for i in range(n):
+        start = time.perf_counter()
+        requests.get(f"{base}bare/{i}", timeout=5).text
+        bare.append(time.perf_counter() - start)
+    report["bare_requests"] = {**percentiles(bare), "connections": StandInAPIHandler.connections}
+
+    StandInAPIHandler.connections = 0
+    pooled = []
+    app.HTTP_RATE_PER_HOST = app.HTTP_RATE_BURST = 10 ** 6  # Measure pooling alone
+    for i in range(n):
+        start = time.perf_counter()
+        client.request("GET", f"{base}pooled/{i}")
+        pooled.append(time.perf_counter() - start)
+    report["pooled_client"] = {**percentiles(pooled), "connections": StandInAPIHandler.connections}
+
+    # Conditional revalidation: second fetch after TTL expiry should be a body-less 304
+    app.HTTP_CACHE_TTL = 0
+    url = f"{base}etag"
+    first = app.api_simulate(url, mock=False)
+    sent_before = StandInAPIHandler.bytes_sent
+    second = app.api_simulate(url, mock=False)
+    report["revalidation"] = {
+        "identical_body": first == second,
+        "bytes_on_revalidate": StandInAPIHandler.bytes_sent - sent_before,
+        "revalidated": client.stats["revalidated"],
+    }
+
+    # Max-bytes cutoff on a 5MB body
+    start = time.perf_counter()
+    big = app.api_simulate(f"{base}big", mock=False)
+    report["size_cap"] = {
+        "returned_chars": len(big),
+        "truncated": "truncated" in big[-60:],
+        "ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+    # Per-host rate limit: a burst past the bucket size must wait
+    app.HTTP_RATE_PER_HOST, app.HTTP_RATE_BURST = 20.0, 5
+    client._buckets.clear()
+    start = time.perf_counter()
+    for i in range(10):
+        client.request("POST", f"{base}echo", json_body={"i": i})
+    report["rate_limit"] = {
+        "requests": 10,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+        "waits": client.stats["rate_limited_waits"],
+    }
+    server.shutdown()
+
+    print(json.dumps(report, indent=2))
+    failures = []
+    if report["pooled_client"]["connections"] > 2:
+        failures.append("pooled client opened a connection per request")
+    if not report["revalidation"]["identical_body"] or report["revalidation"]["bytes_on_revalidate"]:
+        failures.append("conditional revalidation did not reuse the cached body")
+    if not report["size_cap"]["truncated"] or report["size_cap"]["returned_chars"] > app.HTTP_MAX_BYTES + 100:
+        failures.append("response size cap not applied")
+    if not report["rate_limit"]["waits"]:
+        failures.append("rate limiter never waited")
+    return failures
+
+
+def bench_embeddings(args):
+    """Stored embedding formats: bytes per vector, search latency and recall@k vs float32."""
+    import numpy as np
+
+    db_path = os.path.abspath(args.db) if args.db else None  # load_app changes directory
+    app = load_app()
+    rng = np.random.default_rng(0)
+    if db_path:
+        import sqlite3
+        db = sqlite3.connect(db_path)
+        blobs = [row[0] for row in db.execute("SELECT embedding FROM memory WHERE embedding IS NOT NULL")]
+        db.close()
+        if not blobs:
+            return [f"no embeddings found in {db_path}"]
+        corpus = np.stack([app.decode_embedding(b) for b in blobs])
+        queries = corpus[rng.choice(len(corpus), min(args.queries, len(corpus)), replace=False)]
+        queries = queries + rng.normal(0, 0.02, queries.shape).astype(np.float32)
+    else:
+        # Clustered unit vectors, shaped like MiniLM output (384 dims)
+        centers = rng.normal(size=(64, 384)).astype(np.float32)
+        corpus = centers[rng.integers(0, 64, args.vectors)] + rng.normal(0, 0.6, (args.vectors, 384)).astype(np.float32)
+        queries = centers[rng.integers(0, 64, args.queries)] + rng.normal(0, 0.6, (args.queries, 384)).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    def search(matrix):
+        norms = np.maximum(np.linalg.norm(matrix, axis=1), 1e-12)
+        timings, hits = [], []
+        for q in queries:
+            start = time.perf_counter()
+            scores = (matrix @ q) / norms
+            hits.append(set(np.argpartition(-scores, args.k)[:args.k]))
+            timings.append(time.perf_counter() - start)
+        return hits, timings
+
+    truth, _ = search(corpus)
+    report = {"vectors": len(corpus), "queries": len(queries), "k": args.k}
+    for fmt in ("float32", "float16", "int8"):
+        start = time.perf_counter()
+        blobs = [app.encode_embedding(v, fmt) for v in corpus]
+        encode_s = time.perf_counter() - start
+        start = time.perf_counter()
+        matrix = np.stack([app.decode_embedding(b) for b in blobs])
+        decode_s = time.perf_counter() - start
+        hits, timings = search(matrix)
+        recall = statistics.mean(len(h & t) / args.k for h, t in zip(hits, truth))
+        report[fmt] = {
+            "bytes_per_vector": round(statistics.mean(len(b) for b in blobs), 1),
+            "encode_ms": round(encode_s * 1000, 2),
+            "decode_ms": round(decode_s * 1000, 2),
+            "search": percentiles(timings),
+            f"recall@{args.k}": round(recall, 4),
+        }
+    report["legacy_float32_bytes"] = corpus.shape[1] * 4
+
+    print(json.dumps(report, indent=2))
+    failures = []
+    for fmt in ("float16", "int8"):
+        if report[fmt][f"recall@{args.k}"] < args.min_recall:
+            failures.append(f"{fmt} recall@{args.k} below {args.min_recall}")
+        if report[fmt]["bytes_per_vector"] >= report["float32"]["bytes_per_vector"]:
+            failures.append(f"{fmt} blobs are not smaller than float32")
+    return failures
+
+
+def bench_retrieval(args):
+    """Fused memory search (vector + FTS5 + recency) over one user's memories: per-convo, user-wide, filtered."""
+    import numpy as np
+    from datetime import datetime, timedelta
+
+    app = load_app()
+    rng = np.random.default_rng(0)
+    vocab = np.array([f"w{i}" for i in range(5000)] + ["timeout", "ImportError", "config.yaml", "deploy", "pi5"])
+    centers = rng.normal(size=(64, 384)).astype(np.float32)
+    now = datetime.now()
+    rows = []
+    for i in range(args.memories):
+        vec = centers[i % 64] + rng.normal(0, 0.6, 384).astype(np.float32)
+        text = " ".join(rng.choice(vocab, 12))
+        rows.append(("bench", i % args.convos, f"mem_{i}", json.dumps({"note": text}),
+                     app.encode_embedding(vec), 1.0, now - timedelta(minutes=i)))
+    rows.append(("other", 0, "mem_other", json.dumps({"note": "timeout"}), None, 1.0, now))
+    start = time.perf_counter()
+    app.c.executemany("INSERT INTO memory (user, convo_id, mem_key, mem_value, embedding, salience, timestamp) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    app.conn.commit()
+    report = {"memories": args.memories, "convos": args.convos, "load_s": round(time.perf_counter() - start, 2)}
+
+    start = time.perf_counter()
+    app.get_memory_index().search(app.c, "bench", centers[0] / np.linalg.norm(centers[0]), 5)
+    report["index_build_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    queries = []
+    for i in range(args.queries):
+        vec = centers[i % 64] + rng.normal(0, 0.6, 384).astype(np.float32)
+        queries.append((" ".join(rng.choice(vocab, 3)) + " timeout", vec / np.linalg.norm(vec)))
+    for scope, convo_id in (("convo", 1), ("user", None)):
+        timings = []
+        for text, vec in queries:
+            start = time.perf_counter()
+            results = app.hybrid_memory_search(app.c, "bench", text, 5, convo_id, vec)
+            timings.append(time.perf_counter() - start)
+        report[scope] = {**percentiles(timings), "results": len(results),
+                         "convos_in_results": len({r["convo_id"] for r in results})}
+    timings = []
+    for text, _ in queries:
+        start = time.perf_counter()
+        app.hybrid_memory_search(app.c, "bench", text, 5, None, None)
+        timings.append(time.perf_counter() - start)
+    report["user_keyword_only"] = percentiles(timings)
+    timings = []
+    since = (now - timedelta(days=30)).isoformat()
+    for text, vec in queries:
+        start = time.perf_counter()
+        app.hybrid_memory_search(app.c, "bench", text, 5, None, vec, key_prefix="mem_1", since=since)
+        timings.append(time.perf_counter() - start)
+    report["user_filtered"] = percentiles(timings)
+
+    print(json.dumps(report, indent=2))
+    failures = []
+    for name in ("convo", "user", "user_keyword_only", "user_filtered"):
+        if report[name]["p95"] > args.budget_ms:
+            failures.append(f"{name} search p95 above {args.budget_ms}ms")
+    if report["user"]["results"] != 5:
+        failures.append("user-scoped search returned too few results")
+    return failures
+
+
+# xAI stand-in: OpenAI-compatible /chat/completions; streams tokens at a set rate and scripts tool calls
+LOAD_TOOL_ARGS = {
+    "memory_insert": lambda sid, n: {"mem_key": f"load_note_{n}", "mem_value": {"text": f"load test note {n}", "session": sid}},
+    "memory_query": lambda sid, n: {"mem_key": f"load_note_{n}"},
+    "advanced_memory_retrieve": lambda sid, n: {"query": "load test note", "top_k": 3},
+    "fs_write_file": lambda sid, n: {"file_path": f"load_{sid}.txt", "content": f"turn {n}\n" * 200},
+    "fs_read_file": lambda sid, n: {"file_path": f"load_{sid}.txt"},
+    "fs_list_files": lambda sid, n: {"dir_path": ""},
+}
+
+
+class MockXAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    ttft = 0.2  # Seconds before the first streamed chunk
+    tokens_per_sec = 50.0
+    reply_tokens = 40
+    tool_script = ()  # Tool names called on the first request of every turn
+    requests_served = 0
+    prefixes = {}  # conv id -> last system+tools prefix, to report cached prompt tokens like xAI
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _usage(self, request, completion_tokens):
+        prompt_tokens = len(json.dumps([request["messages"], request.get("tools")])) // 4
+        prefix = json.dumps([request["messages"][0], request.get("tools")])
+        conv = self.headers.get("x-grok-conv-id")
+        with MockXAIHandler.lock:
+            cached = len(prefix) // 4 if conv and MockXAIHandler.prefixes.get(conv) == prefix else 0
+            MockXAIHandler.prefixes[conv] = prefix
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens, "prompt_tokens_details": {"cached_tokens": cached}}
+
+    def _chunk(self, model, delta=None, finish=None, usage=None):
+        payload = {"id": "chatcmpl-load", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                   "choices": [] if usage else [{"index": 0, "delta": delta or {}, "finish_reason": finish}]}
+        if usage:
+            payload["usage"] = usage
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+        self.wfile.flush()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        with MockXAIHandler.lock:
+            MockXAIHandler.requests_served += 1
+        model = request.get("model", "grok-4")
+        messages = request["messages"]
+        if not request.get("stream"):
+            # Consolidation worker: one summary, or a JSON array for batched items
+            items = messages[-1]["content"].count("Item ") if "JSON array" in messages[0]["content"] else 0
+            content = json.dumps([f"summary {i}" for i in range(items)]) if items else "summary"
+            self._json({"id": "chatcmpl-load", "object": "chat.completion", "created": int(time.time()), "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                        "usage": self._usage(request, 1)})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")  # No length for SSE; body ends at close
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(self.ttft)
+        turn = sum(1 for m in messages if m["role"] == "user")
+        sid = (self.headers.get("x-grok-conv-id") or "anon")[:8]
+        try:
+            if messages[-1]["role"] == "user" and self.tool_script:
+                calls = [{"index": i, "id": f"call_{sid}_{turn}_{i}", "type": "function",
+                          "function": {"name": name, "arguments": json.dumps(LOAD_TOOL_ARGS[name](sid, turn))}}
+                         for i, name in enumerate(self.tool_script)]
+                self._chunk(model, {"role": "assistant", "tool_calls": calls}, "tool_calls")
+                completion_tokens = len(calls) * 20
+            else:
+                for i in range(self.reply_tokens):
+                    if i:
+                        time.sleep(1 / self.tokens_per_sec)
+                    self._chunk(model, {"content": f"tok{i} "})
+                self._chunk(model, finish="stop")
+                completion_tokens = self.reply_tokens
+            self._chunk(model, usage=self._usage(request, completion_tokens))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+def rss_mb():
+    """Current resident set size (Linux /proc), falling back to peak RSS."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def bench_load(args):
+    """N concurrent chat sessions through call_xai_api + the tool layer against a streaming xAI stand-in."""
+    from collections import deque
+
+    server, base = start_server(MockXAIHandler)
+    MockXAIHandler.ttft = args.ttft_ms / 1000
+    MockXAIHandler.tokens_per_sec = args.tokens_per_sec
+    MockXAIHandler.reply_tokens = args.reply_tokens
+    MockXAIHandler.tool_script = tuple(name for name in args.tools.split(",") if name)
+    unknown = set(MockXAIHandler.tool_script) - set(LOAD_TOOL_ARGS)
+    if unknown:
+        return [f"no scripted arguments for tools: {', '.join(sorted(unknown))}"]
+    os.environ["XAI_BASE_URL"] = base + "v1"
+    os.environ.setdefault("XAI_API_KEY", "load-test")
+    rss_before_import = rss_mb()
+    app = load_app()
+    rss_loaded = rss_mb()
+    tracer = app.get_tracer()
+    tracer.ring = deque(maxlen=500000)  # Keep every span of the run for the breakdown
+    # Each simulated session gets its own session_state and DB connection, as a Streamlit script run would
+    app.conn = app.ThreadLocalProxy(app.open_db_connection)
+    app.c = app.ThreadLocalProxy(lambda: app.conn._get().cursor())
+    app.st.session_state = app.ThreadLocalProxy(dict)
+    sys_prompt = "You are Grok, a helpful assistant. Use tools to save and recall notes and files."
+    ideal_turn = 2 * MockXAIHandler.ttft if MockXAIHandler.tool_script else MockXAIHandler.ttft
+    ideal_turn += (MockXAIHandler.reply_tokens - 1) / MockXAIHandler.tokens_per_sec
+
+    turns, first_chunks, overheads, errors, lock_errors = [], [], [], [], []
+    lock = threading.Lock()
+    rss_peak = [rss_mb()]
+
+    def session(i):
+        state = app.st.session_state
+        state.update({"user": f"load{i}", "enable_tools": True, "custom_prompt": sys_prompt, "messages": []})
+        try:
+            for n in range(args.turns):
+                state["messages"].append(app.new_message("user", f"Turn {n}: save a note and a file, then read them back."))
+                start = time.perf_counter()
+                first = None
+                chunks = []
+                for chunk in app.call_xai_api(args.model, state["messages"], sys_prompt, stream=True, enable_tools=True,
+                                              prefetch=args.prefetch):
+                    if first is None:
+                        first = time.perf_counter() - start
+                    chunks.append(chunk)
+                full = "".join(chunks)
+                state["messages"].append(app.new_message("assistant", full))
+                state["current_convo_id"] = app.save_history(state["user"], state["messages"], state.get("current_convo_id"))
+                elapsed = time.perf_counter() - start
+                with lock:
+                    turns.append(elapsed)
+                    first_chunks.append(first or elapsed)
+                    overheads.append(max(0.0, elapsed - ideal_turn))
+                    if "locked" in full:
+                        lock_errors.append(i)
+                    if "Tool error" in full or "API Error" in full:
+                        errors.append(f"session {i} turn {n}: tool or API error")
+                    rss_peak[0] = max(rss_peak[0], rss_mb())
+        except Exception as e:
+            with lock:
+                errors.append(f"session {i}: {e!r}")
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(args.sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    server.shutdown()
+
+    stats = tracer.stage_stats()
+    report = {
+        "sessions": args.sessions,
+        "turns": len(turns),
+        "wall_s": round(wall, 2),
+        "turns_per_sec": round(len(turns) / wall, 2) if wall else 0.0,
+        "model_requests": MockXAIHandler.requests_served,
+        "ideal_turn_ms": round(ideal_turn * 1000, 1),
+        "turn_latency": percentiles(turns),
+        "first_chunk": percentiles(first_chunks),
+        "overhead": percentiles(overheads),
+        "db": {
+            "lock_errors": len(lock_errors),
+            "stages": {name: stat for name, stat in stats.items() if name.startswith("db.")},
+        },
+        "tools": {name: stat for name, stat in stats.items() if name.startswith(("tool.", "embed."))},
+        "model": {name: stat for name, stat in stats.items() if name.startswith("model.")},
+        "routes": app.get_route_stats().summary(),
+        "prefetch": app.get_memory_prefetcher().stats if args.prefetch else None,
+        "rss_mb": {"before_import": rss_before_import, "app_loaded": rss_loaded, "peak": rss_peak[0], "end": rss_mb()},
+        "errors": errors[:10],
+    }
+
+    print(json.dumps(report, indent=2))
+    failures = []
+    if errors:
+        failures.append(f"{len(errors)} session errors")
+    if lock_errors:
+        failures.append(f"{len(lock_errors)} turns hit 'database is locked'")
+    if len(turns) != args.sessions * args.turns:
+        failures.append("not every turn completed")
+    if report["overhead"]["p95"] > args.budget_ms:
+        failures.append(f"turn overhead p95 above {args.budget_ms}ms (beyond the stand-in's scripted model time)")
+    return failures
+
+def bench_payloads(args):
+    """History/memory payload codecs: bytes written per turn (WAL), DB size, save and load latency."""
+    import random
+    import sqlite3
+
+    app = load_app()
+    rng = random.Random(0)
+    # Chat-like text: line windows from the app source and README (prose, code, JSON-ish tool output)
+    corpus = []
+    for path in (APP_PATH, os.path.join(os.path.dirname(APP_PATH), "README.md")):
+        with open(path, encoding="utf-8") as f:
+            corpus.extend(line.rstrip() for line in f if line.strip())
+
+    def text(lines):
+        start = rng.randrange(len(corpus) - lines)
+        return "\n".join(corpus[start:start + lines])
+
+    def conversation():
+        messages, memories = [], []
+        for _ in range(args.turns):
+            messages.append({"role": "user", "content": text(rng.randint(1, 4)), "id": os.urandom(16).hex()})
+            reply = text(rng.randint(3, 25))
+            if rng.random() < 0.3:
+                reply += f"\n[Tool Result (fs_read_file): {text(rng.randint(20, 80))}]\n"
+            messages.append({"role": "assistant", "content": reply, "id": os.urandom(16).hex()})
+            memories.append(json.dumps({"content": text(rng.randint(1, 30)), "tags": ["bench"]}))
+            yield json.dumps(messages), memories[-1]
+
+    convos = [list(conversation()) for _ in range(args.convos)]
+    configs = ["off", "zlib"] + (["zstd", "zstd+dict"] if app.zstandard else [])
+    report = {"convos": args.convos, "turns": args.turns, "min_bytes": app.PAYLOAD_MIN_BYTES}
+    workdir = tempfile.mkdtemp(prefix="homebot-payloads-")
+    for name in configs:
+        codec = app.PayloadCodec(name.split("+")[0])
+        if name == "zstd+dict":
+            # Dictionary trained on separate conversations, as migrate.py payloads --train does on real data
+            samples = [value.encode() for _ in range(20) for turn in conversation() for value in turn]
+            codec.add_dictionary(app.zstandard.train_dictionary(app.PAYLOAD_DICT_SIZE, samples).as_bytes())
+        path = os.path.join(workdir, f"{name}.db")
+        db = sqlite3.connect(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA wal_autocheckpoint=0")  # WAL only grows: its size is the bytes written
+        db.execute("CREATE TABLE history (convo_id INTEGER PRIMARY KEY, messages TEXT)")
+        db.execute("CREATE TABLE memory (mem_value TEXT)")
+        db.commit()
+        saves, payload_bytes = [], 0
+        for convo_id, turns in enumerate(convos, 1):
+            db.execute("INSERT INTO history (convo_id, messages) VALUES (?, ?)", (convo_id, "[]"))
+            for messages_json, mem_json in turns:
+                start = time.perf_counter()
+                messages_value, mem_value = codec.encode(messages_json), codec.encode(mem_json)
+                db.execute("UPDATE history SET messages=? WHERE convo_id=?", (messages_value, convo_id))
+                db.execute("INSERT INTO memory (mem_value) VALUES (?)", (mem_value,))
+                db.commit()
+                saves.append(time.perf_counter() - start)
+                payload_bytes += sum(len(v.encode() if isinstance(v, str) else v) for v in (messages_value, mem_value))
+        wal_bytes = os.path.getsize(path + "-wal")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        loads = []
+        for convo_id in range(1, len(convos) + 1):
+            start = time.perf_counter()
+            json.loads(codec.decode(db.execute("SELECT messages FROM history WHERE convo_id=?", (convo_id,)).fetchone()[0]))
+            loads.append(time.perf_counter() - start)
+        memory_reads = []
+        for (value,) in db.execute("SELECT mem_value FROM memory"):
+            start = time.perf_counter()
+            json.loads(codec.decode(value))
+            memory_reads.append(time.perf_counter() - start)
+        report[name] = {
+            "payload_kb_per_turn": round(payload_bytes / len(saves) / 1024, 2),
+            "wal_mb_written": round(wal_bytes / 2**20, 2),
+            "db_mb": round(os.path.getsize(path) / 2**20, 2),
+            "save": percentiles(saves),
+            "history_load": percentiles(loads),
+            "memory_read": percentiles(memory_reads),
+        }
+        db.close()
+
+    print(json.dumps(report, indent=2))
+    failures = []
+    for name in configs[1:]:
+        if report[name]["wal_mb_written"] >= report["off"]["wal_mb_written"]:
+            failures.append(f"{name} writes no fewer bytes than uncompressed")
+        if report[name]["db_mb"] >= report["off"]["db_mb"]:
+            failures.append(f"{name} DB is not smaller than uncompressed")
+        if report[name]["history_load"]["p95"] > args.budget_ms:
+            failures.append(f"{name} history load p95 above {args.budget_ms}ms")
+    return failures
+
+
+BENCHMARKS = {
+    "http": bench_http,
+    "embeddings": bench_embeddings,
+    "retrieval": bench_retrieval,
+    "load": bench_load,
+    "payloads": bench_payloads,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    http = sub.add_parser("http", help="shared HTTP client behind api_simulate")
+    http.add_argument("--requests", type=int, default=200)
+    emb = sub.add_parser("embeddings", help="float32 vs float16 vs int8 embedding storage")
+    emb.add_argument("--vectors", type=int, default=20000)
+    emb.add_argument("--queries", type=int, default=200)
+    emb.add_argument("--k", type=int, default=10)
+    emb.add_argument("--min-recall", type=float, default=0.9)
+    emb.add_argument("--db", help="measure real embeddings from this chatapp.db instead of synthetic ones")
+    ret = sub.add_parser("retrieval", help="hybrid memory search latency at scale")
+    ret.add_argument("--memories", type=int, default=100000)
+    ret.add_argument("--convos", type=int, default=200)
+    ret.add_argument("--queries", type=int, default=100)
+    ret.add_argument("--budget-ms", type=float, default=50.0)
+    load = sub.add_parser("load", help="concurrent chat sessions against a streaming xAI stand-in")
+    load.add_argument("--sessions", type=int, default=8)
+    load.add_argument("--turns", type=int, default=5)
+    load.add_argument("--model", default="grok-4", help='"auto" to exercise model routing')
+    load.add_argument("--ttft-ms", type=float, default=200.0)
+    load.add_argument("--tokens-per-sec", type=float, default=50.0)
+    load.add_argument("--reply-tokens", type=int, default=40)
+    load.add_argument("--tools", default="memory_insert,memory_query,fs_write_file,fs_read_file",
+                      help="comma-separated tool calls scripted on each turn (empty for plain chat)")
+    load.add_argument("--prefetch", action="store_true", help="speculative memory prefetch on every turn")
+    load.add_argument("--budget-ms", type=float, default=750.0, help="p95 turn time beyond the scripted model time")
+    pay = sub.add_parser("payloads", help="history/memory payload compression (off vs zlib vs zstd)")
+    pay.add_argument("--convos", type=int, default=20)
+    pay.add_argument("--turns", type=int, default=30)
+    pay.add_argument("--budget-ms", type=float, default=20.0, help="p95 history load (SELECT + decompress + JSON parse)")
+    args = parser.parse_args()
+    failures = BENCHMARKS[args.bench](args)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ pip install \
     streamlit==1.38.0 \
     openai==1.40.0 \
     passlib==1.7.4 \
+    bcrypt==4.0.1 \
     python-dotenv==1.0.1 \
     ntplib==0.4.0 \
     pygit2==1.15.0 \
@@ -32,7 +33,9 @@ pip install \
     cssbeautifier==1.15.1 \
     pyyaml==6.0.2 \
     sqlparse==0.5.1 \
-    beautifulsoup4==4.12.3
+    beautifulsoup4==4.12.3 \
+    starlette==0.38.2 \
+    uvicorn==0.30.6
 
 echo "Installing torch with CPU wheels for Raspberry Pi..."
 pip install torch==2.4.0 --extra-index-url https://download.pytorch.org/whl/cpu
@@ -0,0 +1,85 @@
+"""One-shot storage migrations for HomeBot's chatapp.db.
+
+Idle maintenance already converts rows in batches; run this to convert a whole
+database at once (e.g. after changing HOMEBOT_PAYLOAD_CODEC), ideally while
+the app is stopped.
+
+Usage:
+    python migrate.py payloads [--dir .] [--codec zlib|zstd|off] [--train] [--vacuum]
+    python migrate.py embeddings [--dir .] [--format float16|int8|float32] [--vacuum]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from app_loader import load_app
+
+
+def db_bytes(db):
+    return db.execute("PRAGMA page_count").fetchone()[0] * db.execute("PRAGMA page_size").fetchone()[0]
+
+
+def migrate_payloads(app, args):
+    """Re-encode every history/memory payload in the configured codec (training a zstd dictionary first with --train)."""
+    report = {"codec": app.get_payload_codec().codec}
+    if args.train and report["codec"] != "zstd":
+        sys.exit("--train needs the zstd codec (--codec zstd, with zstandard installed)")
+    db = app.open_db_connection()
+    if args.train:
+        try:
+            report["dict_id"] = app.train_payload_dictionary(db)
+        except RuntimeError as e:
+            sys.exit(str(e))
+    start = time.perf_counter()
+    report.update(app.migrate_payloads(db))
+    report["seconds"] = round(time.perf_counter() - start, 2)
+    return db, report
+
+
+def migrate_embeddings(app, args):
+    """Re-encode every stored embedding in the configured format."""
+    db = app.open_db_connection()
+    start = time.perf_counter()
+    report = {"format": args.format or app.EMBEDDING_FORMAT, **app.migrate_embeddings(db, args.format)}
+    report["seconds"] = round(time.perf_counter() - start, 2)
+    return db, report
+
+
+MIGRATIONS = {
+    "payloads": migrate_payloads,
+    "embeddings": migrate_embeddings,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="migration", required=True)
+    payloads = sub.add_parser("payloads", help="compress (or decompress) history and memory payloads")
+    payloads.add_argument("--codec", choices=["zlib", "zstd", "off"], help="overrides HOMEBOT_PAYLOAD_CODEC")
+    payloads.add_argument("--train", action="store_true", help="train a zstd dictionary on the stored payloads first")
+    embeddings = sub.add_parser("embeddings", help="re-encode stored embedding vectors")
+    embeddings.add_argument("--format", choices=["float32", "float16", "int8"], help="overrides HOMEBOT_EMBEDDING_FORMAT")
+    for p in (payloads, embeddings):
+        p.add_argument("--dir", default=".", help="directory holding chatapp.db")
+        p.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to return freed pages to the filesystem")
+    args = parser.parse_args()
+    workdir = os.path.abspath(args.dir)
+    if not os.path.exists(os.path.join(workdir, "chatapp.db")):
+        sys.exit(f"no chatapp.db in {workdir}")
+    if getattr(args, "codec", None):
+        os.environ["HOMEBOT_PAYLOAD_CODEC"] = args.codec
+    os.environ.setdefault("HOMEBOT_TRACE_SINK", "off")
+    app = load_app(workdir, background=False)  # No maintenance or job threads writing mid-migration
+    db, report = MIGRATIONS[args.migration](app, args)
+    if args.vacuum:
+        size_before = db_bytes(db)
+        app.vacuum_memory_db(db)
+        report["bytes_reclaimed"] = size_before - db_bytes(db)
+    db.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""Headless HomeBot API: chat turns as Server-Sent Events, plus memory and history endpoints.
+
+Runs the same call_xai_api, tools and database as the Streamlit UI, without its
+per-interaction script rerun. Clients authenticate with HTTP Basic using their
+HomeBot username and password.
+
+Usage:
+    python server.py [--host 0.0.0.0] [--port 8600]
+    uvicorn server:app --host 0.0.0.0 --port 8600
+    HOMEBOT_SESSION_BACKEND=sqlite uvicorn server:app --workers 4   # workers share session state
+
+Endpoints:
+    POST   /v1/chat                  {"message", "convo_id"?, "model"?, "prompt"?, "tools"?, "cache"?, "prefetch"?} -> SSE
+    GET    /v1/history               conversations (convo_id, title)
+    GET    /v1/history/{convo_id}    messages of one conversation
+    DELETE /v1/history/{convo_id}
+    GET    /v1/memory                ?convo_id=&key=&limit=&scope=convo|user
+    POST   /v1/memory                {"convo_id", "mem_key", "mem_value"}
+    GET    /v1/memory/search         ?q=&convo_id=&top_k=&scope=&key_prefix=&since=&until=&level=
+    GET    /healthz
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+import app_loader
+
+SERVER_WORKERS = int(os.getenv("HOMEBOT_SERVER_WORKERS", "8"))  # Threads running turns and DB calls (one connection each)
+SERVER_SESSIONS = 256  # Per-conversation session states kept in RAM (LRU)
+SERVER_DEFAULT_MODEL = os.getenv("HOMEBOT_SERVER_MODEL", "grok-4")
+AUTH_CACHE_TTL = 300  # Seconds a verified Basic credential skips the (deliberately slow) password hash
+
+
+def load_app():
+    """Import the Streamlit app as a module; conn, c and st.session_state become per-thread."""
+    module = app_loader.load_app()
+    module.conn = module.ThreadLocalProxy(module.open_db_connection)
+    module.c = module.ThreadLocalProxy(lambda: module.conn._get().cursor())
+    module.st.session_state = module.ThreadLocalProxy()
+    return module
+
+
+homebot = load_app()
+pool = ThreadPoolExecutor(max_workers=SERVER_WORKERS, thread_name_prefix="homebot-api")
+sessions = OrderedDict()  # session id -> this worker's copy of the state (what st.session_state holds in the UI)
+sessions_lock = threading.Lock()
+auth_cache = {}  # sha256(user, password) -> expiry
+
+
+def get_session(user, convo_id):
+    """(session id, state) for one conversation. Shared keys are reloaded from the session store each turn;
+    local-only ones (turn lock, REPL namespace, embedding model) stay in this worker."""
+    sid = f"api:{user}:{convo_id}"
+    with sessions_lock:
+        state = sessions.get(sid)
+        if state is None:
+            state = sessions[sid] = {"user": user, "current_convo_id": convo_id, "messages": [],
+                                     "turn_lock": threading.Lock()}
+            while len(sessions) > SERVER_SESSIONS:
+                sessions.popitem(last=False)
+        sessions.move_to_end(sid)
+        return sid, state
+
+
+def drop_session(user, convo_id):
+    sid = f"api:{user}:{convo_id}"
+    with sessions_lock:
+        sessions.pop(sid, None)
+    homebot.get_session_store().delete(sid)
+
+
+def run_bound(state, func, *args):
+    """Run func on a worker thread with state bound as st.session_state; commits on success."""
+    def call():
+        homebot.st.session_state.bind(state)
+        try:
+            result = func(*args)
+            homebot.conn.commit()
+            return result
+        except Exception:
+            homebot.conn.rollback()
+            raise
+        finally:
+            homebot.st.session_state.unbind()
+    return asyncio.get_running_loop().run_in_executor(pool, call)
+
+
+async def authenticate(request: Request) -> str:
+    header = request.headers.get("authorization", "")
+    if not header.lower().startswith("basic "):
+        raise HTTPException(401, headers={"WWW-Authenticate": 'Basic realm="HomeBot"'})
+    try:
+        username, _, password = base64.b64decode(header[6:]).decode().partition(":")
+    except ValueError:
+        raise HTTPException(401, headers={"WWW-Authenticate": 'Basic realm="HomeBot"'})
+    key = hashlib.sha256(f"{username}\0{password}".encode()).hexdigest()
+    if auth_cache.get(key, 0) > time.time():
+        return username
+    if not await run_bound({}, homebot.check_login, username, password):
+        raise HTTPException(401, headers={"WWW-Authenticate": 'Basic realm="HomeBot"'})
+    auth_cache[key] = time.time() + AUTH_CACHE_TTL
+    return username
+
+
+def owned_convo(user, convo_id):
+    """(title, messages) of the user's conversation, or None."""
+    homebot.c.execute("SELECT title, messages FROM history WHERE convo_id=? AND user=?", (convo_id, user))
+    row = homebot.c.fetchone()
+    return (row[0], json.loads(homebot.decode_payload(row[1]))) if row else None
+
+
+def int_param(value, name):
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        raise HTTPException(400, f"{name} must be an integer.")
+
+
+def tool_result(text):
+    """Tool functions return JSON or a plain message; pass JSON through as data."""
+    try:
+        return {"result": json.loads(text)}
+    except (TypeError, ValueError):
+        return {"result": text}
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def chat(request: Request):
+    user = await authenticate(request)
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(400, "Body must be JSON.")
+    message = body.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise HTTPException(400, "message is required.")
+    convo_id = int_param(body.get("convo_id"), "convo_id")
+    if convo_id is None:
+        convo_id = await run_bound({}, homebot.save_history, user, [])  # New chat row, like ensure_convo_id
+    elif await run_bound({}, owned_convo, user, convo_id) is None:
+        raise HTTPException(404, "Conversation not found.")
+    prompt = body.get("prompt")
+    if prompt:
+        if prompt not in homebot.load_prompt_files():  # Only files listed in ./prompts/ (no paths)
+            raise HTTPException(404, "Prompt file not found.")
+        sys_prompt = homebot.get_prompt_registry().read(prompt)
+    else:
+        sys_prompt = "You are Grok, a helpful AI."
+    model = body.get("model") or SERVER_DEFAULT_MODEL
+    enable_tools = bool(body.get("tools", False))
+    use_cache = bool(body.get("cache", False))
+    prefetch = bool(body.get("prefetch", False))
+    sid, state = get_session(user, convo_id)
+    if not state["turn_lock"].acquire(blocking=False):
+        raise HTTPException(409, "A turn is already running for this conversation.")
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def emit(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def run_turn():
+        homebot.st.session_state.bind(state)
+        try:
+            stored = homebot.load_session_state(sid) or {}  # Turns may have run on another worker
+            if stored.pop("owner", None) == user:
+                state.update(stored)
+            # History is the source of truth, so turns from the UI and the API interleave on one conversation
+            state["messages"] = owned_convo(user, convo_id)[1]
+            state.update({"enable_tools": enable_tools, "custom_prompt": sys_prompt})
+            state["messages"].append(homebot.new_message("user", message))
+            chunks = []
+            generator = homebot.call_xai_api(model, state["messages"], sys_prompt, stream=True, enable_tools=enable_tools,
+                                             cache=use_cache, prefetch=prefetch)
+            for chunk in generator:
+                if cancelled.is_set():
+                    generator.close()
+                    break
+                chunks.append(chunk)
+                emit(("delta", {"text": chunk}))
+            full_response = "".join(chunks)
+            state["messages"].append(homebot.new_message("assistant", full_response))
+            homebot.save_history(user, state["messages"], convo_id)
+            homebot.save_session_state(sid, state)
+            _, answer = homebot.split_final_answer(full_response)
+            emit(("done", {"convo_id": convo_id, "content": full_response,
+                           "answer": answer if homebot.FINAL_ANSWER_MARKER in full_response else full_response,
+                           "usage": (state.get("prompt_usage") or [None])[-1]}))
+        except Exception as e:
+            homebot.conn.rollback()
+            print(f"[LOG] API turn error: {e}")
+            emit(("error", {"error": str(e)}))
+        finally:
+            homebot.st.session_state.unbind()
+            state["turn_lock"].release()
+            emit(None)
+
+    pool.submit(run_turn)
+
+    async def events():
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                yield sse(*item)
+        finally:
+            cancelled.set()  # Client went away: stop consuming the model stream
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Convo-Id": str(convo_id)})
+
+
+async def history_list(request: Request):
+    user = await authenticate(request)
+
+    def query():
+        homebot.c.execute("SELECT convo_id, title FROM history WHERE user=? ORDER BY convo_id DESC", (user,))
+        return [{"convo_id": row[0], "title": row[1]} for row in homebot.c.fetchall()]
+    return JSONResponse(await run_bound({}, query))
+
+
+async def history_item(request: Request):
+    user = await authenticate(request)
+    convo_id = int_param(request.path_params["convo_id"], "convo_id")
+    convo = await run_bound({}, owned_convo, user, convo_id)
+    if convo is None:
+        raise HTTPException(404, "Conversation not found.")
+    if request.method == "DELETE":
+        await run_bound({}, lambda: homebot.c.execute("DELETE FROM history WHERE convo_id=? AND user=?", (convo_id, user)))
+        await run_bound({}, drop_session, user, convo_id)
+        return JSONResponse({"deleted": convo_id})
+    return JSONResponse({"convo_id": convo_id, "title": convo[0], "messages": convo[1]})
+
+
+async def memory(request: Request):
+    user = await authenticate(request)
+    if request.method == "POST":
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(400, "Body must be JSON.")
+        convo_id = int_param(body.get("convo_id"), "convo_id")
+        if convo_id is None or not body.get("mem_key"):
+            raise HTTPException(400, "convo_id and mem_key are required.")
+        if await run_bound({}, owned_convo, user, convo_id) is None:
+            raise HTTPException(404, "Conversation not found.")
+        return JSONResponse(tool_result(await run_bound({"user": user}, homebot.memory_insert, user, convo_id,
+                                                        body["mem_key"], body.get("mem_value", {}))))
+    params = request.query_params
+    convo_id = int_param(params.get("convo_id"), "convo_id")
+    scope = params.get("scope", "convo")
+    if scope == "convo" and convo_id is None:
+        raise HTTPException(400, "convo_id is required unless scope=user.")
+    limit = int_param(params.get("limit"), "limit") or 10
+    return JSONResponse(tool_result(await run_bound({"user": user}, homebot.memory_query, user, convo_id,
+                                                    params.get("key"), limit, scope)))
+
+
+async def memory_search(request: Request):
+    user = await authenticate(request)
+    params = request.query_params
+    if not params.get("q"):
+        raise HTTPException(400, "q is required.")
+    convo_id = int_param(params.get("convo_id"), "convo_id")
+    scope = params.get("scope", "convo" if convo_id is not None else "user")
+    top_k = int_param(params.get("top_k"), "top_k") or 5
+
+    def search():
+        homebot.st.session_state["embed_model"] = homebot.get_embed_model()  # Vector search, as with advanced tools on
+        return homebot.advanced_memory_retrieve(user, convo_id, params["q"], top_k, scope, params.get("key_prefix"),
+                                                params.get("since"), params.get("until"), params.get("level", "any"))
+    return JSONResponse(tool_result(await run_bound({"user": user}, search)))
+
+
+async def healthz(request: Request):
+    return JSONResponse({"ok": True, "sessions": len(sessions)})
+
+
+app = Starlette(routes=[
+    Route("/v1/chat", chat, methods=["POST"]),
+    Route("/v1/history", history_list, methods=["GET"]),
+    Route("/v1/history/{convo_id}", history_item, methods=["GET", "DELETE"]),
+    Route("/v1/memory", memory, methods=["GET", "POST"]),
+    Route("/v1/memory/search", memory_search, methods=["GET"]),
+    Route("/healthz", healthz, methods=["GET"]),
+])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8600)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()